@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+# Benchmarks for the hot paths. Run against a scratch database, never production:
+#   ./benchmarks.py checkin [swipes]
+#   ./benchmarks.py groupcommit [swipes] [readers]
+#   ./benchmarks.py cardreader [swipes] [stray keys per swipe]   (no database needed)
+#   ./benchmarks.py startup [runs] [budget ms]   (uses a scratch SQLite file; exits 1 over budget)
+
+import os
+import re
+import sys
+import time
+import getpass
+import threading
+from datetime import datetime
+
+import constants as c
+
+BENCH_CUID = "999999999"
+
+
+def main(args):
+    bench = args[1] if len(args) > 1 else None
+
+    if bench == "checkin":
+        benchCheckIn(int(args[2]) if len(args) > 2 else 500)
+    elif bench == "groupcommit":
+        benchGroupCommit(int(args[2]) if len(args) > 2 else 2000, int(args[3]) if len(args) > 3 else 8)
+    elif bench == "cardreader":
+        benchCardReader(int(args[2]) if len(args) > 2 else 2000, int(args[3]) if len(args) > 3 else 0)
+    elif bench == "startup":
+        benchStartup(int(args[2]) if len(args) > 2 else 10, float(args[3]) if len(args) > 3 else 300)
+    else:
+        print("Invalid option\nPossible options: checkin [swipes], groupcommit [swipes] [readers], "
+              "cardreader [swipes] [stray keys], startup [runs] [budget ms]")
+        sys.exit(1)
+
+
+def connectDB():
+#===============================================================================
+# Create and connect a DB object using the default settings
+#===============================================================================
+    from dbUtil import DB
+
+    db = DB(c.DEFAULT_HOST, c.DEFAULT_DATABASE, c.TABLE_USERS, c.TABLE_VISITS, c.DEFAULT_USER,
+            getpass.getpass("Database Password: "))
+
+    if db.connect() != c.SUCCESS:
+        print("Failed to connect to database.")
+        sys.exit(1)
+
+    return db
+
+
+def summarize(label, samples):
+#===============================================================================
+# Print mean and percentiles (in ms) of a list of durations in seconds
+#===============================================================================
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(p * len(samples)))] * 1000
+
+    print("%-34s n=%-6d mean=%7.3fms  p50=%7.3fms  p95=%7.3fms  p99=%7.3fms" %
+          (label, len(samples), sum(samples) / len(samples) * 1000, pick(.50), pick(.95), pick(.99)))
+
+
+def legacyCheckIn(db, CUID):
+#===============================================================================
+# The original interpolated multi-statement check-in, kept here for comparison
+#===============================================================================
+    with db.pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""BEGIN TRANSACTION;""")
+            cursor.execute("""SELECT last_checkIn FROM %s WHERE CUID=\'%s\';""" % (db.dbUsersTable, CUID))
+            cursor.fetchone()
+            cursor.execute("""UPDATE %s SET %s = \'%s\' WHERE %s = \'%s\';""" % (db.dbUsersTable, c.LAST_CHECKIN_COLUMN_USER, datetime.now(), c.CUID_COLUMN_USER, CUID))
+            cursor.execute("""UPDATE %s SET %s = %s + 1 WHERE %s = \'%s\';""" % (db.dbUsersTable, c.VISIT_NUM_COLUMN_USER, c.VISIT_NUM_COLUMN_USER, c.CUID_COLUMN_USER, CUID))
+            cursor.execute("""SELECT %s FROM %s WHERE CUID=\'%s\';""" % (c.VISIT_NUM_COLUMN_USER, db.dbUsersTable, CUID))
+            visitNum = cursor.fetchone()[0]
+            cursor.execute("""INSERT INTO %s (%s, %s, %s) values (\'%s\', \'%s\', \'%s\');""" % (db.dbVisitsTable, c.CUID_COLUMN_VISIT, c.TIMEIN_COLUMN_VISIT, c.VISIT_NUM_COLUMN_VISIT, CUID, datetime.now(), visitNum))
+            cursor.execute("""SELECT %s FROM %s WHERE CUID=\'%s\';""" % (c.EMAIL_COLUMN_USER, db.dbUsersTable, CUID))
+            cursor.fetchone()
+            cursor.execute("""END TRANSACTION;""")
+        finally:
+            cursor.close()
+
+
+def unpreparedCheckIn(db, CUID):
+#===============================================================================
+# The single statement check-in sent as plain text (re-parsed every time)
+#===============================================================================
+    with db.pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            query, params = db.statements.statements["checkIn"]
+            for i, param in reversed(list(enumerate(params))):
+                query = query.replace("$%d" % (i + 1), "%%(%s)s" % param)
+            cursor.execute(query, {"cuid": CUID, "now": None, "allowWithinHour": True})
+            cursor.fetchone()
+        finally:
+            cursor.close()
+
+
+def benchCheckIn(swipes):
+#===============================================================================
+# Compare per-swipe check-in latency of the legacy, unprepared and prepared paths
+#===============================================================================
+    db = connectDB()
+
+    # Use a dedicated throwaway card and allow repeated check-ins for the run
+    c.ALLOW_CHECKIN_WITHIN_HOUR = 1
+    deleteBenchCard(db)
+    db.addCard(BENCH_CUID, "Bench", "Mark", "benchmark")
+
+    paths = [("legacy (7 statements)", lambda: legacyCheckIn(db, BENCH_CUID)),
+             ("single statement, unprepared", lambda: unpreparedCheckIn(db, BENCH_CUID)),
+             ("single statement, prepared", lambda: db.checkIn(BENCH_CUID))]
+
+    try:
+        for label, checkIn in paths:
+            samples = []
+            for i in range(swipes):
+                start = time.perf_counter()
+                checkIn()
+                samples.append(time.perf_counter() - start)
+            summarize(label, samples)
+    finally:
+        deleteBenchCard(db)
+        db.close()
+
+
+def benchGroupCommit(swipes, readers):
+#===============================================================================
+# Throughput of concurrent swipes from several readers at different group
+# commit windows (0 is one transaction per swipe)
+#===============================================================================
+    db = connectDB()
+
+    # One card per reader so every swipe is a real check-in
+    c.ALLOW_CHECKIN_WITHIN_HOUR = 1
+    cards = ["99999%04d" % i for i in range(readers)]
+    deleteBenchCard(db, cards)
+    for i, CUID in enumerate(cards):
+        db.addCard(CUID, "Bench", "Reader%d" % i, "benchmark%d" % i)
+
+    try:
+        for window in [0, 0.005, 0.020, 0.050]:
+            if window:
+                db.enableGroupCommit(window, c.GROUP_COMMIT_MAX)
+            else:
+                db.disableGroupCommit()
+
+            samples = []
+            lock = threading.Lock()
+
+            def reader(CUID):
+                for i in range(swipes // readers):
+                    start = time.perf_counter()
+                    db.checkIn(CUID)
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        samples.append(elapsed)
+
+            start = time.perf_counter()
+            threads = [threading.Thread(target=reader, args=(CUID,)) for CUID in cards]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+
+            summarize("window %4.0fms %7.1f swipes/s" % (window * 1000, len(samples) / elapsed), samples)
+    finally:
+        db.disableGroupCommit()
+        deleteBenchCard(db, cards)
+        db.close()
+
+
+def legacyCardReader(keys):
+#===============================================================================
+# The original GUI decoding: rescan the whole input with a regex on every key
+#===============================================================================
+    regex = re.compile("%(.+)..\?;")
+    cardInput = ""
+    cards = []
+
+    for key in keys:
+        r = regex.search(cardInput)
+        if r is not None:
+            cards.append(r.groups()[0])
+            cardInput = ""
+        else:
+            cardInput += key
+
+    return cards
+
+
+def benchCardReader(swipes, strayKeys):
+#===============================================================================
+# Per-swipe decoding time of the legacy regex rescan and the incremental
+# decoder, feeding one key at a time like the GUI. Stray keys typed before a
+# swipe pile up in the legacy buffer and make every rescan longer
+#===============================================================================
+    from cardReader import SwipeDecoder
+
+    swipe = "x" * strayKeys + "%123456789XX?;123456789=1234?\r"
+    legacy = []
+    incremental = []
+
+    for i in range(swipes):
+        start = time.perf_counter()
+        legacyCardReader(swipe)
+        legacy.append(time.perf_counter() - start)
+
+    decoder = SwipeDecoder(["tigerone"])
+    for i in range(swipes):
+        start = time.perf_counter()
+        for key in swipe:
+            decoder.feed(key, 0.0)
+        incremental.append(time.perf_counter() - start)
+
+    summarize("regex rescan per key (%d keys)" % len(swipe), legacy)
+    summarize("incremental decoder (%d keys)" % len(swipe), incremental)
+
+
+def startToPrompt(command, cwd):
+#===============================================================================
+# Seconds from launching a text mode kiosk to its menu prompt. Exits the
+# kiosk afterwards. Returns None if it ended without showing the menu
+#===============================================================================
+    import subprocess
+
+    start = time.perf_counter()
+    kiosk = subprocess.Popen(command, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    # input() flushes its prompt even when stdout is a pipe
+    output = b""
+    while not output.endswith(b">> "):
+        chunk = kiosk.stdout.read1(4096)
+        if not chunk:
+            break
+        output += chunk
+    elapsed = time.perf_counter() - start
+
+    # Pick Exit from the menu
+    kiosk.communicate(b"5\n", timeout=30)
+    return elapsed if output.endswith(b">> ") else None
+
+
+def benchStartup(runs, budget):
+#===============================================================================
+# Time from launching "checkIn.py --nogui" on a scratch SQLite file to the
+# first menu prompt, and check that text mode never imports PyQt5
+# Exits with 1 if the median is over budget milliseconds
+#===============================================================================
+    import tempfile
+
+    workDir = tempfile.mkdtemp(prefix="magstripe-startup-")
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "checkIn.py"),
+               "--nogui", "--sqlite", os.path.join(workDir, "startup.db")]
+
+    # The first run creates the database file and compiles the modules
+    if startToPrompt(command, workDir) is None:
+        print("The kiosk exited before showing the menu")
+        sys.exit(1)
+
+    samples = [startToPrompt(command, workDir) for i in range(runs)]
+    if None in samples:
+        print("The kiosk exited before showing the menu")
+        sys.exit(1)
+    summarize("text mode start to first prompt", samples)
+
+    # Importing the program the way text mode does must not load Qt
+    import checkIn
+    qtModules = sorted(name for name in sys.modules if name.startswith("PyQt5"))
+
+    median = sorted(samples)[len(samples) // 2] * 1000
+    if qtModules:
+        print("FAIL: text mode imported %s" % ", ".join(qtModules))
+    if median > budget:
+        print("FAIL: median startup %.1f ms is over the %.0f ms budget" % (median, budget))
+    if qtModules or median > budget:
+        sys.exit(1)
+    print("OK: median startup %.1f ms is within the %.0f ms budget" % (median, budget))
+
+
+def deleteBenchCard(db, cards=(BENCH_CUID,)):
+#===============================================================================
+# Remove the benchmark cards and their visits
+#===============================================================================
+    with db.pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM %s WHERE %s = ANY(%%s);" % (db.dbVisitsTable, c.CUID_COLUMN_VISIT), [list(cards)])
+        cursor.execute("DELETE FROM %s WHERE %s = ANY(%%s);" % (db.dbUsersTable, c.CUID_COLUMN_USER), [list(cards)])
+        cursor.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
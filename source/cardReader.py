@@ -0,0 +1,251 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import time
+
+from metrics import STAGE_SECONDS
+import constants as c
+
+# Start sentinel of each track. Track 3 starts with ';' like track 2 on most
+# readers, so a second ';' track in one swipe is taken as track 3
+START_SENTINELS = {"%": 1, ";": 2, "+": 3}
+END_SENTINEL = "?"
+# Longest data allowed on each track by ISO 7811
+MAX_TRACK_LENGTH = {1: 79, 2: 40, 3: 107}
+END_OF_SWIPE = "\r\n"
+# Characters that can change the decoder's state. Anything else is track data
+# or a stray key, which feed() handles without calling step()
+SPECIAL = frozenset(START_SENTINELS) | frozenset(END_SENTINEL) | frozenset(END_OF_SWIPE)
+
+# Decoder states
+IDLE = 0
+IN_TRACK = 1
+BETWEEN_TRACKS = 2
+
+
+class CardFormat:
+    #===========================================================================
+    # A kind of card. Subclasses pull the card ID out of the decoded tracks
+    #===========================================================================
+    name = ""
+
+    def extract(self, tracks):
+    #===========================================================================
+    # The card ID from a dict of track number to track data, or None if the
+    # swipe isn't this kind of card
+    #===========================================================================
+        return None
+
+
+class TigerOneFormat(CardFormat):
+    #===========================================================================
+    # Clemson Tiger One card: the 9 character CUID is track 1 minus its last
+    # two characters
+    #===========================================================================
+    name = "tigerone"
+
+    def extract(self, tracks):
+        track = tracks.get(1)
+        return track[:-2] if track is not None and len(track) == 11 else None
+
+
+class Track2Format(CardFormat):
+    #===========================================================================
+    # ISO 7813 style cards: the card ID is the track 2 account number, which
+    # runs up to the '=' field separator
+    #===========================================================================
+    name = "track2"
+
+    def extract(self, tracks):
+        track = tracks.get(2)
+        if not track or track.startswith("="):
+            return None
+        return track.split("=")[0]
+
+
+FORMATS = {}
+
+
+def registerFormat(cardFormat):
+#===============================================================================
+# Make a card format available to CARD_FORMATS by its name
+#===============================================================================
+    FORMATS[cardFormat.name] = cardFormat
+
+
+registerFormat(TigerOneFormat())
+registerFormat(Track2Format())
+
+
+class SwipeDecoder:
+    def __init__(self, formats=None, timeout=None):
+    #===========================================================================
+    # Incremental decoder for keyboard emulating magstripe readers
+    # Characters are fed in as they arrive and each one is handled once, so a
+    # swipe costs time linear in its length. Only the track being read is
+    # buffered and it is capped at the track's maximum length, so stray keys
+    # can't grow memory. Text outside a track is ignored
+    # The cost is a fixed ~0.5 us of Python per key. On a short clean swipe
+    # that is a little slower than the old regex rescan (about 0.015 ms vs
+    # 0.011 ms for 30 keys, see "benchmarks.py cardreader"), but the rescan
+    # grows with everything typed since the last swipe and this doesn't
+    # A swipe ends at Enter, or when no key arrives for `timeout` seconds after
+    # a complete track (see poll). The card ID comes from the first of the
+    # formats that recognizes the tracks
+    #===========================================================================
+        self.formats = [FORMATS[name] for name in (formats or c.CARD_FORMATS)]
+        self.timeout = timeout if timeout is not None else c.CARD_READ_TIMEOUT
+        # Time of the keys being decoded, and of the first key of the swipe
+        self.now = 0.0
+        self.reset()
+
+
+    def reset(self):
+    #===========================================================================
+    # Forget any partially read swipe
+    #===========================================================================
+        self.state = IDLE
+        self.tracks = {}
+        self.track = None
+        self.maxLength = 0
+        self.chars = []
+        self.error = False
+        self.lastKey = 0.0
+        self.started = 0.0
+
+
+    def feed(self, text, now=None):
+    #===========================================================================
+    # Decode some characters. Returns a list with the card ID of each swipe
+    # that was completed, or ERROR_READING_CARD for each one that was garbled
+    # or not a known card format
+    #===========================================================================
+        if now is None:
+            now = time.monotonic()
+
+        # Fast path for the usual call: one data key of the track being read
+        if (self.state == IN_TRACK and text not in SPECIAL and len(text) == 1
+                and now - self.lastKey <= self.timeout and len(self.chars) < self.maxLength):
+            self.chars.append(text)
+            self.lastKey = now
+            return []
+
+        results = []
+        self.now = now
+        if self.state != IDLE and now - self.lastKey > self.timeout:
+            self.finish(results)
+
+        for char in text:
+            # Track data and stray keys are almost every key; only the few that
+            # can change state go through step(). Data past the track's maximum
+            # length goes there too, to mark the track garbled
+            if char not in SPECIAL:
+                if self.state != IN_TRACK:
+                    continue
+                if len(self.chars) < self.maxLength:
+                    self.chars.append(char)
+                    continue
+            self.step(char, results)
+        self.lastKey = now
+
+        return results
+
+
+    def poll(self, now=None):
+    #===========================================================================
+    # Finish a swipe whose reader went quiet. Call this from a timer for readers
+    # that don't send Enter. Returns a list like feed()
+    #===========================================================================
+        if now is None:
+            now = time.monotonic()
+
+        results = []
+        if self.state != IDLE and now - self.lastKey > self.timeout:
+            self.now = now
+            self.finish(results)
+        return results
+
+
+    def step(self, char, results):
+    #===========================================================================
+    # Advance the state machine by one character
+    #===========================================================================
+        if char in END_OF_SWIPE:
+            if self.state != IDLE:
+                self.finish(results)
+
+        elif self.state == IN_TRACK:
+            if char == END_SENTINEL:
+                self.tracks[self.track] = "".join(self.chars)
+                self.state = BETWEEN_TRACKS
+            elif char in START_SENTINELS and (self.track != 1 or char == "%"):
+                # A track started before the last one ended; the last one is garbled
+                # (';' and '+' are ordinary characters on track 1)
+                self.error = True
+                self.startTrack(char)
+            elif len(self.chars) >= MAX_TRACK_LENGTH[self.track]:
+                self.error = True
+                self.state = BETWEEN_TRACKS
+            else:
+                self.chars.append(char)
+
+        elif char in START_SENTINELS:
+            self.startTrack(char)
+
+        # Anything else is a stray key or the LRC character after a track
+
+
+    def startTrack(self, char):
+    #===========================================================================
+    # Begin reading the track a start sentinel belongs to
+    #===========================================================================
+        track = START_SENTINELS[char]
+        if track == 2 and 2 in self.tracks:
+            track = 3
+
+        if self.state == IDLE:
+            self.started = self.now
+        self.state = IN_TRACK
+        self.track = track
+        self.maxLength = MAX_TRACK_LENGTH[track]
+        self.chars = []
+
+
+    def finish(self, results):
+    #===========================================================================
+    # End the current swipe and record its card ID or an error
+    #===========================================================================
+        # A track that was still being read was cut off and is left out. The
+        # swipe still counts if the format's track was read in full
+        CUID = None
+        if not self.error:
+            for cardFormat in self.formats:
+                CUID = cardFormat.extract(self.tracks)
+                if CUID is not None:
+                    break
+
+        results.append(CUID if CUID is not None else c.ERROR_READING_CARD)
+        STAGE_SECONDS.observe("decode", self.now - self.started)
+        self.reset()
+
+
+    def pending(self):
+    #===========================================================================
+    # Whether a swipe is partially read (and poll() may finish it)
+    #===========================================================================
+        return self.state != IDLE
@@ -19,16 +19,28 @@
 #===============================================================================
 
 import sys
-from ui import UI
+from datetime import datetime, timedelta
+# The GUI (and PyQt5) is imported only when it is started, so text mode starts fast
 from textUtil import TextUI
+from storage import BACKENDS
+from profiling import SessionProfiler
+import metrics
 import constants as c
-import dbUtil
 
 
 def main(args):
     print(c.GROUP_NAME, "Attendance Tracker Version", c.VERSION)
-    # Init textMode
+    metrics.configureLogging()
+    # Profile the whole session if asked to; the stats are written on exit
+    profilePath = parseProfile(args)
+    if profilePath is not None:
+        SessionProfiler(profilePath).start()
+    # Init textMode. Text mode is the default; --gui starts the GUI
     textMode = 1 #1 for text, 0 for UI
+    # Check-in service to use instead of connecting to the database
+    serverURL = None
+    # Storage backend and, for SQLite, the database file
+    backend, dbPath = parseBackend(args)
     # Process the arguments
     if len(args) > 1:
         arg = args[1].lower()
@@ -40,28 +52,147 @@ def main(args):
             sys.exit(0)
         elif arg == "--nogui":
             textMode = 1
+        elif arg == "--gui":
+            textMode = 0
+        elif arg == "--serve":
+            TextUI(backend=backend, dbPath=dbPath).serve()
+            sys.exit(0)
+        elif arg == "--server" and len(args) > 2:
+            serverURL = args[2]
+            textMode = 0 if "--gui" in args[3:] else textMode
+        elif arg == "--init-schema":
+            TextUI(backend=backend, dbPath=dbPath).initSchema()
+            sys.exit(0)
+        elif arg == "--partition-visits":
+            TextUI(backend=backend, dbPath=dbPath).partitionVisits()
+            sys.exit(0)
+        elif arg == "--backfill-rollups":
+            TextUI(backend=backend, dbPath=dbPath).backfillRollups()
+            sys.exit(0)
+        elif arg == "--reports":
+            TextUI(backend=backend, dbPath=dbPath).reports(args[2] if len(args) > 2 else None)
+            sys.exit(0)
+        elif arg == "--import-roster" and len(args) > 2:
+            TextUI(backend=backend, dbPath=dbPath).importRoster(args[2])
+            sys.exit(0)
+        elif arg == "--export-visits" and len(args) > 2:
+            exportVisits(args[2], args[3:], backend, dbPath)
+            sys.exit(0)
         else:
             print("Invalid argument:", args[1])
             sys.exit(0)
 
     # Start the program into either textmode or GUI mode
+    if textMode == 0:
+        try:
+            from ui import UI
+        except ImportError:
+            print("\nThe GUI requires the PyQt5 module to be installed. Starting in text mode (--nogui).")
+            textMode = 1
+
     if textMode == 0:
         global app
-        app = UI(args)
+        app = UI(args, serverURL, backend, dbPath)
         app.exec_()
     else:
-        TextUI().start()
+        TextUI(serverURL, backend, dbPath).start()
 
     # Exit normally
     sys.exit(0)
 
 
+def parseBackend(args):
+#===============================================================================
+# Take "--sqlite [file]" (or "--backend <name>") out of the arguments
+# Returns the storage backend and the SQLite file, if one was given
+#===============================================================================
+    backend = c.DEFAULT_BACKEND
+    dbPath = None
+
+    for i, arg in enumerate(args[1:], 1):
+        if arg.lower() == "--sqlite":
+            backend = "sqlite"
+            # The file is optional
+            if i + 1 < len(args) and not args[i + 1].startswith("--"):
+                dbPath = args.pop(i + 1)
+            args.pop(i)
+            break
+        elif arg.lower() == "--backend" and i + 1 < len(args):
+            backend = args[i + 1].lower()
+            if backend not in BACKENDS:
+                print("Invalid backend: %s\nPossible backends: %s" % (backend, ", ".join(BACKENDS)))
+                sys.exit(1)
+            del args[i:i + 2]
+            break
+
+    return backend, dbPath
+
+
+def parseProfile(args):
+#===============================================================================
+# Take "--profile [file.prof]" out of the arguments
+# Returns the file to save the profile to, or None to not profile
+#===============================================================================
+    for i, arg in enumerate(args[1:], 1):
+        if arg.lower() == "--profile":
+            path = c.PROFILE_PATH
+            # The file is optional
+            if i + 1 < len(args) and not args[i + 1].startswith("--"):
+                path = args.pop(i + 1)
+            args.pop(i)
+            return path
+
+    return None
+
+
+def exportVisits(path, options, backend, dbPath):
+#===============================================================================
+# Parse the export options and run the export
+#===============================================================================
+    fmt = "jsonl" if path.endswith((".jsonl", ".jsonl.gz")) else "csv"
+    compress = path.endswith(".gz")
+    start = end = CUID = None
+
+    try:
+        while options:
+            option = options.pop(0).lower()
+            if option == "--gzip":
+                compress = True
+            elif option == "--format" and options[0] in ("csv", "jsonl"):
+                fmt = options.pop(0)
+            elif option == "--from":
+                start = datetime.strptime(options.pop(0), "%Y-%m-%d")
+            elif option == "--to":
+                # The end date is inclusive
+                end = datetime.strptime(options.pop(0), "%Y-%m-%d") + timedelta(days=1)
+            elif option == "--cuid":
+                CUID = options.pop(0)
+            else:
+                print("Invalid export option:", option)
+                sys.exit(1)
+    except (IndexError, ValueError):
+        print("Invalid export option. Dates are YYYY-MM-DD.")
+        sys.exit(1)
+
+    TextUI(backend=backend, dbPath=dbPath).exportVisits(path, fmt, start, end, CUID, compress)
+
+
 def showHelp():
-    print("Supress GUI:\t--nogui\nShow Help:\t--help\nShow Version:\t--version")
+    print("Start GUI:\t--gui (text mode is the default)\nSupress GUI:\t--nogui\nLocal database:\t--sqlite [file.db] (or --backend postgres|sqlite)\n"
+          "Create tables:\t--init-schema\nPartition visits:\t--partition-visits\nRun service:\t--serve\n"
+          "Use service:\t--server <http://host:port> [--gui]\nImport roster:\t--import-roster <file.csv>\n"
+          "Export visits:\t--export-visits <file> [--format csv|jsonl] [--from YYYY-MM-DD] [--to YYYY-MM-DD] [--cuid CUID] [--gzip]\n"
+          "Write reports:\t--reports [directory]\nRebuild rollups:\t--backfill-rollups\n"
+          "Profile session:\t--profile [file.prof]\n"
+          "Show Help:\t--help\nShow Version:\t--version")
 
 def showVersion():
     print("Version", c.VERSION)
 
 
 if __name__ == '__main__':
+    # Report workers are started as fresh processes, which packaged builds must handle
+    if getattr(sys, "frozen", False):
+        import multiprocessing
+        multiprocessing.freeze_support()
     main(sys.argv)
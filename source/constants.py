@@ -28,6 +28,119 @@ TABLE_VISITS                = "visits"
 DEFAULT_VISITS              = 0
 ALLOW_CHECKIN_WITHIN_HOUR   = 1
 TIME_BETWEEN_CHECKINS       = 2 # In seconds
+# All queries use bound parameters, so the keyword scan in Utils.sanitizeInput is
+# only a second line of defense. Set to 0 to skip it on the card swipe hot path
+SANITIZE_INPUT              = 1
+
+# Where the data lives: "postgres" (a server) or "sqlite" (a local file, see --sqlite)
+DEFAULT_BACKEND             = "postgres"
+SQLITE_PATH                 = "attendance.db"
+SQLITE_SYNCHRONOUS          = "NORMAL" # "FULL" also survives power loss, at an fsync per check-in
+SQLITE_BUSY_TIMEOUT         = 5 # How long to wait for another writer, in seconds
+SQLITE_CACHE_SIZE           = 16384 # Page cache per connection, in KiB
+SQLITE_MMAP_SIZE            = 268435456 # Bytes of the file to memory map
+
+# Connection pool shared by the worker threads
+POOL_MIN_CONN               = 1
+POOL_MAX_CONN               = 4
+POOL_RESERVED_FOR_CHECKIN   = 1 # Connections reports cannot take
+POOL_CHECKOUT_TIMEOUT       = 5 # In seconds
+POOL_VALIDATE_AFTER         = 30 # Ping connections idle longer than this, in seconds
+
+# Offline swipe journal. Set JOURNAL_PATH to "" to disable journaling
+JOURNAL_PATH                = "swipes.journal"
+KIOSK_ID                    = "" # Defaults to the host name
+JOURNAL_FSYNC_GROUP         = 8 # fsync after this many swipes...
+JOURNAL_FSYNC_DELAY         = 0.05 # ...or this many seconds, whichever is first
+JOURNAL_REPLAY_INTERVAL     = 10 # In seconds
+JOURNAL_REPLAY_BATCH        = 5000 # Swipes per replay transaction
+
+# Group commit: apply swipes arriving within a short window in one transaction
+# It pays off when many readers share one server (see ./benchmarks.py groupcommit);
+# with a few readers, waiting for the window costs more than it saves
+GROUP_COMMIT                = 0
+GROUP_COMMIT_WINDOW         = 0.02 # In seconds
+GROUP_COMMIT_MAX            = 32 # Most swipes in one transaction
+
+# In-memory user cache, kept in sync with LISTEN/NOTIFY. Set the size to 0 to disable
+USER_CACHE_SIZE             = 5000
+NOTIFY_CHANNEL              = "magstripe_users"
+
+# Roster snapshot used to reject unknown cards without a database trip. "" to disable
+ROSTER_PATH                 = "roster.snapshot"
+
+# Monthly visits partitions (Postgres). Set VISITS_PARTITIONED to 1 to give new databases
+# a partitioned visits table; run checkIn.py --partition-visits to convert an existing one
+VISITS_PARTITIONED          = 0
+VISITS_PARTITIONS_AHEAD     = 3 # Months of partitions created ahead of time
+VISITS_RETENTION_MONTHS     = 0 # Retire partitions older than this many months; 0 keeps every month
+VISITS_RETENTION_ACTION     = "detach" # "detach" keeps retired months as separate tables, "drop" deletes them
+VISITS_PARTITION_INTERVAL   = 21600 # Seconds between partition checks
+PARTITION_LOCK_TIMEOUT      = 2 # How long partition changes may wait for check-ins, in seconds
+
+# Rows per transaction when bulk importing a roster
+IMPORT_BATCH_SIZE           = 5000
+
+# Card formats to recognize, tried in order (see cardReader.FORMATS)
+CARD_FORMATS                = ["tigerone"]
+CARD_READ_TIMEOUT           = 0.3 # Seconds of reader silence that end a swipe
+
+# Request engine shared by both front ends
+ENGINE_WORKERS              = 4 # Concurrent DB calls; no point exceeding POOL_MAX_CONN
+ENGINE_TIMEOUT              = 10 # Seconds a request may wait for a worker
+SWIPE_SOURCES               = [] # Extra card readers (devices or pipes) to check in from
+
+# Swipes waiting to be checked in by the kiosk. When full, "spill" saves swipes to
+# the offline journal (if enabled) and "reject" asks the user to swipe again
+SWIPE_QUEUE_SIZE            = 64
+SWIPE_QUEUE_OVERFLOW        = "spill"
+SWIPE_QUEUE_STATS_WINDOW    = 100 # Swipes the wait time stats cover
+
+# HTTP/JSON check-in service (checkIn.py --serve) and its kiosk clients (--server)
+SERVICE_HOST                = "127.0.0.1" # Use "0.0.0.0" to accept kiosks on other machines
+SERVICE_PORT                = 8734
+SERVICE_TOKEN               = "" # Shared secret kiosks must send; "" allows anyone who can connect
+SERVICE_MAX_BATCH           = 500 # Most CUIDs in one batch check-in request
+SERVICE_MAX_ROWS            = 5000 # Most visits rows in one response
+SERVICE_CLIENT_TIMEOUT      = 10 # In seconds
+SERVICE_LOG_REQUESTS        = 0
+
+# Visit reports (checkIn.py --reports or the Reports menu). They need NumPy
+REPORT_DIR                  = "reports"
+REPORT_FETCH_BATCH          = 50000 # Visits read per round trip
+REPORT_WORKERS              = 4 # Processes computing reports side by side; 1 computes them in-process
+REPORT_PARALLEL_MIN         = 1000000 # Fewer visits than this are quicker to report on in-process
+REPORT_COHORT_MONTHS        = 12 # Months after their first visit that cohorts are followed
+
+# Windowed leaderboard ("Top Visitors"), read from the rollup tables
+LEADERBOARD_SIZE            = 10
+LEADERBOARD_DAYS            = 30 # Default window, in days up to today
+
+# Instrumentation. Metrics are served in the Prometheus text format on
+# http://METRICS_HOST:METRICS_PORT/metrics; a port of 0 turns the endpoint off
+METRICS_HOST                = "127.0.0.1"
+METRICS_PORT                = 0
+METRICS_BUCKETS             = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5] # In seconds
+# Diagnostic log, with a trace id per swipe. "" logs to the console
+LOG_PATH                    = ""
+LOG_LEVEL                   = "WARNING" # "INFO" logs every swipe, "DEBUG" each stage
+
+# Session profile written on exit by checkIn.py --profile
+PROFILE_PATH                = "checkin.prof"
+PROFILE_SORT                = "cumulative" # Any pstats sort key, e.g. "tottime"
+PROFILE_TOP                 = 40 # Entries printed on exit
+
+# Postgres statements slower than this (in seconds) are written to SLOW_QUERY_LOG
+# with their parameters, e.g. 0.25. 0 turns the slow-query log off
+SLOW_QUERY_THRESHOLD        = 0
+SLOW_QUERY_LOG              = "slow_queries.log"
+SLOW_QUERY_LOG_BYTES        = 1048576 # Rotate after this many bytes...
+SLOW_QUERY_LOG_BACKUPS      = 5 # ...keeping this many old logs
+SLOW_QUERY_EXPLAIN          = 0 # Also log the plan, from EXPLAIN ANALYZE in a rolled back transaction
+SLOW_QUERY_EXPLAIN_GAP      = 60 # Seconds before the same statement is explained again
+
+# Rows fetched per round trip when streaming the visits standings
+VISITS_FETCH_BATCH          = 500
 
 CUID_COLUMN_USER            = "cuid"
 LAST_CHECKIN_COLUMN_USER    = "last_checkin"
@@ -59,3 +172,9 @@ BAD_CHECKIN_TIME    = 4
 FUTURE_CHECKIN_TIME = 5
 SQL_ERROR           = 6
 NO_RESULTS          = 7
+DB_BUSY             = 8
+
+# Check-in was saved to the offline journal and will be replayed later
+CHECKIN_JOURNALED   = 9
+# The kiosk's swipe queue was full and the swipe was turned away
+SWIPE_QUEUE_FULL    = 12
@@ -0,0 +1,213 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import time
+import threading
+from contextlib import contextmanager
+
+# The pool only ever holds Postgres connections and is never opened without psycopg2
+try:
+    import psycopg2
+    import psycopg2.extensions
+except ImportError:
+    psycopg2 = None
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, connectFunc, minConn, maxConn, timeout, validateAfter, reserved=0, closeCallback=None):
+    #===========================================================================
+    # Bounded, thread-safe pool of database connections
+    # connectFunc opens a new connection. `reserved` connections can only be
+    # taken by priority callers so reports can never starve check-ins
+    #===========================================================================
+        self.connectFunc = connectFunc
+        self.minConn = minConn
+        self.maxConn = maxConn
+        self.timeout = timeout
+        self.validateAfter = validateAfter
+        self.reserved = min(reserved, maxConn - 1)
+        self.closeCallback = closeCallback
+
+        # Idle connections as (connection, time it was returned) pairs
+        self.idle = []
+        # Number of open connections, idle or checked out
+        self.size = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+
+    def open(self):
+    #===========================================================================
+    # Open the minimum number of connections. Connection errors are raised
+    #===========================================================================
+        for i in range(self.minConn):
+            conn = self.connectFunc()
+            with self.cond:
+                self.size += 1
+                self.idle.append((conn, time.monotonic()))
+
+
+    def getConn(self, timeout=None, priority=False):
+    #===========================================================================
+    # Check out a healthy connection, waiting up to timeout seconds for one
+    # Raises PoolTimeout if none became available
+    #===========================================================================
+        if timeout is None:
+            timeout = self.timeout
+
+        deadline = time.monotonic() + timeout
+        limit = self.maxConn if priority else self.maxConn - self.reserved
+
+        while True:
+            conn = None
+            with self.cond:
+                while True:
+                    if self.closed:
+                        raise PoolTimeout("Connection pool is closed")
+
+                    inUse = self.size - len(self.idle)
+                    if self.idle and inUse < limit:
+                        conn, lastUsed = self.idle.pop()
+                        break
+                    elif self.size < limit:
+                        # Reserve the slot now and connect outside of the lock
+                        self.size += 1
+                        lastUsed = None
+                        break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout("Timed out waiting for a database connection")
+                    self.cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    return self.connectFunc()
+                except Exception:
+                    self.release()
+                    raise
+
+            if self.isHealthy(conn, lastUsed):
+                return conn
+
+            # Drop the dead connection and try again
+            self.discard(conn)
+
+
+    def isHealthy(self, conn, lastUsed):
+    #===========================================================================
+    # Check a connection is usable. Connections idle for longer than
+    # validateAfter seconds are pinged in case the server dropped them
+    #===========================================================================
+        if conn.closed:
+            return False
+
+        if time.monotonic() - lastUsed < self.validateAfter:
+            return True
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.close()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+    def putConn(self, conn):
+    #===========================================================================
+    # Return a connection to the pool. Broken connections are discarded and
+    # an unfinished transaction is rolled back
+    #===========================================================================
+        if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+
+        if self.closed or conn.closed or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            self.discard(conn)
+            return
+
+        # Wake every waiter: the first one may be a normal caller that can't
+        # take a connection freed from the reserve, while a priority caller can
+        with self.cond:
+            self.idle.append((conn, time.monotonic()))
+            self.cond.notify_all()
+
+
+    @contextmanager
+    def connection(self, timeout=None, priority=False):
+    #===========================================================================
+    # Borrow a connection for the body of a with statement
+    #===========================================================================
+        conn = self.getConn(timeout, priority)
+        try:
+            yield conn
+        finally:
+            self.putConn(conn)
+
+
+    def discard(self, conn):
+    #===========================================================================
+    # Close a connection and free its slot
+    #===========================================================================
+        if self.closeCallback is not None:
+            self.closeCallback(conn)
+
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+        self.release()
+
+
+    def release(self):
+    #===========================================================================
+    # Free a connection slot and wake up the waiting callers
+    #===========================================================================
+        with self.cond:
+            self.size -= 1
+            self.cond.notify_all()
+
+
+    def inUse(self):
+    #===========================================================================
+    # Number of connections checked out
+    #===========================================================================
+        with self.cond:
+            return self.size - len(self.idle)
+
+
+    def closeAll(self):
+    #===========================================================================
+    # Close every idle connection. Checked out connections are closed when returned
+    #===========================================================================
+        with self.cond:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+            self.cond.notify_all()
+
+        for conn, lastUsed in idle:
+            self.discard(conn)
@@ -16,208 +16,1460 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>. 
 #===============================================================================
 
+import io
 import os
+import csv
+import gzip
 import re
-import sys
-from datetime import datetime
+import time
+import threading
+from datetime import datetime, timedelta
 from sharedUtils import Utils
 
 import constants as c
-import psycopg2
-import email
 
-# The MySQLdb module must be available
+# psycopg2 is only needed to connect to Postgres (the SQLite backend works without it)
 try:
     import psycopg2
 except ImportError:
-    print ("This program requires the psycopg2 module to be installed. "
-            "\nOn Ubuntu-based distros the package is \"python-psycopg2\". Exiting.")
-    sys.exit(1) 
+    psycopg2 = None
 
+from statements import StatementRegistry
+from dbPool import ConnectionPool, PoolTimeout
+from journal import SwipeJournal, JournalReplayer
+from userCache import UserCache
+from notifyListener import NotifyListener
+from roster import Roster
+from partitions import PartitionMaintainer, monthStart, addMonths, partitionName, partitionMonth
+from metrics import STAGE_SECONDS, DB_ERRORS, POOL_IN_USE, log
+from slowQueries import SlowQueryLog
+from storage import Storage
 
-class DB:
+
+class DB(Storage):
     def __init__(self, dbHost, dbDatabase, dbUsersTable, dbVisitsTable, dbUser, dbPass):
-        self.dbConn = None
+        super(DB, self).__init__(dbUsersTable, dbVisitsTable)
+        self.pool = None
+        self.replayer = None
+        self.userCache = UserCache(c.USER_CACHE_SIZE) if c.USER_CACHE_SIZE else None
+        self.listener = None
+        self.roster = None
+        self.rosterFresh = False
+        # Held while the roster is swapped for a rebuilt one so no delta is lost
+        self.rosterLock = threading.Lock()
+        self.partitionMaintainer = None
+        # Cursor class that logs slow statements (see SlowQueryLog), or None
+        self.cursorFactory = None
+        # Create new visits tables partitioned by month
+        self.partitionVisits = bool(c.VISITS_PARTITIONED)
+        # Backend PIDs of our open pool connections, to ignore our own notifications
+        # Postgres reuses PIDs, so they are removed again when a connection is closed
+        self.backendPids = set()
+        # id(connection) -> its backend PID, which can't be read once it is closed
+        self.connectionPids = {}
+        # Server time minus local time, measured at connect
+        self.clockSkew = timedelta(0)
         self.dbHost = dbHost
         self.dbDatabase = dbDatabase
-        self.dbUsersTable = dbUsersTable
-        self.dbVisitsTable = dbVisitsTable
         self.dbUser = dbUser
         self.dbPass = dbPass
         self.tools = Utils()
+        self.statements = StatementRegistry()
+        self.registerStatements()
+
+
+    def registerStatements(self):
+    #===========================================================================
+    # Register every query used by this class. They are prepared on the server
+    # the first time they are used on a connection
+    #===========================================================================
+        names = self.schemaNames()
+
+        self.statements.register("addCard",
+            """INSERT INTO %(users)s (%(cuidCol)s, %(firstCol)s, %(lastNameCol)s, %(emailCol)s, %(visitCol)s)
+               VALUES (%%(cuid)s, %%(firstName)s, %%(lastName)s, %%(email)s, %%(visits)s);""" % names)
+
+        self.statements.register("checkIn", self.checkInQuery() % names)
+
+        # For databases without the rollup tables until --init-schema is run
+        self.statements.register("checkInNoRollups", self.checkInQuery(rollups=False) % names)
+
+        # Windowed leaderboard and daily totals, read from the rollups instead of the visits table
+        self.statements.register("topVisitors",
+            """SELECT u.%(emailCol)s, r.visits, r.days
+               FROM (SELECT %(vCuidCol)s AS cuid, sum(visits) AS visits, count(*) AS days FROM %(byUserDay)s
+                     WHERE day >= %%(start)s AND day < %%(end)s
+                     GROUP BY %(vCuidCol)s ORDER BY 2 DESC, 1 LIMIT %%(limit)s) r
+               JOIN %(users)s u ON u.%(cuidCol)s = r.cuid
+               ORDER BY r.visits DESC, u.%(emailCol)s;""" % names)
+
+        self.statements.register("visitTrend",
+            """SELECT day, visits, visitors FROM %(byDay)s WHERE day >= %%(start)s AND day < %%(end)s ORDER BY day;""" % names)
+
+        self.statements.register("showAllVisits",
+            """SELECT %(emailCol)s, %(visitCol)s FROM %(users)s ORDER BY %(visitCol)s DESC;""" % names)
+
+        self.statements.register("showUserVisits",
+            """SELECT %(emailCol)s, %(visitCol)s FROM %(users)s WHERE %(emailCol)s = %%(userID)s;""" % names)
+
+        # Rank by counting the users above this one on the visit_num index (an
+        # index-only range scan). Nothing extra is written on check-in, so kiosks
+        # never queue up on shared counter rows
+        self.statements.register("showRank",
+            """SELECT u.%(emailCol)s, u.%(visitCol)s,
+                      (SELECT count(*) FROM %(users)s a WHERE a.%(visitCol)s > u.%(visitCol)s) + 1,
+                      (SELECT count(*) FROM %(users)s)
+               FROM %(users)s u WHERE u.%(emailCol)s = %%(userID)s LIMIT 1;""" % names)
 
     def connect(self):
     #===========================================================================
-    # Connect to db with given info - need to fix error system
+    # Connect to db with given info and open the connection pool
     #===========================================================================    
+        if psycopg2 is None:
+            print("\nConnecting to Postgres requires the psycopg2 module to be installed. "
+                  "\nOn Ubuntu-based distros the package is \"python-psycopg2\". "
+                  "\nUse --sqlite to keep the database in a local file instead.")
+            return c.FAILURE
+
         # If a password was not given, ask for it
         if self.dbPass == "":
             self.dbPass = getDbPass()
 
+        if c.SLOW_QUERY_THRESHOLD:
+            self.cursorFactory = SlowQueryLog().cursorFactory()
+
+        self.pool = ConnectionPool(self.newConnection, c.POOL_MIN_CONN, c.POOL_MAX_CONN, c.POOL_CHECKOUT_TIMEOUT,
+                                   c.POOL_VALIDATE_AFTER, c.POOL_RESERVED_FOR_CHECKIN, self.connectionClosed)
+
         try:# Connect to the database server
-            self.dbConn = psycopg2.connect(database = self.dbDatabase, user = self.dbUser, password = self.dbPass, host = self.dbHost)
-            return c.SUCCESS         
+            self.pool.open()
         except psycopg2.Error as e:
-            #if "user denied" in e.args[1]:  # Bad password error
             print("\n",e)
-            #if "password authentication" in e:
-            #   return c.BAD_PASSWD
-            #else:  # Other error
-                #return c.FAILURE
+            self.pool.closeAll()
+            self.pool = None
 
+            if "password authentication" in str(e):
+               return c.BAD_PASSWD
+            else:  # Other error
+                return c.FAILURE
 
-    def close(self):
+        POOL_IN_USE.setFunction(self.pool.inUse)
+
+        # Warn about missing tables or indexes the hot paths depend on
+        try:
+            self.schemaProblems = self.checkSchema()
+            self.rollups = self.hasRollups()
+        except (psycopg2.Error, PoolTimeout) as e:
+            print("Could not check the schema:", e)
+
+        # Journal swipes while the server is unreachable and replay them when it is back
+        if c.JOURNAL_PATH:
+            self.journal = SwipeJournal(c.JOURNAL_PATH, c.KIOSK_ID, c.JOURNAL_FSYNC_GROUP, c.JOURNAL_FSYNC_DELAY,
+                                        self.serverNow)
+            self.replayer = JournalReplayer(self, self.journal, c.JOURNAL_REPLAY_INTERVAL, c.JOURNAL_REPLAY_BATCH)
+            self.replayer.start()
+
+        if c.GROUP_COMMIT:
+            self.enableGroupCommit(c.GROUP_COMMIT_WINDOW, c.GROUP_COMMIT_MAX)
+
+        # Keep next months' visits partitions created and apply the retention policy
+        try:
+            if self.visitsPartitioned():
+                self.partitionMaintainer = PartitionMaintainer(self, c.VISITS_PARTITION_INTERVAL)
+                self.partitionMaintainer.start()
+        except (psycopg2.Error, PoolTimeout) as e:
+            print("Could not check the visits partitions:", e)
+
+        # The roster is kept up to date by the notify trigger, so it can't be used without it
+        useRoster = bool(c.ROSTER_PATH)
+        if useRoster:
+            try:
+                if not self.hasNotifyTrigger():
+                    print("Roster disabled: the %s_notify trigger is missing (run --init-schema)" % self.dbUsersTable)
+                    useRoster = False
+            except (psycopg2.Error, PoolTimeout) as e:
+                print("Roster disabled: could not check the notify trigger:", e)
+                useRoster = False
+
+        # Keep cached users and the roster in sync with changes made by other kiosks
+        if self.userCache is not None or useRoster:
+            # The listener's own connection sends no notifications, so its PID isn't tracked
+            self.listener = NotifyListener(lambda: self.newConnection(trackPid=False), c.NOTIFY_CHANNEL, self.backendPids)
+
+            if self.userCache is not None:
+                self.measureClockSkew()
+                self.listener.addHandler(self.userCache.invalidate)
+
+            # Load the last roster snapshot to collect deltas in. It may miss cards
+            # other kiosks added while this one was down, so roster misses are
+            # only trusted once it has been rebuilt from the users table
+            if useRoster:
+                self.roster = Roster.load(c.ROSTER_PATH) or Roster()
+                self.listener.addHandler(self.rosterChanged)
+
+            self.listener.start()
+
+            if useRoster:
+                threading.Thread(target=self.refreshRoster, daemon=True).start()
+
+        return c.SUCCESS
+
+
+    def findMissingSchema(self):
     #===========================================================================
-    # Close out db connection
+    # Look up which tables and schemaIndexes() entries don't exist
+    # Returns (missing table names, missing schemaIndexes() entries)
     #===========================================================================
-        if self.dbConn is not None:
-            self.dbConn.close()
+        missingTables = []
+        indexes = {}
 
-    def addCard(self, cuid, firstName, lastName, email):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                for table in self.schemaTableNames():
+                    cursor.execute("""SELECT to_regclass(%s);""", (table,))
+                    if cursor.fetchone()[0] is None:
+                        missingTables.append(table)
+                        continue
+
+                    # Column names of every usable index on the table, in index order
+                    cursor.execute("""SELECT array(SELECT a.attname::text
+                                                   FROM unnest(i.indkey::int2[]) WITH ORDINALITY k(attnum, ord)
+                                                   JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+                                                   ORDER BY k.ord)
+                                      FROM pg_index i WHERE i.indrelid = to_regclass(%s) AND i.indisvalid;""", (table,))
+                    indexes[table] = [tuple(row[0]) for row in cursor]
+            finally:
+                cursor.close()
+
+        return missingTables, self.findMissingIndexes(indexes)
+
+
+    def checkSchema(self):
     #===========================================================================
-    # add a CUID and userID to the database
+    # Verify the tables, the indexes from schemaIndexes() and this month's
+    # visits partition exist
+    # Returns a list of problems, empty if the schema is complete
     #===========================================================================
-        # Init some stuff that could cause problems if not initialized
+        problems = super(DB, self).checkSchema()
+
+        # Check-ins still work without this month's partition, but pile up in the default one
+        # (a missing visits table isn't partitioned)
+        if self.visitsPartitioned():
+            thisMonth = monthStart(self.serverNow())
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    partitioned, months, hasDefault = self.visitsPartitions(cursor)
+                finally:
+                    cursor.close()
+
+            if thisMonth not in months:
+                problems.append("no %s partition for %s" % (self.dbVisitsTable, thisMonth.strftime("%Y-%m")))
+
+        return problems
+
+
+    def initSchema(self):
+    #===========================================================================
+    # Create the users and visits tables and their indexes if they don't exist,
+    # then install the notify trigger. Safe to run again on an
+    # existing database; only missing pieces are added
+    #===========================================================================
+        names = self.schemaNames()
+        status = c.SUCCESS
         sqlError = None
-        # Get a cursor to the DB
-        cursor = self.dbConn.cursor()
+        problems = []
+
+        try:
+            newRollups = not self.hasRollups()
+
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    for createTable in self.schemaTables():
+                        cursor.execute(createTable)
+                finally:
+                    cursor.close()
+
+            # Tables created above already have their keys; only add what is still missing
+            missingTables, missingIndexes = self.findMissingSchema()
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    for table, columns, createIndex in missingIndexes:
+                        cursor.execute(createIndex)
+                    cursor.execute("""ANALYZE %(users)s;""" % names)
+                    cursor.execute("""ANALYZE %(visits)s;""" % names)
+                finally:
+                    cursor.close()
+
+            self.installNotifyTrigger()
+            self.dropRankSummary()
+
+            # Fill new rollup tables from the visits already recorded
+            if newRollups:
+                backfillResult = self.backfillRollups()
+                if backfillResult["backfillStatus"] != c.SUCCESS:
+                    status = backfillResult["backfillStatus"]
+                    sqlError = backfillResult["sqlError"]
+
+            if self.visitsPartitioned():
+                partitionResult = self.maintainPartitions()
+                if partitionResult["partitionStatus"] != c.SUCCESS:
+                    status = partitionResult["partitionStatus"]
+                    sqlError = partitionResult["sqlError"]
+
+            problems = self.checkSchema()
+        except PoolTimeout:
+            status = c.DB_BUSY
+        except psycopg2.Error as e:
+            status = c.SQL_ERROR
+            sqlError = e
+
+        self.schemaProblems = problems
+        return {"initSchemaStatus": status, "problems": problems, "sqlError": sqlError}
+
+
+    def refreshRoster(self):
+    #===========================================================================
+    # Rebuild the roster snapshot from the users table and save it
+    # The users table is only read once the listener is up, so a card added in
+    # between is caught as a delta. Until the rebuild finishes, roster misses
+    # are double checked with the database
+    #===========================================================================
+        while not self.listener.listening.wait(1):
+            if self.listener.stopEvent.is_set():
+                return
+
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT %s FROM %s;" % (c.CUID_COLUMN_USER, self.dbUsersTable))
+                roster, unstorable = Roster.build(row[0] for row in cursor)
+                cursor.close()
+        except (psycopg2.Error, PoolTimeout) as e:
+            print("Could not refresh the roster:", e)
+            return
+
+        # A roster that can't hold every CUID can't be trusted to say a card is unknown
+        if unstorable:
+            print("Roster disabled: %d CUIDs are not 32-bit numbers" % len(unstorable))
+            with self.rosterLock:
+                self.rosterFresh = False
+                self.roster = None
+            return
+
+        # Keep CUIDs added while the rebuild was running
+        with self.rosterLock:
+            if self.roster is None:
+                return
+            roster.added |= self.roster.added
+            self.roster = roster
+            self.rosterFresh = True
+
+        try:
+            roster.save(c.ROSTER_PATH)
+        except OSError as e:
+            print("Could not save the roster:", e)
+
+
+    def rosterChanged(self, CUID):
+    #===========================================================================
+    # Notification handler. A changed CUID is added to the roster deltas; after
+    # a reconnect (CUID None) notifications were missed, so rebuild
+    #===========================================================================
+        if CUID is None:
+            self.rosterFresh = False
+            threading.Thread(target=self.refreshRoster, daemon=True).start()
+        else:
+            self.addToRoster(CUID)
+
+
+    def addToRoster(self, CUID):
+    #===========================================================================
+    # Add a CUID to the roster deltas, if the roster is in use
+    #===========================================================================
+        with self.rosterLock:
+            if self.roster is not None:
+                self.roster.add(CUID)
 
-        cuid = self.tools.sanitizeInput(cuid)
-        firstName = self.tools.sanitizeInput(firstName)
-        lastName = self.tools.sanitizeInput(lastName)
-        email = self.tools.sanitizeInput(email)
 
+    def measureClockSkew(self):
+    #===========================================================================
+    # Measure how far the server clock is from ours so cached hour rule
+    # decisions use (approximately) the server's time
+    #===========================================================================
         try:
-            cursor.execute("""BEGIN TRANSACTION;""")
-            # Add the new record into the DB
-            cursor.execute("""INSERT INTO %s (%s, %s, %s, %s, %s) values (\'%s\', \'%s\', \'%s\', \'%s\', \'%s\');""" % (self.dbUsersTable, c.CUID_COLUMN_USER, c.FIRST_NAME_COLUMN_USER, c.LAST_NAME_COLUMN_USER, c.EMAIL_COLUMN_USER, c.VISIT_NUM_COLUMN_USER, cuid, firstName, lastName, email, c.DEFAULT_VISITS))
-            cursor.execute("""END TRANSACTION;""")
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                before = datetime.now()
+                cursor.execute("SELECT statement_timestamp()::timestamp;")
+                serverNow = cursor.fetchone()[0]
+                after = datetime.now()
+                cursor.close()
+            self.clockSkew = serverNow - (before + (after - before) / 2)
+        except (psycopg2.Error, PoolTimeout):
+            self.clockSkew = timedelta(0)
+
+
+    def serverNow(self):
+    #===========================================================================
+    # Best guess of the server's current time
+    #===========================================================================
+        return datetime.now() + self.clockSkew
+
+
+    def dropRankSummary(self):
+    #===========================================================================
+    # Remove the <users>_visit_counts table and triggers older versions used
+    # for showRank. Every check-in updated two shared rows of it, which
+    # serialized the kiosks and could deadlock concurrent batches
+    #===========================================================================
+        names = {"users": self.dbUsersTable}
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""DROP TRIGGER IF EXISTS %(users)s_visit_counts_rows ON %(users)s;""" % names)
+                cursor.execute("""DROP TRIGGER IF EXISTS %(users)s_visit_counts_update ON %(users)s;""" % names)
+                cursor.execute("""DROP FUNCTION IF EXISTS %(users)s_visit_counts_sync();""" % names)
+                cursor.execute("""DROP TABLE IF EXISTS %(users)s_visit_counts;""" % names)
+            finally:
+                cursor.close()
+
+
+    def showRank(self, userID):
+    #===========================================================================
+    # Visit count, rank (1 is the most visits; ties share a rank) and
+    # percentile (share of users with as many visits or fewer) of one user
+    #===========================================================================
+        rankResult = {"showRankStatus": c.FAILURE, "userID": userID, "visits": None, "rank": None,
+                      "total": None, "percentile": None, "sqlError": None}
+
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    self.statements.execute(cursor, "showRank", {"userID": userID})
+                    row = cursor.fetchone()
+                finally:
+                    cursor.close()
+        except PoolTimeout:
+            rankResult["showRankStatus"] = c.DB_BUSY
+            return rankResult
+        except psycopg2.Error as e:
+            rankResult["showRankStatus"] = c.SQL_ERROR
+            rankResult["sqlError"] = e
+            return rankResult
+
+        if row is None:
+            rankResult["showRankStatus"] = c.NO_RESULTS
+            return rankResult
+
+        userID, visits, rank, total = row
+        rankResult.update({"showRankStatus": c.SUCCESS, "userID": userID, "visits": visits, "rank": int(rank),
+                           "total": total, "percentile": 100.0 * (total - rank + 1) / total})
+        return rankResult
+
+
+    def warmUp(self):
+    #===========================================================================
+    # Get the pool ready for the first swipes: open the minimum connections
+    # and prepare the check-in statement on each, so the first check-in on a
+    # connection doesn't pay for the extra PREPARE round trip
+    # Run it in the background after connect. Returns SUCCESS or FAILURE
+    #===========================================================================
+        conns = []
+        try:
+            # Hold them all at once so each one gets prepared
+            for i in range(c.POOL_MIN_CONN):
+                conns.append(self.pool.getConn())
+
+            for conn in conns:
+                cursor = conn.cursor()
+                try:
+                    self.statements.prepare(cursor, "checkIn" if self.rollups else "checkInNoRollups")
+                finally:
+                    cursor.close()
+        except (psycopg2.Error, PoolTimeout):
+            return c.FAILURE
         finally:
-            cursor.close()
+            for conn in conns:
+                self.pool.putConn(conn)
+
+        return c.SUCCESS
+
+
+    def hasRollups(self):
+    #===========================================================================
+    # Whether both rollup tables exist
+    #===========================================================================
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""SELECT to_regclass(%s) IS NOT NULL AND to_regclass(%s) IS NOT NULL;""",
+                               self.rollupTableNames())
+                return cursor.fetchone()[0]
+            finally:
+                cursor.close()
+
+
+    def backfillRollups(self):
+    #===========================================================================
+    # Rebuild the rollup tables from the visits table in one transaction and
+    # start updating them on check-in. Check-ins wait until it is done
+    # Returns {"backfillStatus", "days", "sqlError"}
+    #===========================================================================
+        names = self.schemaNames()
+        backfillResult = {"backfillStatus": c.SUCCESS, "days": 0, "sqlError": None}
+
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute("""BEGIN TRANSACTION;""")
+                    # Keep new visits out so none are counted twice or missed
+                    cursor.execute("""LOCK TABLE %(visits)s IN SHARE MODE;""" % names)
+                    cursor.execute("""TRUNCATE %(byUserDay)s, %(byDay)s;""" % names)
+                    cursor.execute("""INSERT INTO %(byUserDay)s (day, %(vCuidCol)s, visits)
+                                      SELECT %(vTimeCol)s::date, %(vCuidCol)s, count(*) FROM %(visits)s GROUP BY 1, 2;""" % names)
+                    cursor.execute("""INSERT INTO %(byDay)s (day, visits, visitors)
+                                      SELECT day, sum(visits), count(*) FROM %(byUserDay)s GROUP BY day;""" % names)
+                    backfillResult["days"] = cursor.rowcount
+                    cursor.execute("""END TRANSACTION;""")
+                    cursor.execute("""ANALYZE %(byUserDay)s;""" % names)
+                    cursor.execute("""ANALYZE %(byDay)s;""" % names)
+                finally:
+                    cursor.close()
+        except PoolTimeout:
+            backfillResult["backfillStatus"] = c.DB_BUSY
+            return backfillResult
+        except psycopg2.Error as e:
+            backfillResult.update({"backfillStatus": c.SQL_ERROR, "sqlError": e})
+            return backfillResult
+
+        self.rollups = True
+        return backfillResult
+
+
+    def topVisitors(self, start, end, limit=None):
+    #===========================================================================
+    # The users with the most visits on the days start <= day < end, from the
+    # per-user-per-day rollup. Rows are (userID, visits, days visited)
+    #===========================================================================
+        topResult = {"topStatus": c.SUCCESS, "rows": None, "sqlError": None}
+
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    self.statements.execute(cursor, "topVisitors", {"start": start, "end": end,
+                                                                    "limit": limit or c.LEADERBOARD_SIZE})
+                    topResult["rows"] = cursor.fetchall()
+                finally:
+                    cursor.close()
+        except PoolTimeout:
+            topResult["topStatus"] = c.DB_BUSY
+        except psycopg2.Error as e:
+            topResult.update({"topStatus": c.SQL_ERROR, "sqlError": e})
+
+        if topResult["rows"] == []:
+            topResult["topStatus"] = c.NO_RESULTS
+        return topResult
+
+
+    def visitTrend(self, start, end):
+    #===========================================================================
+    # Visits and distinct visitors for each day start <= day < end, from the
+    # per-day rollup. Rows are (date, visits, visitors), days without visits
+    # included
+    #===========================================================================
+        trendResult = {"trendStatus": c.SUCCESS, "rows": None, "sqlError": None}
+
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    self.statements.execute(cursor, "visitTrend", {"start": start, "end": end})
+                    trendResult["rows"] = self.fillDays(cursor.fetchall(), start, end)
+                finally:
+                    cursor.close()
+        except PoolTimeout:
+            trendResult["trendStatus"] = c.DB_BUSY
+        except psycopg2.Error as e:
+            trendResult.update({"trendStatus": c.SQL_ERROR, "sqlError": e})
+
+        return trendResult
+
+
+    def installNotifyTrigger(self):
+    #===========================================================================
+    # Create the trigger that notifies kiosks when a users row changes
+    # Needs to be done once per database by a user allowed to create triggers
+    #===========================================================================
+        names = {"users": self.dbUsersTable, "cuidCol": c.CUID_COLUMN_USER, "channel": c.NOTIFY_CHANNEL}
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""CREATE OR REPLACE FUNCTION %(users)s_notify() RETURNS trigger AS $$
+                                  BEGIN
+                                      IF TG_OP = 'DELETE' THEN
+                                          PERFORM pg_notify('%(channel)s', OLD.%(cuidCol)s::text);
+                                      ELSE
+                                          PERFORM pg_notify('%(channel)s', NEW.%(cuidCol)s::text);
+                                      END IF;
+                                      RETURN NULL;
+                                  END $$ LANGUAGE plpgsql;""" % names)
+                cursor.execute("""DROP TRIGGER IF EXISTS %(users)s_notify ON %(users)s;""" % names)
+                cursor.execute("""CREATE TRIGGER %(users)s_notify AFTER INSERT OR UPDATE OR DELETE ON %(users)s
+                                  FOR EACH ROW EXECUTE PROCEDURE %(users)s_notify();""" % names)
+            finally:
+                cursor.close()
+
+
+    def hasNotifyTrigger(self):
+    #===========================================================================
+    # Whether the trigger from installNotifyTrigger exists on the users table
+    #===========================================================================
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""SELECT EXISTS (SELECT 1 FROM pg_trigger
+                                                 WHERE tgrelid = to_regclass(%s) AND tgname = %s);""",
+                               (self.dbUsersTable, self.dbUsersTable + "_notify"))
+                return cursor.fetchone()[0]
+            finally:
+                cursor.close()
+
+
+    def visitsPartitioned(self):
+    #===========================================================================
+    # Whether the visits table is partitioned
+    #===========================================================================
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                return self.visitsPartitions(cursor)[0]
+            finally:
+                cursor.close()
+
+
+    def visitsPartitions(self, cursor):
+    #===========================================================================
+    # Look up the visits partitions
+    # Returns (whether visits is partitioned, {month: monthly partition name},
+    # whether it has a default partition)
+    #===========================================================================
+        cursor.execute("""SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s));""",
+                       (self.dbVisitsTable,))
+        partitioned = cursor.fetchone()[0]
+
+        cursor.execute("""SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) = 'DEFAULT'
+                          FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                          WHERE i.inhparent = to_regclass(%s);""", (self.dbVisitsTable,))
+        months = {}
+        hasDefault = False
+        for name, isDefault in cursor.fetchall():
+            month = partitionMonth(self.dbVisitsTable, name)
+            if month is not None:
+                months[month] = name
+            hasDefault = hasDefault or isDefault
+
+        return partitioned, months, hasDefault
+
+
+    def maintainPartitions(self, now=None):
+    #===========================================================================
+    # Create the visits partitions for this month and the next
+    # VISITS_PARTITIONS_AHEAD months (plus a default partition for anything
+    # outside them), and retire partitions older than VISITS_RETENTION_MONTHS
+    # by detaching or dropping them. Visit counts in the users table are kept
+    # DDL waits at most PARTITION_LOCK_TIMEOUT for check-ins holding the table
+    # and an advisory lock keeps kiosks from maintaining at the same time
+    #===========================================================================
+        thisMonth = monthStart(now or self.serverNow())
+        wanted = [addMonths(thisMonth, i) for i in range(c.VISITS_PARTITIONS_AHEAD + 1)]
+        retireBefore = addMonths(thisMonth, -c.VISITS_RETENTION_MONTHS) if c.VISITS_RETENTION_MONTHS else None
+
+        partitionResult = {"partitionStatus": c.SUCCESS, "created": [], "retired": [], "moved": 0, "sqlError": None}
+
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute("""BEGIN TRANSACTION;""")
+                    cursor.execute("""SET LOCAL lock_timeout = %d;""" % (c.PARTITION_LOCK_TIMEOUT * 1000))
+                    cursor.execute("""SELECT pg_advisory_xact_lock(hashtext(%s));""", (self.dbVisitsTable + "_partitions",))
+
+                    partitioned, months, hasDefault = self.visitsPartitions(cursor)
+
+                    if not partitioned:
+                        partitionResult["partitionStatus"] = c.FAILURE
+                    else:
+                        self.createPartitions(cursor, [month for month in wanted if month not in months], hasDefault,
+                                              partitionResult)
+
+                        for month, name in sorted(months.items()):
+                            if retireBefore is not None and month < retireBefore:
+                                cursor.execute("""ALTER TABLE %s DETACH PARTITION %s;""" % (self.dbVisitsTable, name))
+                                if c.VISITS_RETENTION_ACTION == "drop":
+                                    cursor.execute("""DROP TABLE %s;""" % name)
+                                partitionResult["retired"].append(name)
+
+                    cursor.execute("""END TRANSACTION;""")
+                finally:
+                    cursor.close()
+        except PoolTimeout:
+            partitionResult.update({"partitionStatus": c.DB_BUSY, "created": [], "retired": []})
+        except psycopg2.Error as e:
+            partitionResult.update({"partitionStatus": c.SQL_ERROR, "created": [], "retired": [], "sqlError": e})
+
+        return partitionResult
+
+
+    def createPartitions(self, cursor, months, hasDefault, partitionResult):
+    #===========================================================================
+    # Create a default partition if there isn't one and a partition for each of
+    # the months. Rows for a new month that went to the default partition are
+    # moved into it
+    #===========================================================================
+        names = dict(self.schemaNames(), default=self.dbVisitsTable + "_default")
+
+        if not hasDefault:
+            cursor.execute("""CREATE TABLE %(default)s PARTITION OF %(visits)s DEFAULT;""" % names)
+            partitionResult["created"].append(names["default"])
+
+        for month in months:
+            names.update({"partition": partitionName(self.dbVisitsTable, month),
+                          "start": month.isoformat(" "), "end": addMonths(month, 1).isoformat(" ")})
+
+            cursor.execute("""SELECT EXISTS (SELECT 1 FROM %(default)s
+                                             WHERE %(vTimeCol)s >= '%(start)s' AND %(vTimeCol)s < '%(end)s');""" % names)
+            strays = cursor.fetchone()[0]
+
+            # A new partition can't overlap rows in the default partition, so set it aside while they move
+            if strays:
+                cursor.execute("""ALTER TABLE %(visits)s DETACH PARTITION %(default)s;""" % names)
+
+            cursor.execute("""CREATE TABLE %(partition)s PARTITION OF %(visits)s
+                              FOR VALUES FROM ('%(start)s') TO ('%(end)s');""" % names)
+            partitionResult["created"].append(names["partition"])
+
+            if strays:
+                cursor.execute("""WITH moved AS (
+                                      DELETE FROM %(default)s WHERE %(vTimeCol)s >= '%(start)s' AND %(vTimeCol)s < '%(end)s'
+                                      RETURNING %(vCuidCol)s, %(vTimeCol)s, %(vVisitCol)s
+                                  )
+                                  INSERT INTO %(visits)s (%(vCuidCol)s, %(vTimeCol)s, %(vVisitCol)s)
+                                  SELECT * FROM moved;""" % names)
+                partitionResult["moved"] += cursor.rowcount
+                cursor.execute("""ALTER TABLE %(visits)s ATTACH PARTITION %(default)s DEFAULT;""" % names)
+
+
+    def convertVisitsToPartitions(self):
+    #===========================================================================
+    # Convert an existing unpartitioned visits table into monthly partitions
+    # covering all of its rows, in one transaction. Check-ins wait while the
+    # rows are copied, so run this at a quiet time
+    #===========================================================================
+        names = dict(self.schemaNames(), old=self.dbVisitsTable + "_unpartitioned")
+        partitionResult = {"partitionStatus": c.SUCCESS, "created": [], "retired": [], "moved": 0, "sqlError": None}
+
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute("""BEGIN TRANSACTION;""")
+                    partitioned, months, hasDefault = self.visitsPartitions(cursor)
+
+                    if not partitioned:
+                        cursor.execute("""LOCK TABLE %(visits)s IN ACCESS EXCLUSIVE MODE;""" % names)
+                        cursor.execute("""ALTER TABLE %(visits)s RENAME TO %(old)s;""" % names)
+
+                        # Free the index names for the new table
+                        cursor.execute("""SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                                          WHERE i.indrelid = to_regclass(%s);""", (names["old"],))
+                        for i, (indexName,) in enumerate(cursor.fetchall()):
+                            cursor.execute("""ALTER INDEX %s RENAME TO %s_idx%d;""" % (indexName, names["old"], i))
+
+                        cursor.execute(self.schemaTables(partitioned=True)[1])
+                        # The primary key already covers (cuid, timein)
+                        for table, columns, createIndex in self.findMissingIndexes(
+                                {self.dbVisitsTable: [(c.CUID_COLUMN_VISIT, c.TIMEIN_COLUMN_VISIT)]}):
+                            cursor.execute(createIndex)
+
+                        cursor.execute("""SELECT min(%(vTimeCol)s), max(%(vTimeCol)s) FROM %(old)s;""" % names)
+                        first, last = cursor.fetchone()
+                        thisMonth = monthStart(self.serverNow())
+                        month = monthStart(first) if first is not None else thisMonth
+                        lastMonth = addMonths(max(monthStart(last), thisMonth) if last is not None else thisMonth,
+                                              c.VISITS_PARTITIONS_AHEAD)
+
+                        wanted = []
+                        while month <= lastMonth:
+                            wanted.append(month)
+                            month = addMonths(month, 1)
+                        self.createPartitions(cursor, wanted, False, partitionResult)
+
+                        cursor.execute("""INSERT INTO %(visits)s (%(vCuidCol)s, %(vTimeCol)s, %(vVisitCol)s)
+                                          SELECT %(vCuidCol)s, %(vTimeCol)s, %(vVisitCol)s FROM %(old)s;""" % names)
+                        partitionResult["moved"] = cursor.rowcount
+                        cursor.execute("""DROP TABLE %(old)s;""" % names)
+
+                    cursor.execute("""END TRANSACTION;""")
+                    cursor.execute("""ANALYZE %(visits)s;""" % names)
+                finally:
+                    cursor.close()
+        except PoolTimeout:
+            return {"partitionStatus": c.DB_BUSY, "created": [], "retired": [], "moved": 0, "sqlError": None}
+        except psycopg2.Error as e:
+            return {"partitionStatus": c.SQL_ERROR, "created": [], "retired": [], "moved": 0, "sqlError": e}
+
+        # Apply the retention policy to the months just created
+        retention = self.maintainPartitions()
+        partitionResult["retired"] = retention["retired"]
+        return partitionResult
+
+
+    def newConnection(self, trackPid=True):
+    #===========================================================================
+    # Open a new connection for the pool
+    #===========================================================================
+        conn = psycopg2.connect(database = self.dbDatabase, user = self.dbUser, password = self.dbPass, host = self.dbHost,
+                                cursor_factory = self.cursorFactory)
+        # Single statement queries are their own transaction. This avoids an extra BEGIN round trip per query
+        conn.autocommit = True
+        if trackPid:
+            pid = conn.get_backend_pid()
+            self.connectionPids[id(conn)] = pid
+            self.backendPids.add(pid)
+        return conn
+
+
+    def connectionClosed(self, conn):
+    #===========================================================================
+    # Called by the pool before it closes a connection: forget its prepared
+    # statements and stop ignoring notifications from its PID, which another
+    # session may be given
+    #===========================================================================
+        self.statements.forget(conn)
+        pid = self.connectionPids.pop(id(conn), None)
+        if pid is not None:
+            self.backendPids.discard(pid)
+
+
+    def close(self):
+    #===========================================================================
+    # Close out db connections
+    #===========================================================================
+        super(DB, self).close()
+        if self.partitionMaintainer is not None:
+            self.partitionMaintainer.stop()
+        if self.listener is not None:
+            self.listener.stop()
+        if self.replayer is not None:
+            self.replayer.stop()
+        if self.journal is not None:
+            self.journal.close()
+        if self.pool is not None:
+            self.pool.closeAll()
+
+
+    def addCard(self, cuid, firstName, lastName, email):
+    #===========================================================================
+    # add a CUID and userID to the database
+    #===========================================================================
+        try:
+            with self.pool.connection(priority=True) as conn:
+                cursor = conn.cursor()
+                try:
+                    # Add the new record into the DB
+                    self.statements.execute(cursor, "addCard", {"cuid": cuid, "firstName": firstName, "lastName": lastName,
+                                                                "email": email, "visits": c.DEFAULT_VISITS})
+                finally:
+                    cursor.close()
+        except PoolTimeout:
+            return {"addCardStatus": c.DB_BUSY, "Name": firstName, "userID": email, "CUID": cuid, "sqlError": None}
+        except psycopg2.Error as e:
+            return {"addCardStatus": c.SQL_ERROR, "Name": firstName, "userID": email, "CUID": cuid, "sqlError": e}
+
+        self.addToRoster(cuid)
 
         checkInResult = self.checkIn(cuid)
             
-        return {"addCardStatus": checkInResult["checkInStatus"], "Name": firstName, "CUID": cuid, "sqlError": sqlError}
+        return {"addCardStatus": checkInResult["checkInStatus"], "Name": firstName, "userID": checkInResult["userID"],
+                "CUID": cuid, "sqlError": checkInResult["sqlError"]}
 
-    def checkIn(self, CUID):
+    def rosterRejects(self, CUID):
     #===========================================================================
-    # Check in to db with CUID already in db
+    # Unknown cards are caught by the roster without a trip to the database
+    # It can't be trusted until it has been rebuilt, and may have missed
+    # changes while the listener is reconnecting
     #===========================================================================
+        roster = self.roster
+        return (self.rosterFresh and roster is not None and self.listener.listening.is_set()
+                and roster.contains(CUID) is False)
+
+
+    def checkInBatch(self, CUIDs, times=None):
+    #===========================================================================
+    # Check in a list of CUIDs in one transaction and return a result dict for
+    # each. If the transaction fails each CUID is retried on its own so one bad
+    # swipe can't fail the rest of the group
+    # times optionally gives each check-in's time instead of the server clock
+    # With a journal the times are taken here, from serverNow(), so swipes can
+    # be journaled with the same time when the connection drops
+    #===========================================================================
+        if times is None:
+            times = [None] * len(CUIDs)
+
+        # A check-in whose reply is lost may or may not have been committed. If
+        # it was, its visit has this exact time and journal replay skips it
+        if self.journal is not None:
+            times = [timeIn or self.serverNow() for timeIn in times]
+
         # Init some stuff that could cause problems if not initialized
+        rows = []
+
+        if self.pool is None:
+            print("Not connected to the database")
+            return [self.checkInResult(CUID, c.FAILURE) for CUID in CUIDs]
+
+        # The connection used, to tell a lost connection from other errors
+        conn = None
+
+        started = time.perf_counter()
+        try:
+            # Check-ins may use the connections reserved for them
+            with self.pool.connection(priority=True) as conn:
+                cursor = conn.cursor()
+                try:
+                    # A single check-in is its own transaction
+                    if len(CUIDs) > 1:
+                        cursor.execute("""BEGIN TRANSACTION;""")
+
+                    for CUID, timeIn in zip(CUIDs, times):
+                        self.statements.execute(cursor, "checkIn" if self.rollups else "checkInNoRollups",
+                                                {"cuid": CUID, "now": timeIn,
+                                                 "allowWithinHour": bool(c.ALLOW_CHECKIN_WITHIN_HOUR)})
+                        rows.append(cursor.fetchone())
+
+                    if len(CUIDs) > 1:
+                        cursor.execute("""END TRANSACTION;""")
+                finally:
+                    cursor.close()
+        except PoolTimeout:
+            DB_ERRORS.inc("pool_timeout")
+            log.warning("no connection free for %d check-ins", len(CUIDs))
+            return [self.checkInResult(CUID, c.DB_BUSY) for CUID in CUIDs]
+        except psycopg2.extensions.QueryCanceledError as e:
+            # statement_timeout or a cancel from the server; retrying would just wait again
+            DB_ERRORS.inc("canceled")
+            log.warning("check-in canceled: %s", str(e).strip())
+            return [self.checkInResult(CUID, c.SQL_ERROR, sqlError=e) for CUID in CUIDs]
+        except psycopg2.Error as e:
+            if self.connectionLost(conn, e):
+                DB_ERRORS.inc("unreachable")
+                log.warning("database unreachable: %s", str(e).strip())
+                # The server is unreachable. Don't lose the swipes if we can journal them. Any
+                # that were committed before the connection dropped are skipped on replay
+                if self.journal is not None:
+                    return [self.checkInResult(CUID, c.CHECKIN_JOURNALED, timeIn=self.journal.append(CUID, timeIn))
+                            for CUID, timeIn in zip(CUIDs, times)]
+                return [self.checkInResult(CUID, c.SQL_ERROR, sqlError=e) for CUID in CUIDs]
+
+            # Deadlocks and serialization failures (TransactionRollbackError) land
+            # here too, and are retried one CUID at a time
+            DB_ERRORS.inc("sql")
+            log.warning("check-in failed: %s", str(e).strip())
+            if len(CUIDs) > 1:
+                return [self.checkInBatch([CUID], [timeIn])[0] for CUID, timeIn in zip(CUIDs, times)]
+            return [self.checkInResult(CUIDs[0], c.SQL_ERROR, sqlError=e)]
+
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe("db", elapsed)
+        log.debug("%d check-ins took %.1f ms in the database", len(CUIDs), elapsed * 1000)
+        return self.checkInResults(CUIDs, rows)
+
+
+    def connectionLost(self, conn, error):
+    #===========================================================================
+    # Whether a check-in failed because the server can't be reached, rather
+    # than because of the statement. conn is None if no connection was made
+    #===========================================================================
+        if isinstance(error, psycopg2.extensions.TransactionRollbackError):
+            return False
+        if conn is None:
+            return isinstance(error, psycopg2.OperationalError)
+        return isinstance(error, psycopg2.InterfaceError) or bool(conn.closed)
+
+
+    def checkInQuery(self, rollups=True):
+    #===========================================================================
+    # Build the single statement check-in query
+    # The user row is locked, conditionally bumped and the visit is recorded
+    # (along with the rollups, if asked) only if the row was updated. The last
+    # check-in and server time are returned so a rejected check-in can be
+    # classified with checkCheckInTime()
+    # The check-in time is the server clock unless a "now" parameter is given
+    # Table and column names are filled in by registerStatements()
+    #===========================================================================
+        return """WITH cur AS (
+                      SELECT u.%(cuidCol)s AS cuid, u.%(emailCol)s AS email, u.%(lastCol)s AS last_checkin,
+                             COALESCE(%%(now)s::timestamp, statement_timestamp()::timestamp) AS now
+                      FROM %(users)s u WHERE u.%(cuidCol)s = %%(cuid)s FOR UPDATE
+                  ), upd AS (
+                      UPDATE %(users)s u SET %(lastCol)s = cur.now, %(visitCol)s = u.%(visitCol)s + 1
+                      FROM cur
+                      WHERE u.%(cuidCol)s = cur.cuid
+                        AND (%%(allowWithinHour)s::boolean OR cur.last_checkin IS NULL
+                             OR cur.last_checkin <= cur.now - interval '1 hour')
+                      RETURNING u.%(cuidCol)s AS cuid, u.%(visitCol)s AS visit_num, cur.now AS now
+                  ), ins AS (
+                      INSERT INTO %(visits)s (%(vCuidCol)s, %(vTimeCol)s, %(vVisitCol)s)
+                      SELECT cuid, now, visit_num FROM upd
+                  )""" + (self.rollupQuery("(SELECT cuid, now AS timein FROM upd)") if rollups else "") + """
+                  SELECT cur.email, cur.last_checkin, cur.now, upd.visit_num
+                  FROM cur LEFT JOIN upd ON upd.cuid = cur.cuid;"""
+
+
+    def rollupQuery(self, source):
+    #===========================================================================
+    # Extra WITH clauses that add the visits in source (a subquery of cuid,
+    # timein rows) to the rollup tables, for appending to a data-modifying WITH
+    # query. A user's first visit of a day counts towards that day's visitors;
+    # an upsert that inserted its row has xmax = 0
+    # Doubled % signs are left for registerStatements() to fill in the names
+    #===========================================================================
+        return """, user_day_rollup AS (
+                      INSERT INTO %%(byUserDay)s (day, %%(vCuidCol)s, visits)
+                      SELECT timein::date, cuid, count(*) FROM %(source)s s GROUP BY 1, 2
+                      ON CONFLICT (day, %%(vCuidCol)s) DO UPDATE SET visits = %%(byUserDay)s.visits + EXCLUDED.visits
+                      RETURNING day, xmax = 0 AS new_visitor
+                  ), day_rollup AS (
+                      INSERT INTO %%(byDay)s (day, visits, visitors)
+                      SELECT d.day, d.visits, (SELECT count(*) FROM user_day_rollup r WHERE r.day = d.day AND r.new_visitor)
+                      FROM (SELECT timein::date AS day, count(*) AS visits FROM %(source)s s GROUP BY 1) d
+                      ON CONFLICT (day) DO UPDATE SET visits = %%(byDay)s.visits + EXCLUDED.visits,
+                                                      visitors = %%(byDay)s.visitors + EXCLUDED.visitors
+                  )""" % {"source": source}
+
+   
+    def replaySwipes(self, records):
+    #===========================================================================
+    # Apply a batch of journaled (timeIn, CUID, kioskID) swipes in one transaction
+    # The batch is COPY'd into a temporary table and applied with set based
+    # statements, keeping the original check-in times. Swipes that are already
+    # in the visits table are skipped so a batch can safely be replayed twice
+    # Unless ALLOW_CHECKIN_WITHIN_HOUR is set, a swipe less than an hour after
+    # an earlier replayed one, or less than an hour from a recorded visit,
+    # is refused like a live check-in would be
+    # applied counts the visits actually recorded
+    #===========================================================================
+        names = self.schemaNames()
+
+        data = io.StringIO("".join("%s\t%s\t%s\n" % (CUID, timeIn.isoformat(" "), kioskID)
+                                   for timeIn, CUID, kioskID in records))
         status = c.FAILURE
-        userID = None
         sqlError = None
-        visitNum = None
-
-        # Get a cursor to the DB
-        if self.dbConn is not None:
-            cursor = self.dbConn.cursor()
-        else:
-            print("dbConn is None")
+        applied = 0
+        unknown = 0
+        refused = 0
 
         try:
-            cursor.execute("""BEGIN TRANSACTION;""")
-            # Get the last check-in time
-            cursor.execute("""SELECT last_checkIn FROM %s WHERE CUID=\'%s\';""" % (self.dbUsersTable, CUID))
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute("""BEGIN TRANSACTION;""")
+                    cursor.execute("""CREATE TEMP TABLE swipe_replay (cuid varchar, timein timestamp, kiosk text) ON COMMIT DROP;""")
+                    cursor.copy_from(data, "swipe_replay", columns=("cuid", "timein", "kiosk"))
 
-            # Ensure that the card is in the database
-            if cursor.rowcount == 0:
-                status = c.CUID_NOT_IN_DB
-                # Raise a generic exception to break out of the try block
-                raise Exception
-            else:
-                result = cursor.fetchone()
+                    # Lock the affected users so live check-ins can't take the same visit numbers
+                    cursor.execute("""SELECT 1 FROM %(users)s WHERE %(cuidCol)s IN (SELECT cuid FROM swipe_replay)
+                                      ORDER BY %(cuidCol)s FOR UPDATE;""" % names)
+
+                    cursor.execute("""SELECT count(*) FROM swipe_replay r
+                                      WHERE NOT EXISTS (SELECT 1 FROM %(users)s u WHERE u.%(cuidCol)s = r.cuid);""" % names)
+                    unknown = cursor.fetchone()[0]
+
+                    if not c.ALLOW_CHECKIN_WITHIN_HOUR:
+                        refused = self.refuseReplayWithinHour(cursor, records)
+
+                    cursor.execute(("""WITH ordered AS (
+                                          SELECT r.cuid, r.timein,
+                                                 u.%(visitCol)s + row_number() OVER (PARTITION BY r.cuid ORDER BY r.timein) AS visit_num
+                                          FROM (SELECT DISTINCT cuid, timein FROM swipe_replay) r
+                                          JOIN %(users)s u ON u.%(cuidCol)s = r.cuid
+                                          WHERE NOT EXISTS (SELECT 1 FROM %(visits)s v
+                                                            WHERE v.%(vCuidCol)s = r.cuid AND v.%(vTimeCol)s = r.timein)
+                                      ), ins AS (
+                                          INSERT INTO %(visits)s (%(vCuidCol)s, %(vTimeCol)s, %(vVisitCol)s)
+                                          SELECT cuid, timein, visit_num FROM ordered
+                                      )""" + (self.rollupQuery("ordered") if self.rollups else "") + """
+                                      UPDATE %(users)s u SET %(visitCol)s = u.%(visitCol)s + s.n,
+                                                            %(lastCol)s = GREATEST(u.%(lastCol)s, s.last)
+                                      FROM (SELECT cuid, count(*) AS n, max(timein) AS last FROM ordered GROUP BY cuid) s
+                                      WHERE u.%(cuidCol)s = s.cuid
+                                      RETURNING s.n;""") % names)
+                    applied = sum(row[0] for row in cursor.fetchall())
+
+                    cursor.execute("""END TRANSACTION;""")
+
+                    # Our own notifications are ignored, so drop the replayed users here
+                    if self.userCache is not None:
+                        for timeIn, CUID, kioskID in records:
+                            self.userCache.invalidate(CUID)
+                    status = c.SUCCESS
+                finally:
+                    cursor.close()
+        except PoolTimeout:
+            status = c.DB_BUSY
+        except psycopg2.Error as e:
+            status = c.SQL_ERROR
+            sqlError = e
+
+        return {"replayStatus": status, "applied": applied, "unknown": unknown, "refused": refused, "sqlError": sqlError}
+
+
+    def refuseReplayWithinHour(self, cursor, records):
+    #===========================================================================
+    # Apply the hour rule to the swipe_replay table: going through each user's
+    # swipes in time order, delete those less than an hour after the last one
+    # kept or less than an hour from a visit already recorded (a recorded visit
+    # at the same time is a duplicate, skipped by replaySwipes instead)
+    # Returns the number of swipes deleted
+    #===========================================================================
+        names = self.schemaNames()
+
+        # Recorded visits of each known card that could be within an hour of its
+        # swipes. Unknown cards are left for replaySwipes to count
+        cursor.execute("""SELECT r.cuid, v.%(vTimeCol)s
+                          FROM (SELECT cuid, min(timein) AS first, max(timein) AS last FROM swipe_replay GROUP BY cuid) r
+                          JOIN %(users)s u ON u.%(cuidCol)s = r.cuid
+                          LEFT JOIN %(visits)s v ON v.%(vCuidCol)s = r.cuid
+                           AND v.%(vTimeCol)s > r.first - interval '1 hour' AND v.%(vTimeCol)s < r.last + interval '1 hour';""" % names)
+        visits = {}
+        for CUID, timeIn in cursor.fetchall():
+            visits.setdefault(CUID, [])
+            if timeIn is not None:
+                visits[CUID].append(timeIn)
+
+        hour = timedelta(hours=1)
+        lastKept = {}
+        refusedCUIDs = []
+        refusedTimes = []
 
-                # Verify the check-in times
-            if c.ALLOW_CHECKIN_WITHIN_HOUR:
-                status = c.SUCCESS
+        for timeIn, CUID in sorted(set((timeIn, CUID) for timeIn, CUID, kioskID in records)):
+            if CUID not in visits:
+                continue
+
+            recorded = visits[CUID]
+            if timeIn in recorded:
+                lastKept[CUID] = timeIn
+            elif (CUID in lastKept and timeIn - lastKept[CUID] < hour) or any(abs(timeIn - visit) < hour for visit in recorded):
+                refusedCUIDs.append(CUID)
+                refusedTimes.append(timeIn)
             else:
-                status = self.checkCheckInTime(result[0])
+                lastKept[CUID] = timeIn
+
+        if refusedCUIDs:
+            cursor.execute("""DELETE FROM swipe_replay r USING unnest(%s::varchar[], %s::timestamp[]) d(cuid, timein)
+                              WHERE r.cuid = d.cuid AND r.timein = d.timein;""", (refusedCUIDs, refusedTimes))
+
+        # Swipes journaled twice count once
+        return len(refusedCUIDs)
+
+
+    def importRosterBatch(self, batch, lastLine, checkpointPath, importResult):
+    #===========================================================================
+    # Upsert one batch of [line number, CUID, first, last, email] rows in one
+    # transaction and save a checkpoint. Returns False if the import must stop
+    #===========================================================================
+        names = {"users": self.dbUsersTable, "cuidCol": c.CUID_COLUMN_USER, "firstCol": c.FIRST_NAME_COLUMN_USER,
+                 "lastNameCol": c.LAST_NAME_COLUMN_USER, "emailCol": c.EMAIL_COLUMN_USER,
+                 "visitCol": c.VISIT_NUM_COLUMN_USER}
+
+        data = io.StringIO()
+        csv.writer(data).writerows(batch)
+        data.seek(0)
+
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute("""BEGIN TRANSACTION;""")
+                    cursor.execute("""CREATE TEMP TABLE roster_import (line int, cuid varchar, first_name text,
+                                      last_name text, email text) ON COMMIT DROP;""")
+                    cursor.copy_expert("""COPY roster_import FROM STDIN WITH (FORMAT csv);""", data)
+
+                    # The last row for a CUID wins if the file lists it more than once
+                    cursor.execute("""INSERT INTO %(users)s (%(cuidCol)s, %(firstCol)s, %(lastNameCol)s, %(emailCol)s, %(visitCol)s)
+                                      SELECT DISTINCT ON (cuid) cuid, first_name, last_name, email, %%s
+                                      FROM roster_import ORDER BY cuid, line DESC
+                                      ON CONFLICT (%(cuidCol)s) DO UPDATE
+                                      SET %(firstCol)s = EXCLUDED.%(firstCol)s, %(lastNameCol)s = EXCLUDED.%(lastNameCol)s,
+                                          %(emailCol)s = EXCLUDED.%(emailCol)s;""" % names, [c.DEFAULT_VISITS])
+                    cursor.execute("""END TRANSACTION;""")
+                finally:
+                    cursor.close()
+        except PoolTimeout:
+            importResult["importStatus"] = c.DB_BUSY
+            return False
+        except psycopg2.Error as e:
+            importResult["importStatus"] = c.SQL_ERROR
+            importResult["sqlError"] = e
+            return False
+
+        importResult["imported"] += len(batch)
+        self.writeCheckpoint(checkpointPath, lastLine)
+
+        for row in batch:
+            self.addToRoster(row[1])
+            if self.userCache is not None:
+                self.userCache.invalidate(row[1])
+
+        return True
 
 
-            if status == c.SUCCESS:
-                # Update the database with the new visits
-                cursor.execute("""UPDATE %s SET %s = \'%s\' WHERE %s = \'%s\';""" % (self.dbUsersTable, c.LAST_CHECKIN_COLUMN_USER, datetime.now(), c.CUID_COLUMN_USER, CUID))
-                cursor.execute("""UPDATE %s SET %s = %s + 1 WHERE %s = \'%s\';""" % (self.dbUsersTable, c.VISIT_NUM_COLUMN_USER, c.VISIT_NUM_COLUMN_USER, c.CUID_COLUMN_USER, CUID))
+    def exportVisits(self, path, fmt="csv", start=None, end=None, CUID=None, compress=False):
+    #===========================================================================
+    # Stream the visits table to a CSV or JSON Lines file
+    # with COPY TO STDOUT, optionally limited to start <= timein < end and/or
+    # one CUID, and optionally gzipped on the fly. Rows go straight from the
+    # server to the file, so memory use doesn't depend on the export size
+    #===========================================================================
+        names = {"visits": self.dbVisitsTable, "cuidCol": c.CUID_COLUMN_VISIT,
+                 "timeCol": c.TIMEIN_COLUMN_VISIT, "visitCol": c.VISIT_NUM_COLUMN_VISIT}
+
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append("%(timeCol)s >= %%s" % names)
+            params.append(start)
+        if end is not None:
+            conditions.append("%(timeCol)s < %%s" % names)
+            params.append(end)
+        if CUID is not None:
+            conditions.append("%(cuidCol)s = %%s" % names)
+            params.append(CUID)
+        names["where"] = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+
+        if fmt == "jsonl":
+            # One JSON object per line. Quote and delimiter are set to characters
+            # that can't appear in the JSON so COPY writes it untouched
+            query = """COPY (SELECT json_build_object('%(cuidCol)s', %(cuidCol)s, '%(timeCol)s', %(timeCol)s,
+                                                      '%(visitCol)s', %(visitCol)s)
+                             FROM %(visits)s %(where)s ORDER BY %(timeCol)s)
+                       TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02');""" % names
+        else:
+            query = """COPY (SELECT %(cuidCol)s, %(timeCol)s, %(visitCol)s FROM %(visits)s %(where)s ORDER BY %(timeCol)s)
+                       TO STDOUT WITH (FORMAT csv, HEADER);""" % names
 
-                cursor.execute("""SELECT %s FROM %s WHERE CUID=\'%s\';""" % (c.VISIT_NUM_COLUMN_USER, self.dbUsersTable, CUID))
+        status = c.SUCCESS
+        sqlError = None
 
-                visitNum = cursor.fetchone()[0]
-                cursor.execute("""INSERT INTO %s (%s, %s, %s) values (\'%s\', \'%s\', \'%s\');""" % (self.dbVisitsTable, c.CUID_COLUMN_VISIT, c.TIMEIN_COLUMN_VISIT, c.VISIT_NUM_COLUMN_VISIT, CUID, datetime.now(), visitNum))
+        rawFile = None
+        outFile = None
 
-                # Grab the user ID that just checked-in to print confirmation
-                cursor.execute("""SELECT %s FROM %s WHERE CUID=\'%s\';""" % (c.EMAIL_COLUMN_USER, self.dbUsersTable, CUID))
+        try:
+            rawFile = open(path, "wb")
+            outFile = gzip.GzipFile(fileobj=rawFile, mode="wb") if compress else rawFile
 
-                userID = cursor.fetchone()[0]
-                
-            cursor.execute("""END TRANSACTION;""")
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    # COPY can't take bound parameters, so let psycopg2 quote the filters into the query
+                    cursor.copy_expert(cursor.mogrify(query, params).decode(), outFile)
+                finally:
+                    cursor.close()
+        except PoolTimeout:
+            status = c.DB_BUSY
         except psycopg2.Error as e:
             status = c.SQL_ERROR
             sqlError = e
-        except Exception as e:
-            print(e)
-            pass
+        except OSError:
+            # The file couldn't be created or written
+            status = c.FAILURE
         finally:
-            cursor.close()
-        
-        return {"checkInStatus": status, "userID": userID, "CUID": CUID, "sqlError": sqlError}
+            # Closing the gzip stream writes its trailer but leaves rawFile open
+            if compress and outFile is not None:
+                outFile.close()
+            if rawFile is not None:
+                rawFile.close()
 
-   
-    def checkCheckInTime(self, lastCheckIn):
-    #===========================================================================
-    # Verifies that we are not checking into the past or the future
-    #===========================================================================
-        # Get the current date/time
-        curDate = datetime.now()
-
-        # The last_checkIn column was added after the DB was initially populated meaning it could be a NoneType
-        # Only check the dates if this is not the case
-        if lastCheckIn and datetime.date(curDate) == datetime.date(lastCheckIn):
-            tmzAdjust = 0
-         
-            # Check that the current system time is at least one hour greater than the last check-in time
-            if (datetime.time(curDate).hour+tmzAdjust == datetime.time(lastCheckIn).hour or
-                (datetime.time(curDate).hour+tmzAdjust == datetime.time(lastCheckIn).hour+1 and
-                datetime.time(curDate).minute < datetime.time(lastCheckIn).minute)):
-                return c.BAD_CHECKIN_TIME
-            # If the current system time is before the check-in time, do not allow check-in
-            elif datetime.time(curDate).hour+tmzAdjust < datetime.time(lastCheckIn).hour:
-                return c.FUTURE_CHECKIN_TIME
-        # If the current system date is before the check-in date, do not allow check-in
-        elif lastCheckIn and datetime.date(curDate) < datetime.date(lastCheckIn):
-            return c.FUTURE_CHECKIN_TIME
+        return {"exportStatus": status, "path": path, "sqlError": sqlError}
+
+
+    def scanVisits(self, consume, start=None, end=None, batchSize=None):
+    #===========================================================================
+    # Read the visits table as (CUID, seconds since the epoch) rows, optionally
+    # limited to start <= timein < end, and pass them to consume batchSize rows
+    # at a time. Rows come from a server-side cursor in no particular order, so
+    # memory use doesn't depend on the table size
+    #===========================================================================
+        names = {"visits": self.dbVisitsTable, "cuidCol": c.CUID_COLUMN_VISIT, "timeCol": c.TIMEIN_COLUMN_VISIT}
+        batchSize = batchSize or c.REPORT_FETCH_BATCH
+
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append("%(timeCol)s >= %%s" % names)
+            params.append(start)
+        if end is not None:
+            conditions.append("%(timeCol)s < %%s" % names)
+            params.append(end)
+        names["where"] = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+
+        status = c.SUCCESS
+        rows = 0
+        sqlError = None
+
+        try:
+            with self.pool.connection() as conn:
+                # Named (server-side) cursors only live inside a transaction
+                conn.autocommit = False
+                try:
+                    cursor = conn.cursor(name="scan_%x" % id(conn))
+                    cursor.execute("""SELECT %(cuidCol)s, EXTRACT(EPOCH FROM %(timeCol)s)::bigint
+                                      FROM %(visits)s %(where)s;""" % names, params)
+                    while True:
+                        batch = cursor.fetchmany(batchSize)
+                        if not batch:
+                            break
+                        consume(batch)
+                        rows += len(batch)
+                    cursor.close()
+                finally:
+                    if not conn.closed:
+                        conn.rollback()
+                        conn.autocommit = True
+        except PoolTimeout:
+            status = c.DB_BUSY
+        except psycopg2.Error as e:
+            status = c.SQL_ERROR
+            sqlError = e
+
+        return {"scanStatus": status, "rows": rows, "sqlError": sqlError}
+
+
+    def iterVisits(self, userID="", limit=None, offset=0, batchSize=None, orderBy="visits", descending=True):
+    #===========================================================================
+    # Generator of (userID, visits) rows from a server-side cursor, fetched
+    # batchSize rows at a time. The connection is held until the generator is
+    # exhausted or closed
+    #===========================================================================
+        names = {"users": self.dbUsersTable, "emailCol": c.EMAIL_COLUMN_USER, "visitCol": c.VISIT_NUM_COLUMN_USER,
+                 "direction": "DESC" if descending else "ASC"}
+        params = []
+
+        if userID == "":
+            # Break ties by user ID so limit/offset pages are stable
+            if orderBy == "userID":
+                query = "SELECT %(emailCol)s, %(visitCol)s FROM %(users)s ORDER BY %(emailCol)s %(direction)s" % names
+            else:
+                query = "SELECT %(emailCol)s, %(visitCol)s FROM %(users)s ORDER BY %(visitCol)s %(direction)s, %(emailCol)s" % names
         else:
-            return c.SUCCESS
+            query = "SELECT %(emailCol)s, %(visitCol)s FROM %(users)s WHERE %(emailCol)s = %%s" % names
+            params.append(userID)
+
+        if limit is not None:
+            query += " LIMIT %s"
+            params.append(limit)
+        if offset:
+            query += " OFFSET %s"
+            params.append(offset)
+
+        with self.pool.connection() as conn:
+            # Named (server-side) cursors only live inside a transaction
+            conn.autocommit = False
+            try:
+                cursor = conn.cursor(name="visits_%x" % id(conn))
+                cursor.itersize = batchSize or c.VISITS_FETCH_BATCH
+                cursor.execute(query + ";", params)
+
+                for row in cursor:
+                    yield row
+
+                cursor.close()
+            finally:
+                if not conn.closed:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        pass
+                    conn.autocommit = True
+
+
+    def streamVisits(self, first, rows, showVisitsResult):
+    #===========================================================================
+    # Yield the first row and then the rest, recording errors in the result
+    #===========================================================================
+        yield first
+        try:
+            for row in rows:
+                yield row
+        except psycopg2.Error as e:
+            showVisitsResult["showVisitsStatus"] = c.SQL_ERROR
+            showVisitsResult["sqlError"] = e
 
 
-    def showVisits(self, userID=""):
+    def showVisits(self, userID="", stream=False, limit=None, offset=0, orderBy="visits", descending=True):
     #===========================================================================
     # Check visits associated with userID and return value
+    # With stream=True visitsTuple is an iterator that fetches rows from a
+    # server-side cursor in batches instead of a list of every row. If the
+    # query fails part way, iteration stops and the status is set to SQL_ERROR
+    # orderBy ("visits" or "userID") and descending pick the streamed order
     #===========================================================================
         # Init result and sqlError
         result = None
         sqlError = None
 
-        # Get a cursor to the DB
-        cursor = self.dbConn.cursor()
+        if stream or limit is not None or offset or (orderBy, descending) != ("visits", True):
+            rows = self.iterVisits(userID, limit, offset, orderBy=orderBy, descending=descending)
+            showVisitsResult = {"showVisitsStatus": c.SUCCESS, "visitsTuple": None, "sqlError": None}
 
-        try:
-            # Either get all user ID's and visits from DB or just one user ID
-            if userID == "":
-                cursor.execute("""SELECT userID, visits FROM %s ORDER BY visits DESC;""" % (self.dbUsersTable))
-            else:
-                cursor.execute("""SELECT userID, visits FROM %s WHERE userID=\'%s\';""" % (self.dbUsersTable, userID))
+            try:
+                # Fetch the first row to tell an empty result from a full one
+                first = next(rows)
+                showVisitsResult["visitsTuple"] = self.streamVisits(first, rows, showVisitsResult)
+            except StopIteration:
+                showVisitsResult["showVisitsStatus"] = c.NO_RESULTS
+            except PoolTimeout:
+                showVisitsResult["showVisitsStatus"] = c.DB_BUSY
+            except psycopg2.Error as e:
+                showVisitsResult["showVisitsStatus"] = c.SQL_ERROR
+                showVisitsResult["sqlError"] = e
 
-            # Show error if no results (user ID is not in database)
-            if cursor.rowcount == 0:
-                status = c.NO_RESULTS
-            else:
-                result = cursor.fetchall()
-                status = c.SUCCESS
+            if not stream and showVisitsResult["visitsTuple"] is not None:
+                showVisitsResult["visitsTuple"] = list(showVisitsResult["visitsTuple"])
 
+            return showVisitsResult
+
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    # Either get all user ID's and visits from DB or just one user ID
+                    if userID == "":
+                        self.statements.execute(cursor, "showAllVisits")
+                    else:
+                        self.statements.execute(cursor, "showUserVisits", {"userID": userID})
+
+                    # Show error if no results (user ID is not in database)
+                    if cursor.rowcount == 0:
+                        status = c.NO_RESULTS
+                    else:
+                        result = cursor.fetchall()
+                        status = c.SUCCESS
+                finally:
+                    cursor.close()
+        except PoolTimeout:
+            status = c.DB_BUSY
         except psycopg2.Error as e:
             status = c.SQL_ERROR
             sqlError = e
-        finally:
-            cursor.close()
-            return {"showVisitsStatus": status, "visitsTuple": result, "sqlError": sqlError}
+
+        return {"showVisitsStatus": status, "visitsTuple": result, "sqlError": sqlError}
@@ -0,0 +1,451 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import time
+import asyncio
+import functools
+import threading
+import contextvars
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from sharedUtils import Utils
+from metrics import STAGE_SECONDS, STATUS_NAMES, QUEUE_DEPTH, TRACE, log, countCheckIn, newTrace, traced
+import constants as c
+
+
+class Engine:
+    def __init__(self, db, workers=None, timeout=None):
+    #===========================================================================
+    # Runs every database request for a front end as a coroutine on an asyncio
+    # loop in a background thread. The blocking DB calls run on a fixed pool of
+    # worker threads; requests waiting for a worker are coroutines, not threads
+    # Front ends submit coroutines with submit() (returns a future that can be
+    # cancelled) or run() (blocks for the result)
+    #===========================================================================
+        self.db = db
+        self.workers = workers or c.ENGINE_WORKERS
+        self.timeout = timeout if timeout is not None else c.ENGINE_TIMEOUT
+        self.tools = Utils()
+
+        self.loop = None
+        self.thread = None
+        self.executor = None
+        self.slots = None
+        self.started = threading.Event()
+
+
+    def start(self):
+    #===========================================================================
+    # Start the event loop thread
+    #===========================================================================
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="engine")
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.runLoop, daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+        # Expose the metrics while requests are being handled
+        if c.METRICS_PORT:
+            from metricsServer import serveMetrics
+            serveMetrics()
+
+
+    def runLoop(self):
+    #===========================================================================
+    # Body of the event loop thread
+    #===========================================================================
+        asyncio.set_event_loop(self.loop)
+        self.slots = asyncio.Semaphore(self.workers)
+        self.loop.call_soon(self.started.set)
+
+        try:
+            self.loop.run_forever()
+
+            # Let anything still pending see its cancellation before closing
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        finally:
+            self.loop.close()
+
+
+    def stop(self):
+    #===========================================================================
+    # Cancel outstanding requests and stop the loop. DB calls already running
+    # on a worker are allowed to finish
+    #===========================================================================
+        if self.loop is None:
+            return
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+        self.loop = None
+
+
+    def submit(self, coro):
+    #===========================================================================
+    # Schedule a coroutine from any thread
+    # Returns a concurrent.futures.Future; cancel() it to drop the request
+    #===========================================================================
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+    def run(self, coro):
+    #===========================================================================
+    # Run a coroutine and block until its result is ready
+    #===========================================================================
+        return self.submit(coro).result()
+
+
+    async def call(self, func, *args, timeout=None, abandon=False, **kwargs):
+    #===========================================================================
+    # Run a blocking DB call on a worker
+    # The timeout covers waiting for a free worker. A call that has started is
+    # waited for, since a check-in abandoned part way could still be committed
+    # after the user was told it failed. Read only calls can pass abandon=True
+    # to also time out (and be cancelled) while running; the worker finishes
+    # the call in the background and its result is dropped
+    # A cancelled caller stops waiting, but the call is shielded and runs to the
+    # end on its worker, which stays taken until then
+    #===========================================================================
+        timeout = self.timeout if timeout is None else timeout
+
+        await asyncio.wait_for(self.slots.acquire(), timeout)
+        job = None
+        try:
+            # Run in this task's context so the worker's log lines carry its trace id
+            job = self.loop.run_in_executor(self.executor, contextvars.copy_context().run,
+                                            functools.partial(func, *args, **kwargs))
+            if abandon:
+                return await asyncio.wait_for(job, timeout)
+            return await asyncio.shield(job)
+        finally:
+            if job is None or job.done():
+                self.slots.release()
+            else:
+                job.add_done_callback(self.callDone)
+
+
+    def callDone(self, job):
+    #===========================================================================
+    # Free the worker of a call whose caller was cancelled. The result is dropped
+    #===========================================================================
+        if not job.cancelled() and job.exception() is not None:
+            log.warning("call failed after its caller was cancelled: %s", job.exception())
+        self.slots.release()
+
+
+    async def checkIn(self, CUID, trace=None):
+    #===========================================================================
+    # Check in a CUID. Returns the DB.checkIn result dict, with the swipe's
+    # trace id (a new one unless given) under "trace"
+    #===========================================================================
+        TRACE.set(trace or newTrace())
+        started = time.perf_counter()
+
+        try:
+            result = await self.call(self.db.checkIn, CUID)
+        except asyncio.TimeoutError:
+            result = self.db.checkInResult(CUID, c.DB_BUSY)
+
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe("checkin", elapsed)
+        countCheckIn(result)
+        log.info("check-in %s: %s in %.1f ms", CUID, STATUS_NAMES.get(result["checkInStatus"]), elapsed * 1000)
+
+        result["trace"] = TRACE.get()
+        return result
+
+
+    async def checkInBatch(self, CUIDs, trace=None):
+    #===========================================================================
+    # Check in a list of CUIDs in one transaction. Returns a result dict each
+    #===========================================================================
+        TRACE.set(trace or newTrace())
+        started = time.perf_counter()
+
+        try:
+            results = await self.call(self.db.checkInBatch, CUIDs)
+        except asyncio.TimeoutError:
+            results = [self.db.checkInResult(CUID, c.DB_BUSY) for CUID in CUIDs]
+
+        STAGE_SECONDS.observe("checkin", time.perf_counter() - started)
+        for result in results:
+            countCheckIn(result)
+            result["trace"] = TRACE.get()
+        log.info("batch of %d check-ins in %.1f ms", len(CUIDs), (time.perf_counter() - started) * 1000)
+        return results
+
+
+    async def addCard(self, CUID, firstName, lastName, email):
+    #===========================================================================
+    # Add a card and check it in. Returns the DB.addCard result dict
+    #===========================================================================
+        try:
+            result = await self.call(self.db.addCard, CUID, firstName, lastName, email)
+        except asyncio.TimeoutError:
+            result = {"addCardStatus": c.DB_BUSY, "Name": firstName, "userID": email, "CUID": CUID, "sqlError": None}
+
+        countCheckIn(result)
+        return result
+
+
+    async def showVisits(self, userID="", **kwargs):
+    #===========================================================================
+    # Visits for one user or everyone. Takes the DB.showVisits keyword arguments
+    #===========================================================================
+        try:
+            return await self.call(self.db.showVisits, userID, abandon=True, **kwargs)
+        except asyncio.TimeoutError:
+            return {"showVisitsStatus": c.DB_BUSY, "visitsTuple": None, "sqlError": None}
+
+
+    async def showRank(self, userID):
+    #===========================================================================
+    # A user's visits, rank and percentile. Returns the DB.showRank result dict
+    #===========================================================================
+        try:
+            return await self.call(self.db.showRank, userID, abandon=True)
+        except asyncio.TimeoutError:
+            return {"showRankStatus": c.DB_BUSY, "userID": userID, "visits": None, "rank": None,
+                    "total": None, "percentile": None, "sqlError": None}
+
+
+    async def topVisitors(self, start, end, limit=None):
+    #===========================================================================
+    # The users with the most visits in a window of days. Returns the
+    # DB.topVisitors result dict
+    #===========================================================================
+        try:
+            return await self.call(self.db.topVisitors, start, end, limit, abandon=True)
+        except asyncio.TimeoutError:
+            return {"topStatus": c.DB_BUSY, "rows": None, "sqlError": None}
+
+
+    async def visitTrend(self, start, end):
+    #===========================================================================
+    # Visits and visitors per day in a window. Returns the DB.visitTrend result dict
+    #===========================================================================
+        try:
+            return await self.call(self.db.visitTrend, start, end, abandon=True)
+        except asyncio.TimeoutError:
+            return {"trendStatus": c.DB_BUSY, "rows": None, "sqlError": None}
+
+
+    async def runReports(self, outDir=None, start=None, end=None):
+    #===========================================================================
+    # Compute and write the visit reports. Returns the reports.runReports
+    # result dict. Reports take a while, so only waiting for a worker times out
+    #===========================================================================
+        # NumPy is only loaded once someone asks for reports
+        from reports import runReports
+
+        try:
+            return await self.call(runReports, self.db, outDir, start, end)
+        except asyncio.TimeoutError:
+            return {"reportStatus": c.DB_BUSY, "paths": [], "index": None, "visits": 0, "sqlError": None, "error": None}
+
+
+    def addSwipeSource(self, path, handler):
+    #===========================================================================
+    # Check in every card swiped on an extra reader (a device or pipe giving one
+    # swipe per line) and pass each result dict to handler, which is called on
+    # the engine thread. Returns a future; cancel() it to stop reading
+    #===========================================================================
+        return self.submit(self.serveSwipes(self.readSwipes(path), handler))
+
+
+    async def serveSwipes(self, swipes, handler):
+    #===========================================================================
+    # Check in the card data from an async iterator of swipes, one at a time
+    # Many sources can be served at once; each is a task on the loop
+    #===========================================================================
+        async for cardData in swipes:
+            CUID = self.tools.parseCardSwipe(cardData)
+
+            if CUID is None:
+                result = self.db.checkInResult(None, c.ERROR_READING_CARD)
+                countCheckIn(result)
+                handler(result)
+                continue
+
+            handler(await self.checkIn(self.tools.sanitizeInput(CUID), newTrace()))
+
+
+    async def readSwipes(self, path):
+    #===========================================================================
+    # Async iterator of the lines read from a reader device or pipe
+    #===========================================================================
+        reader = asyncio.StreamReader()
+        readerFile = open(path, "rb", buffering=0)
+        transport, protocol = await self.loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), readerFile)
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                yield line.decode("utf-8", "replace").strip()
+        finally:
+            transport.close()
+
+
+class SwipeQueue:
+    def __init__(self, engine, handler, maxSize=None, overflow=None):
+    #===========================================================================
+    # Bounded FIFO of swipes checked in one at a time by a worker task on the
+    # engine loop, so reading cards never waits on the database
+    # When the queue is full a swipe is never dropped silently. Depending on
+    # overflow it is either written to the offline journal for the replayer to
+    # apply ("spill"), or turned away with SWIPE_QUEUE_FULL so the kiosk can ask
+    # the user to wait and swipe again ("reject")
+    # handler gets each result dict and is called on the engine thread
+    #===========================================================================
+        self.engine = engine
+        self.handler = handler
+        self.maxSize = maxSize or c.SWIPE_QUEUE_SIZE
+        self.overflow = overflow or c.SWIPE_QUEUE_OVERFLOW
+
+        self.lock = threading.Lock()
+        self.depth = 0
+        self.queue = None
+        self.worker = None
+
+        self.processed = 0
+        self.spilled = 0
+        self.rejected = 0
+        self.maxDepth = 0
+        # Seconds spent queued by the most recent swipes
+        self.waits = collections.deque(maxlen=c.SWIPE_QUEUE_STATS_WINDOW)
+
+        QUEUE_DEPTH.setFunction(lambda: self.depth)
+
+
+    def start(self):
+    #===========================================================================
+    # Start the worker on the engine loop
+    #===========================================================================
+        self.queue = self.engine.run(self.newQueue())
+        self.worker = self.engine.submit(self.run())
+
+
+    async def newQueue(self):
+    #===========================================================================
+    # The queue has to be created on the engine loop
+    #===========================================================================
+        return asyncio.Queue()
+
+
+    def stop(self):
+    #===========================================================================
+    # Stop the worker and wait for drain() to empty the queue, before the
+    # engine loop is stopped
+    #===========================================================================
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+            self.engine.run(self.drain())
+
+
+    async def drain(self):
+    #===========================================================================
+    # Empty the queue when the kiosk shuts down. Nothing is dropped silently:
+    # each swipe still waiting is spilled to the journal if there is one, and
+    # otherwise logged with its trace id as dropped
+    #===========================================================================
+        while not self.queue.empty():
+            queuedAt, CUID, trace = self.queue.get_nowait()
+            with self.lock:
+                self.depth -= 1
+                if self.engine.db.journal is not None:
+                    self.spilled += 1
+                    status = c.CHECKIN_JOURNALED
+                    result = self.engine.db.checkInResult(CUID, status, timeIn=self.engine.db.journal.append(CUID))
+                else:
+                    self.rejected += 1
+                    status = c.SWIPE_QUEUE_FULL
+                    result = self.engine.db.checkInResult(CUID, status)
+
+            countCheckIn(result)
+            with traced(trace):
+                log.warning("swipe queue stopped, %s %s", CUID, "journaled" if status == c.CHECKIN_JOURNALED else "dropped")
+
+
+    def submit(self, CUID, trace=None):
+    #===========================================================================
+    # Queue a swipe from any thread, optionally with its trace id
+    # Returns SUCCESS if it was queued, CHECKIN_JOURNALED if it was spilled, or
+    # SWIPE_QUEUE_FULL if it was turned away. The handler also gets a result
+    # for spilled and rejected swipes
+    #===========================================================================
+        with self.lock:
+            if self.depth < self.maxSize:
+                self.depth += 1
+                self.maxDepth = max(self.maxDepth, self.depth)
+                self.engine.loop.call_soon_threadsafe(self.queue.put_nowait, (time.monotonic(), CUID, trace))
+                return c.SUCCESS
+
+            if self.overflow == "spill" and self.engine.db.journal is not None:
+                self.spilled += 1
+                status = c.CHECKIN_JOURNALED
+                result = self.engine.db.checkInResult(CUID, status, timeIn=self.engine.db.journal.append(CUID))
+            else:
+                self.rejected += 1
+                status = c.SWIPE_QUEUE_FULL
+                result = self.engine.db.checkInResult(CUID, status)
+
+        countCheckIn(result)
+        with traced(trace):
+            log.warning("swipe queue full, %s %s", CUID, STATUS_NAMES[status])
+        result["trace"] = trace
+        self.handler(result)
+        return status
+
+
+    async def run(self):
+    #===========================================================================
+    # Check in queued swipes in order until cancelled. stop() drains the rest
+    #===========================================================================
+        while True:
+            queuedAt, CUID, trace = await self.queue.get()
+            try:
+                wait = time.monotonic() - queuedAt
+                self.waits.append(wait)
+                STAGE_SECONDS.observe("queue", wait)
+                result = await self.engine.checkIn(CUID, trace)
+            finally:
+                with self.lock:
+                    self.depth -= 1
+
+            with self.lock:
+                self.processed += 1
+            self.handler(result)
+
+
+    def stats(self):
+    #===========================================================================
+    # Queue depth and wait time counters
+    #===========================================================================
+        with self.lock:
+            waits = list(self.waits)
+            return {"depth": self.depth, "maxSize": self.maxSize, "maxDepth": self.maxDepth,
+                    "processed": self.processed, "spilled": self.spilled, "rejected": self.rejected,
+                    "avgWait": sum(waits) / len(waits) if waits else 0.0, "maxWait": max(waits) if waits else 0.0}
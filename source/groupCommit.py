@@ -0,0 +1,122 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import time
+import queue
+import threading
+
+import constants as c
+
+
+class PendingSwipe:
+    def __init__(self, CUID, timeIn=None):
+    #===========================================================================
+    # A check-in waiting for its group to be committed
+    #===========================================================================
+        self.CUID = CUID
+        self.timeIn = timeIn
+        self.result = None
+        self.done = threading.Event()
+
+
+class GroupCommitter(threading.Thread):
+    def __init__(self, db, window, maxBatch):
+    #===========================================================================
+    # Collects check-ins arriving within `window` seconds of the first one (or
+    # up to maxBatch of them) and applies them in a single transaction so a
+    # burst of swipes shares one commit flush
+    #===========================================================================
+        super(GroupCommitter, self).__init__()
+        self.daemon = True
+
+        self.db = db
+        self.window = window
+        self.maxBatch = maxBatch
+        self.swipes = queue.Queue()
+        # Set by stop(). Guarded by lock so no swipe is queued behind the end of the queue
+        self.stopped = False
+        self.lock = threading.Lock()
+
+
+    def submit(self, CUID, timeIn=None):
+    #===========================================================================
+    # Queue a check-in and block until its group is committed
+    # Returns the same result dict as DB.checkIn. Once stopped, the check-in
+    # is applied on its own instead
+    #===========================================================================
+        swipe = PendingSwipe(CUID, timeIn)
+        with self.lock:
+            stopped = self.stopped
+            if not stopped:
+                self.swipes.put(swipe)
+
+        # Outside the lock, so a slow check-in doesn't hold up other callers or stop()
+        if stopped:
+            return self.db.checkInBatch([CUID], [timeIn])[0]
+
+        swipe.done.wait()
+        return swipe.result
+
+
+    def run(self):
+    #===========================================================================
+    # Wait for a swipe, gather its group and apply it
+    #===========================================================================
+        stopping = False
+        while not stopping:
+            swipe = self.swipes.get()
+            if swipe is None:
+                break
+
+            batch = [swipe]
+            deadline = time.monotonic() + self.window
+
+            # Gather everything else that arrives inside the window
+            while len(batch) < self.maxBatch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    swipe = self.swipes.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if swipe is None:
+                    stopping = True
+                    break
+                batch.append(swipe)
+
+            try:
+                results = self.db.checkInBatch([pending.CUID for pending in batch], [pending.timeIn for pending in batch])
+            except Exception as e:
+                # Never leave the callers waiting
+                print(e)
+                results = [self.db.checkInResult(pending.CUID, c.FAILURE) for pending in batch]
+
+            for pending, result in zip(batch, results):
+                pending.result = result
+                pending.done.set()
+
+
+    def stop(self):
+    #===========================================================================
+    # Apply anything already queued and stop the thread. Check-ins submitted
+    # after this are applied by the caller's thread
+    #===========================================================================
+        with self.lock:
+            self.stopped = True
+            self.swipes.put(None)
@@ -0,0 +1,230 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import os
+import socket
+import threading
+from datetime import datetime
+
+import constants as c
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+class SwipeJournal:
+    def __init__(self, path, kioskID, fsyncGroup, fsyncDelay, clock=datetime.now):
+    #===========================================================================
+    # Append-only journal of swipes that could not reach the database
+    # Each line is: timestamp <tab> CUID <tab> kiosk ID
+    # Writes are fsync'd in groups of fsyncGroup records or after fsyncDelay
+    # seconds, whichever comes first. Replayed records are tracked by a byte
+    # offset stored next to the journal
+    # Swipes are stamped with clock(). DB passes its serverNow so journaled
+    # and live check-in times are both on the database's clock
+    #===========================================================================
+        self.path = path
+        self.offsetPath = path + ".offset"
+        self.kioskID = kioskID or socket.gethostname()
+        self.fsyncGroup = fsyncGroup
+        self.fsyncDelay = fsyncDelay
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.flushTimer = None
+        self.journalFile = open(self.path, "a", encoding="utf-8")
+
+
+    def append(self, CUID, timeIn=None):
+    #===========================================================================
+    # Record a swipe. The time defaults to the journal's clock
+    #===========================================================================
+        if timeIn is None:
+            timeIn = self.clock()
+
+        with self.lock:
+            self.journalFile.write("%s\t%s\t%s\n" % (timeIn.strftime(TIME_FORMAT), CUID, self.kioskID))
+            self.journalFile.flush()
+            self.pending += 1
+
+            if self.pending >= self.fsyncGroup:
+                self.sync()
+            elif self.flushTimer is None:
+                # Make sure a lone swipe is synced soon even if no more arrive
+                self.flushTimer = threading.Timer(self.fsyncDelay, self.timedSync)
+                self.flushTimer.daemon = True
+                self.flushTimer.start()
+
+        return timeIn
+
+
+    def timedSync(self):
+    #===========================================================================
+    # Timer callback to sync a partial group
+    #===========================================================================
+        with self.lock:
+            self.flushTimer = None
+            if self.pending > 0:
+                self.sync()
+
+
+    def sync(self):
+    #===========================================================================
+    # fsync the journal. Caller must hold the lock
+    #===========================================================================
+        if self.journalFile.closed:
+            return
+
+        os.fsync(self.journalFile.fileno())
+        self.pending = 0
+
+        if self.flushTimer is not None:
+            self.flushTimer.cancel()
+            self.flushTimer = None
+
+
+    def readOffset(self):
+    #===========================================================================
+    # Byte offset of the first record that has not been replayed
+    #===========================================================================
+        try:
+            with open(self.offsetPath) as offsetFile:
+                return int(offsetFile.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+
+    def readPending(self, maxRecords):
+    #===========================================================================
+    # Read up to maxRecords unreplayed records
+    # Returns a list of (timeIn, CUID, kioskID) and the offset just past them
+    #===========================================================================
+        offset = self.readOffset()
+        records = []
+
+        with open(self.path, "rb") as journalFile:
+            journalFile.seek(offset)
+
+            while len(records) < maxRecords:
+                line = journalFile.readline()
+                # Stop at EOF or a partially written last line
+                if not line.endswith(b"\n"):
+                    break
+
+                offset += len(line)
+                fields = line.decode("utf-8").rstrip("\n").split("\t")
+
+                # Skip anything that is not a well formed record
+                try:
+                    records.append((datetime.strptime(fields[0], TIME_FORMAT), fields[1], fields[2]))
+                except (ValueError, IndexError):
+                    continue
+
+        return records, offset
+
+
+    def markReplayed(self, offset):
+    #===========================================================================
+    # Remember that everything before offset has been replayed. Once the
+    # whole journal is replayed it is truncated so it does not grow forever
+    #===========================================================================
+        with self.lock:
+            if offset >= os.path.getsize(self.path):
+                self.journalFile.truncate(0)
+                offset = 0
+
+            tmpPath = self.offsetPath + ".tmp"
+            with open(tmpPath, "w") as offsetFile:
+                offsetFile.write(str(offset))
+                offsetFile.flush()
+                os.fsync(offsetFile.fileno())
+            os.replace(tmpPath, self.offsetPath)
+
+
+    def hasPending(self):
+    #===========================================================================
+    # Whether there are records that have not been replayed
+    #===========================================================================
+        return os.path.getsize(self.path) > self.readOffset()
+
+
+    def close(self):
+    #===========================================================================
+    # Sync and close the journal
+    #===========================================================================
+        with self.lock:
+            self.sync()
+            self.journalFile.close()
+
+
+class JournalReplayer(threading.Thread):
+    def __init__(self, db, journal, interval, batchSize):
+    #===========================================================================
+    # Background thread that pushes journaled swipes to the database in large
+    # batches once it is reachable again
+    #===========================================================================
+        super(JournalReplayer, self).__init__()
+        self.daemon = True
+
+        self.db = db
+        self.journal = journal
+        self.interval = interval
+        self.batchSize = batchSize
+        self.stopEvent = threading.Event()
+
+
+    def run(self):
+    #===========================================================================
+    # Try to replay the backlog every interval seconds until stopped
+    #===========================================================================
+        while not self.stopEvent.is_set():
+            self.replay()
+            self.stopEvent.wait(self.interval)
+
+
+    def replay(self):
+    #===========================================================================
+    # Replay batches until the journal is empty or the database fails
+    #===========================================================================
+        while self.journal.hasPending():
+            records, offset = self.journal.readPending(self.batchSize)
+
+            # Only a partially written record is left
+            if offset == self.journal.readOffset():
+                return
+
+            if records:
+                replayResult = self.db.replaySwipes(records)
+
+                if replayResult["replayStatus"] != c.SUCCESS:
+                    # Still offline; try again next interval
+                    return
+
+                if replayResult["unknown"] > 0:
+                    print("Dropped %d journaled swipes for cards not in the database" % replayResult["unknown"])
+                if replayResult["refused"] > 0:
+                    print("Dropped %d journaled swipes within an hour of another visit" % replayResult["refused"])
+
+            self.journal.markReplayed(offset)
+
+
+    def stop(self):
+    #===========================================================================
+    # Stop the replayer
+    #===========================================================================
+        self.stopEvent.set()
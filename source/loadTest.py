@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+# End-to-end load tests. Run against a scratch database, never production:
+#   ./loadTest.py seed <users> <visits> [days of history]
+#   ./loadTest.py run [options]
+#   ./loadTest.py clean
+#
+# run options:
+#   --target db | groupcommit | queue | service <url>     (default db)
+#   --arrivals poisson <swipes/s>                         (default poisson 20)
+#            | burst <swipes> <every s> <spread s>        "door opens" bursts
+#            | trace <visits.csv>                         replay an --export-visits file
+#   --duration <s>      simulated seconds of arrivals     (default 60, ignored for traces)
+#   --speed <x>         simulated seconds per real second (default 1)
+#   --concurrency <n>   swipes in flight at once          (default 8)
+#   --hour-rule         enforce the once per hour rule
+#   --seed <n>          random seed
+#
+# Check-ins are stamped with the simulated time, so --speed 10000 plays weeks
+# of swipes (and the hour rule) in minutes. The queue and service targets use
+# the server clock, so only run them at --speed 1 when the hour rule matters
+
+import io
+import csv
+import sys
+import time
+import random
+import threading
+import collections
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import constants as c
+from benchmarks import connectDB, summarize
+
+# Seeded cards are LOAD_CUID_PREFIX followed by 8 digits, with emails starting
+# with LOAD_EMAIL_PREFIX, so they can be told apart and cleaned up
+LOAD_CUID_PREFIX = "7"
+LOAD_EMAIL_PREFIX = "loadtest"
+# How unevenly visits are spread over users (0 is even)
+POPULARITY_SKEW = 0.8
+COPY_CHUNK = 100000
+
+STATUS_NAMES = ["SUCCESS", "FAILURE", "CUID_NOT_IN_DB", "BAD_CHECKIN_TIME", "FUTURE_CHECKIN_TIME",
+                "SQL_ERROR", "NO_RESULTS", "DB_BUSY", "CHECKIN_JOURNALED", "SWIPE_QUEUE_FULL"]
+
+
+def main(args):
+    command = args[1] if len(args) > 1 else None
+
+    try:
+        if command == "seed" and len(args) > 3:
+            db = connectDB()
+            try:
+                seed(db, int(args[2]), int(args[3]), int(args[4]) if len(args) > 4 else 90)
+            finally:
+                db.close()
+        elif command == "run":
+            runLoadTest(parseOptions(args[2:]))
+        elif command == "clean":
+            db = connectDB()
+            try:
+                clean(db)
+            finally:
+                db.close()
+        else:
+            print("Invalid option\nPossible options: seed <users> <visits> [days], run [options], clean")
+            sys.exit(1)
+    except (IndexError, ValueError):
+        print("Invalid option. See the top of loadTest.py for usage.")
+        sys.exit(1)
+
+
+def parseOptions(options):
+#===============================================================================
+# Parse the run options into a dict
+#===============================================================================
+    settings = {"target": "db", "url": None, "arrivals": ["poisson", 20.0], "duration": 60.0, "speed": 1.0,
+                "concurrency": 8, "hourRule": False, "seed": None}
+
+    while options:
+        option = options.pop(0).lower()
+        if option == "--target":
+            settings["target"] = options.pop(0)
+            if settings["target"] == "service":
+                settings["url"] = options.pop(0)
+            elif settings["target"] not in ("db", "groupcommit", "queue"):
+                raise ValueError(settings["target"])
+        elif option == "--arrivals":
+            kind = options.pop(0)
+            if kind == "poisson":
+                settings["arrivals"] = [kind, float(options.pop(0))]
+            elif kind == "burst":
+                settings["arrivals"] = [kind, int(options.pop(0)), float(options.pop(0)), float(options.pop(0))]
+            elif kind == "trace":
+                settings["arrivals"] = [kind, options.pop(0)]
+            else:
+                raise ValueError(kind)
+        elif option == "--duration":
+            settings["duration"] = float(options.pop(0))
+        elif option == "--speed":
+            settings["speed"] = float(options.pop(0))
+        elif option == "--concurrency":
+            settings["concurrency"] = int(options.pop(0))
+        elif option == "--hour-rule":
+            settings["hourRule"] = True
+        elif option == "--seed":
+            settings["seed"] = int(options.pop(0))
+        else:
+            raise ValueError(option)
+
+    return settings
+
+
+def loadCards(users):
+#===============================================================================
+# The CUIDs of the seeded users
+#===============================================================================
+    return [LOAD_CUID_PREFIX + "%08d" % i for i in range(users)]
+
+
+def popularity(users):
+#===============================================================================
+# Cumulative weights giving a few regulars most of the visits
+#===============================================================================
+    cumulative = []
+    total = 0.0
+    for i in range(users):
+        total += 1.0 / (i + 1) ** POPULARITY_SKEW
+        cumulative.append(total)
+    return cumulative
+
+
+def seed(db, users, visits, days, rng=random):
+#===============================================================================
+# Replace the seeded users with `users` new ones and `visits` visits spread
+# over the last `days` days, loaded with COPY
+#===============================================================================
+    clean(db, rollups=False)
+
+    cards = loadCards(users)
+    now = datetime.now().replace(microsecond=0)
+    start = now - timedelta(days=days)
+    span = (now - start).total_seconds()
+
+    # Pick who made each visit and when, then number each user's visits in order
+    history = collections.defaultdict(list)
+    for CUID in rng.choices(cards, cum_weights=popularity(users), k=visits):
+        history[CUID].append(start + timedelta(seconds=rng.uniform(0, span)))
+
+    userRows = io.StringIO()
+    for i, CUID in enumerate(cards):
+        times = sorted(history.get(CUID, []))
+        history[CUID] = times
+        userRows.write("%s\tLoad\tUser%d\t%s%d\t%d\t%s\n" % (CUID, i, LOAD_EMAIL_PREFIX, i, len(times),
+                                                             times[-1].isoformat(" ") if times else "\\N"))
+    userRows.seek(0)
+
+    print("Seeding %d users and %d visits over %d days..." % (users, visits, days))
+    began = time.perf_counter()
+
+    with db.pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.copy_from(userRows, db.dbUsersTable,
+                             columns=(c.CUID_COLUMN_USER, c.FIRST_NAME_COLUMN_USER, c.LAST_NAME_COLUMN_USER,
+                                      c.EMAIL_COLUMN_USER, c.VISIT_NUM_COLUMN_USER, c.LAST_CHECKIN_COLUMN_USER))
+
+            visitRows = io.StringIO()
+            pending = 0
+            for CUID in cards:
+                for visitNum, timeIn in enumerate(history[CUID], 1):
+                    visitRows.write("%s\t%s\t%d\n" % (CUID, timeIn.isoformat(" "), visitNum))
+                    pending += 1
+
+                # Copy in chunks so memory doesn't grow with the number of visits
+                if pending >= COPY_CHUNK:
+                    copyVisits(db, cursor, visitRows)
+                    visitRows = io.StringIO()
+                    pending = 0
+            copyVisits(db, cursor, visitRows)
+
+            cursor.execute("ANALYZE %s;" % db.dbUsersTable)
+            cursor.execute("ANALYZE %s;" % db.dbVisitsTable)
+        finally:
+            cursor.close()
+
+    # The new cards must not be turned away by a roster snapshot taken before them
+    if db.roster is not None:
+        db.refreshRoster()
+
+    # COPY skips the check-in path, so count the seeded history in the rollups
+    if db.rollups:
+        db.backfillRollups()
+
+    print("Seeded in %.1fs" % (time.perf_counter() - began))
+
+
+def copyVisits(db, cursor, visitRows):
+#===============================================================================
+# COPY a buffer of visits rows
+#===============================================================================
+    visitRows.seek(0)
+    cursor.copy_from(visitRows, db.dbVisitsTable,
+                     columns=(c.CUID_COLUMN_VISIT, c.TIMEIN_COLUMN_VISIT, c.VISIT_NUM_COLUMN_VISIT))
+
+
+def clean(db, rollups=True):
+#===============================================================================
+# Remove the seeded users and their visits, and rebuild the rollups without
+# them unless rollups is False
+#===============================================================================
+    with db.pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""DELETE FROM %s WHERE %s IN (SELECT %s FROM %s WHERE %s LIKE %%s AND %s LIKE %%s);""" %
+                           (db.dbVisitsTable, c.CUID_COLUMN_VISIT, c.CUID_COLUMN_USER, db.dbUsersTable,
+                            c.CUID_COLUMN_USER, c.EMAIL_COLUMN_USER), (LOAD_CUID_PREFIX + "%", LOAD_EMAIL_PREFIX + "%"))
+            cursor.execute("""DELETE FROM %s WHERE %s LIKE %%s AND %s LIKE %%s;""" %
+                           (db.dbUsersTable, c.CUID_COLUMN_USER, c.EMAIL_COLUMN_USER),
+                           (LOAD_CUID_PREFIX + "%", LOAD_EMAIL_PREFIX + "%"))
+        finally:
+            cursor.close()
+
+    if rollups and db.rollups:
+        db.backfillRollups()
+
+
+def seededCards(db):
+#===============================================================================
+# CUIDs of the seeded users, busiest first
+#===============================================================================
+    with db.pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""SELECT %s FROM %s WHERE %s LIKE %%s AND %s LIKE %%s ORDER BY %s DESC;""" %
+                           (c.CUID_COLUMN_USER, db.dbUsersTable, c.CUID_COLUMN_USER, c.EMAIL_COLUMN_USER,
+                            c.VISIT_NUM_COLUMN_USER), (LOAD_CUID_PREFIX + "%", LOAD_EMAIL_PREFIX + "%"))
+            return [row[0] for row in cursor]
+        finally:
+            cursor.close()
+
+
+def poissonArrivals(rate, duration, cards, rng=random):
+#===============================================================================
+# (simulated second, CUID) of swipes arriving at random at `rate` per second
+#===============================================================================
+    weights = popularity(len(cards))
+    t = rng.expovariate(rate)
+    while t < duration:
+        yield t, rng.choices(cards, cum_weights=weights)[0]
+        t += rng.expovariate(rate)
+
+
+def burstArrivals(size, every, spread, duration, cards, rng=random):
+#===============================================================================
+# "Door opens" arrivals: every `every` seconds, `size` swipes within `spread`
+# seconds. Nobody swipes twice in one burst
+#===============================================================================
+    start = 0.0
+    while start < duration:
+        burst = rng.sample(cards, min(size, len(cards)))
+        for t, CUID in sorted((start + rng.uniform(0, spread), CUID) for CUID in burst):
+            yield t, CUID
+        start += every
+
+
+def traceArrivals(path):
+#===============================================================================
+# Replay a visits CSV written by --export-visits (cuid, timein, visit_num)
+#===============================================================================
+    with open(path, newline="") as traceFile:
+        rows = csv.reader(traceFile)
+        first = None
+
+        for row in rows:
+            try:
+                timeIn = datetime.fromisoformat(row[1])
+            except (ValueError, IndexError):
+                # Header or a bad line
+                continue
+
+            if first is None:
+                first = timeIn
+            yield (timeIn - first).total_seconds(), row[0]
+
+
+def latencyHistogram(samples, width=40):
+#===============================================================================
+# Print a histogram of latencies in power of two millisecond buckets
+#===============================================================================
+    buckets = collections.Counter()
+    for sample in samples:
+        bucket = 0.25
+        while sample * 1000 > bucket:
+            bucket *= 2
+        buckets[bucket] += 1
+
+    most = max(buckets.values())
+    for bucket in sorted(buckets):
+        print("  <= %8.2fms %7d %s" % (bucket, buckets[bucket], "#" * max(1, buckets[bucket] * width // most)))
+
+
+class Recorder:
+    def __init__(self):
+    #===========================================================================
+    # Collects the latency and status of every swipe from many threads
+    #===========================================================================
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = collections.Counter()
+        self.done = threading.Condition(self.lock)
+
+
+    def record(self, due, status):
+    #===========================================================================
+    # Record a finished swipe that was due at perf_counter() time `due`
+    # Latency is measured from when the swipe was due, not when it was sent, so
+    # time spent waiting behind earlier swipes counts
+    #===========================================================================
+        latency = time.perf_counter() - due
+        with self.lock:
+            self.latencies.append(latency)
+            self.statuses[status] += 1
+            self.done.notify_all()
+
+
+    def waitFor(self, count):
+    #===========================================================================
+    # Block until `count` swipes have been recorded
+    #===========================================================================
+        with self.lock:
+            while len(self.latencies) < count:
+                self.done.wait()
+
+
+def runLoadTest(settings):
+#===============================================================================
+# Play the arrivals against the target and report throughput and latency
+#===============================================================================
+    rng = random.Random(settings["seed"])
+    c.ALLOW_CHECKIN_WITHIN_HOUR = 0 if settings["hourRule"] else 1
+
+    db = None
+    engine = None
+    swipeQueue = None
+
+    try:
+        if settings["target"] == "service":
+            from service import ServiceClient
+            client = ServiceClient(settings["url"])
+            if client.connect() != c.SUCCESS:
+                sys.exit(1)
+            checkIn = lambda CUID, timeIn: client.checkIn(CUID)
+            cards = None
+        else:
+            db = connectDB()
+            cards = seededCards(db)
+            checkIn = db.checkIn
+
+            if settings["target"] == "groupcommit":
+                db.enableGroupCommit(c.GROUP_COMMIT_WINDOW, c.GROUP_COMMIT_MAX)
+
+        kind = settings["arrivals"][0]
+        if kind != "trace" and not cards:
+            if db is None:
+                # The service target has no direct DB access to find the seeded cards
+                cards = loadCards(int(input("Number of seeded users: ")))
+            else:
+                print("No seeded users. Run ./loadTest.py seed first.")
+                sys.exit(1)
+
+        if kind == "poisson":
+            arrivals = poissonArrivals(settings["arrivals"][1], settings["duration"], cards, rng)
+        elif kind == "burst":
+            arrivals = burstArrivals(*settings["arrivals"][1:], settings["duration"], cards, rng)
+        else:
+            arrivals = traceArrivals(settings["arrivals"][1])
+
+        recorder = Recorder()
+
+        if settings["target"] == "queue":
+            from engine import Engine, SwipeQueue
+
+            # The queue checks swipes in in order, so each CUID's results come back in order
+            dueTimes = collections.defaultdict(collections.deque)
+            dueLock = threading.Lock()
+
+            def queueDone(result):
+                with dueLock:
+                    due = dueTimes[result["CUID"]].popleft()
+                recorder.record(due, result["checkInStatus"])
+
+            engine = Engine(db)
+            engine.start()
+            swipeQueue = SwipeQueue(engine, queueDone)
+            swipeQueue.start()
+
+            def send(due, CUID, timeIn):
+                with dueLock:
+                    dueTimes[CUID].append(due)
+                swipeQueue.submit(CUID)
+        else:
+            workers = ThreadPoolExecutor(max_workers=settings["concurrency"])
+
+            def swipe(due, CUID, timeIn):
+                try:
+                    recorder.record(due, checkIn(CUID, timeIn)["checkInStatus"])
+                except Exception as e:
+                    print(e)
+                    recorder.record(due, c.FAILURE)
+
+            send = lambda due, CUID, timeIn: workers.submit(swipe, due, CUID, timeIn)
+
+        print("Target %s, arrivals %s, speed %gx, %d in flight" %
+              (settings["target"], " ".join(str(arg) for arg in settings["arrivals"]), settings["speed"],
+               settings["concurrency"]))
+
+        simStart = datetime.now()
+        wallStart = time.perf_counter()
+        sent = 0
+        simEnd = 0.0
+
+        # Open loop: swipes are sent when they are due whether or not earlier ones have finished
+        for simOffset, CUID in arrivals:
+            due = wallStart + simOffset / settings["speed"]
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            send(due, CUID, simStart + timedelta(seconds=simOffset))
+            sent += 1
+            simEnd = simOffset
+
+        recorder.waitFor(sent)
+        elapsed = time.perf_counter() - wallStart
+
+        if settings["target"] != "queue":
+            workers.shutdown()
+
+        report(recorder, sent, elapsed, simEnd)
+        if swipeQueue is not None:
+            print("Queue stats:", swipeQueue.stats())
+    finally:
+        if swipeQueue is not None:
+            swipeQueue.stop()
+        if engine is not None:
+            engine.stop()
+        if db is not None:
+            db.close()
+
+
+def report(recorder, sent, elapsed, simEnd):
+#===============================================================================
+# Print throughput, statuses and latency percentiles and histogram
+#===============================================================================
+    if not sent:
+        print("No swipes were sent.")
+        return
+
+    names = dict((getattr(c, name), name) for name in STATUS_NAMES)
+
+    print("\n%d swipes in %.2fs (%s simulated): %.1f swipes/s" %
+          (sent, elapsed, timedelta(seconds=int(simEnd)), sent / elapsed))
+    for status, count in recorder.statuses.most_common():
+        print("  %-20s %7d" % (names.get(status, status), count))
+
+    summarize("latency", recorder.latencies)
+    latencyHistogram(recorder.latencies)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,216 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import bisect
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+import constants as c
+
+# Trace id of the swipe being handled, shown in every log line written for it
+TRACE = contextvars.ContextVar("trace", default="-")
+
+log = logging.getLogger("magstripe")
+
+# Names for checkInStatus values in metric labels
+STATUS_NAMES = {c.SUCCESS: "success", c.FAILURE: "failure", c.CUID_NOT_IN_DB: "unknown_card",
+                c.BAD_CHECKIN_TIME: "too_soon", c.FUTURE_CHECKIN_TIME: "future_time", c.SQL_ERROR: "sql_error",
+                c.DB_BUSY: "busy", c.CHECKIN_JOURNALED: "journaled", c.SWIPE_QUEUE_FULL: "queue_full",
+                c.ERROR_READING_CARD: "read_error"}
+
+
+class Counter:
+    def __init__(self, name, description, label):
+    #===========================================================================
+    # A count per value of one label, e.g. check-ins per status
+    #===========================================================================
+        self.name = name
+        self.description = description
+        self.label = label
+        self.lock = threading.Lock()
+        self.values = {}
+
+
+    def inc(self, labelValue, amount=1):
+    #===========================================================================
+    # Add to the count for a label value
+    #===========================================================================
+        with self.lock:
+            self.values[labelValue] = self.values.get(labelValue, 0) + amount
+
+
+    def render(self):
+    #===========================================================================
+    # Lines in the Prometheus text format
+    #===========================================================================
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s counter" % self.name]
+        with self.lock:
+            lines += ['%s{%s="%s"} %s' % (self.name, self.label, labelValue, value)
+                      for labelValue, value in sorted(self.values.items())]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, label, buckets=None):
+    #===========================================================================
+    # Latency histogram per value of one label, in seconds. Buckets are the
+    # upper bounds; observations are kept as counts, so memory is fixed
+    #===========================================================================
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = sorted(buckets or c.METRICS_BUCKETS)
+        self.lock = threading.Lock()
+        # Label value -> [count per bucket (the last is +Inf), sum]
+        self.values = {}
+
+
+    def observe(self, labelValue, seconds):
+    #===========================================================================
+    # Record one duration
+    #===========================================================================
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            counts = self.values.get(labelValue)
+            if counts is None:
+                counts = self.values[labelValue] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += seconds
+
+
+    def render(self):
+    #===========================================================================
+    # Lines in the Prometheus text format, with cumulative buckets
+    #===========================================================================
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            for labelValue, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ["+Inf"], counts):
+                    cumulative += count
+                    lines.append('%s_bucket{%s="%s",le="%s"} %d' % (self.name, self.label, labelValue, bound, cumulative))
+                lines.append('%s_sum{%s="%s"} %f' % (self.name, self.label, labelValue, total))
+                lines.append('%s_count{%s="%s"} %d' % (self.name, self.label, labelValue, cumulative))
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, description):
+    #===========================================================================
+    # A value read when the metrics are scraped, from a function set by
+    # whatever owns it (so nothing has to be updated on the hot path)
+    #===========================================================================
+        self.name = name
+        self.description = description
+        self.function = None
+
+
+    def setFunction(self, function):
+    #===========================================================================
+    # Read the gauge from function(); None removes it
+    #===========================================================================
+        self.function = function
+
+
+    def render(self):
+    #===========================================================================
+    # Lines in the Prometheus text format, or none if nothing provides a value
+    #===========================================================================
+        function = self.function
+        if function is None:
+            return []
+        return ["# HELP %s %s" % (self.name, self.description), "# TYPE %s gauge" % self.name,
+                "%s %s" % (self.name, function())]
+
+
+# Swipe stages: decode (first key to card ID), queue (waiting for a worker),
+# db (DB.checkIn round trip), service (check-in service round trip),
+# checkin (engine request, including waiting for a worker) and ui (showing the result)
+STAGE_SECONDS = Histogram("magstripe_stage_seconds", "Time spent in each stage of a swipe", "stage")
+CHECKINS = Counter("magstripe_checkins_total", "Swipes by check-in status", "status")
+DB_ERRORS = Counter("magstripe_db_errors_total", "Database errors on the check-in path", "kind")
+QUEUE_DEPTH = Gauge("magstripe_swipe_queue_depth", "Swipes waiting in the kiosk's queue")
+POOL_IN_USE = Gauge("magstripe_pool_connections_in_use", "Database connections checked out of the pool")
+GROUP_COMMIT_PENDING = Gauge("magstripe_group_commit_pending", "Check-ins waiting for the next group commit")
+
+METRICS = [STAGE_SECONDS, CHECKINS, DB_ERRORS, QUEUE_DEPTH, POOL_IN_USE, GROUP_COMMIT_PENDING]
+
+
+def countCheckIn(result):
+#===============================================================================
+# Count a check-in result dict by its status
+#===============================================================================
+    status = result["checkInStatus"] if "checkInStatus" in result else result.get("addCardStatus")
+    CHECKINS.inc(STATUS_NAMES.get(status, str(status)))
+
+
+def render():
+#===============================================================================
+# Every metric in the Prometheus text format
+#===============================================================================
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def newTrace():
+#===============================================================================
+# Start a trace for a new swipe in the current context and return its id
+#===============================================================================
+    trace = "%08x" % random.getrandbits(32)
+    TRACE.set(trace)
+    return trace
+
+
+@contextmanager
+def traced(trace):
+#===============================================================================
+# Run the body of a with statement under an existing trace id
+#===============================================================================
+    token = TRACE.set(trace or "-")
+    try:
+        yield
+    finally:
+        TRACE.reset(token)
+
+
+class TraceFilter(logging.Filter):
+    def filter(self, record):
+    #===========================================================================
+    # Add the current trace id to log records
+    #===========================================================================
+        record.trace = TRACE.get()
+        return True
+
+
+def configureLogging():
+#===============================================================================
+# Send the "magstripe" log to LOG_PATH (or the console) with trace ids
+#===============================================================================
+    handler = logging.FileHandler(c.LOG_PATH) if c.LOG_PATH else logging.StreamHandler()
+    handler.addFilter(TraceFilter())
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(trace)s] %(message)s"))
+
+    log.addHandler(handler)
+    log.setLevel(c.LOG_LEVEL)
+    # Keep it out of any handlers the root logger has
+    log.propagate = False
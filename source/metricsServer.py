@@ -0,0 +1,75 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+# The metrics endpoint, kept apart from metrics so front ends that don't
+# serve it never import the HTTP server
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metrics import render
+import constants as c
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+    #===========================================================================
+    # Serve the metrics at /metrics
+    #===========================================================================
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        data = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def log_message(self, format, *args):
+    #===========================================================================
+    # Scrapes every few seconds would flood the console
+    #===========================================================================
+        pass
+
+
+server = None
+
+def serveMetrics(host=None, port=None):
+#===============================================================================
+# Start the metrics endpoint on a background thread if METRICS_PORT is set
+# Safe to call more than once; only the first call starts it
+#===============================================================================
+    global server
+    port = c.METRICS_PORT if port is None else port
+
+    if server is not None or not port:
+        return server
+
+    try:
+        server = ThreadingHTTPServer((host or c.METRICS_HOST, port), MetricsHandler)
+    except OSError as e:
+        print("Could not serve metrics on port %d: %s" % (port, e))
+        return None
+
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("Serving metrics on http://%s:%d/metrics" % server.server_address[:2])
+    return server
@@ -0,0 +1,109 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import select
+import threading
+
+# LISTEN/NOTIFY is Postgres only; the SQLite backend never starts a listener
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+
+class NotifyListener(threading.Thread):
+    def __init__(self, connectFunc, channel, ignorePids, pollInterval=1, retryInterval=5):
+    #===========================================================================
+    # Background thread that LISTENs on a channel with its own connection and
+    # passes each notification payload to the registered handlers
+    # Notifications sent by backends in ignorePids (our own pool) are skipped
+    # Handlers get a payload of None after a reconnect, since notifications
+    # may have been missed while disconnected. `listening` is set while LISTEN
+    # is active, so callers can take a snapshot knowing no change will be missed
+    #===========================================================================
+        super(NotifyListener, self).__init__()
+        self.daemon = True
+
+        self.connectFunc = connectFunc
+        self.channel = channel
+        self.ignorePids = ignorePids
+        self.pollInterval = pollInterval
+        self.retryInterval = retryInterval
+        self.handlers = []
+        self.stopEvent = threading.Event()
+        self.listening = threading.Event()
+
+
+    def addHandler(self, handler):
+    #===========================================================================
+    # Register a function taking the notification payload
+    #===========================================================================
+        self.handlers.append(handler)
+
+
+    def dispatch(self, payload):
+    #===========================================================================
+    # Call every handler with a payload
+    #===========================================================================
+        for handler in self.handlers:
+            handler(payload)
+
+
+    def run(self):
+    #===========================================================================
+    # Listen until stopped, reconnecting if the connection is lost
+    #===========================================================================
+        firstConnect = True
+
+        while not self.stopEvent.is_set():
+            conn = None
+            try:
+                conn = self.connectFunc()
+                cursor = conn.cursor()
+                cursor.execute("LISTEN %s;" % self.channel)
+                cursor.close()
+                self.listening.set()
+
+                if not firstConnect:
+                    self.dispatch(None)
+                firstConnect = False
+
+                while not self.stopEvent.is_set():
+                    if select.select([conn], [], [], self.pollInterval) == ([], [], []):
+                        continue
+
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        if notify.pid not in self.ignorePids:
+                            self.dispatch(notify.payload)
+            except psycopg2.Error as e:
+                self.listening.clear()
+                print("Lost notification connection:", e)
+                self.stopEvent.wait(self.retryInterval)
+            finally:
+                self.listening.clear()
+                if conn is not None:
+                    conn.close()
+
+
+    def stop(self):
+    #===========================================================================
+    # Stop listening
+    #===========================================================================
+        self.stopEvent.set()
@@ -0,0 +1,91 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import re
+import threading
+from datetime import datetime
+
+import constants as c
+
+
+def monthStart(when):
+#===============================================================================
+# Midnight on the first day of the month containing when
+#===============================================================================
+    return datetime(when.year, when.month, 1)
+
+
+def addMonths(month, months):
+#===============================================================================
+# The first day of the month `months` after (or before) a monthStart()
+#===============================================================================
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partitionName(visitsTable, month):
+#===============================================================================
+# Name of the visits partition holding a month, e.g. visits_p2024_09
+#===============================================================================
+    return "%s_p%04d_%02d" % (visitsTable, month.year, month.month)
+
+
+def partitionMonth(visitsTable, name):
+#===============================================================================
+# The month a partitionName() holds, or None for any other table
+#===============================================================================
+    match = re.match(re.escape(visitsTable) + r"_p(\d{4})_(\d{2})$", name)
+    return datetime(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+class PartitionMaintainer(threading.Thread):
+    def __init__(self, db, interval):
+    #===========================================================================
+    # Background thread that keeps monthly visits partitions created ahead of
+    # time and applies the retention policy (see DB.maintainPartitions)
+    # Every kiosk runs one; the database serializes them with an advisory lock
+    #===========================================================================
+        super(PartitionMaintainer, self).__init__()
+        self.daemon = True
+
+        self.db = db
+        self.interval = interval
+        self.stopEvent = threading.Event()
+
+
+    def run(self):
+    #===========================================================================
+    # Maintain the partitions every interval seconds until stopped
+    #===========================================================================
+        while not self.stopEvent.is_set():
+            partitionResult = self.db.maintainPartitions()
+
+            if partitionResult["partitionStatus"] == c.SQL_ERROR:
+                # Usually the lock timeout on a busy table; try again next interval
+                print("Could not maintain the visits partitions:", partitionResult["sqlError"])
+            for name in partitionResult["retired"]:
+                print("Retired visits partition %s" % name)
+
+            self.stopEvent.wait(self.interval)
+
+
+    def stop(self):
+    #===========================================================================
+    # Stop the maintainer
+    #===========================================================================
+        self.stopEvent.set()
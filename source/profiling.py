@@ -0,0 +1,98 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+
+import sys
+import atexit
+import pstats
+import cProfile
+import threading
+
+import constants as c
+
+# From 3.12 cProfile is built on sys.monitoring: one profiler sees every thread,
+# and only one can be enabled at a time
+PROFILES_ALL_THREADS = sys.version_info >= (3, 12)
+
+
+class SessionProfiler:
+    def __init__(self, path=None):
+    #===========================================================================
+    # cProfile for a whole session (checkIn.py --profile). Before Python 3.12
+    # cProfile only sees the thread that enabled it, so every thread started
+    # after start() gets its own profiler and their stats are merged when the
+    # session ends. From 3.12 a single profiler covers all threads
+    #===========================================================================
+        self.path = path or c.PROFILE_PATH
+        self.main = cProfile.Profile()
+        self.threads = []
+        self.lock = threading.Lock()
+
+
+    def start(self):
+    #===========================================================================
+    # Profile this thread and any thread started from now on. The stats are
+    # written when the program exits
+    #===========================================================================
+        if not PROFILES_ALL_THREADS:
+            threading.setprofile(self.profileThread)
+        self.main.enable()
+        atexit.register(self.stop)
+
+
+    def profileThread(self, frame, event, arg):
+    #===========================================================================
+    # Called on the first event in a new thread; swaps itself out for a profiler
+    #===========================================================================
+        profile = cProfile.Profile()
+        with self.lock:
+            self.threads.append(profile)
+        profile.enable()
+
+
+    def stop(self):
+    #===========================================================================
+    # Stop profiling, save the merged stats to path and print the top entries
+    #===========================================================================
+        if not PROFILES_ALL_THREADS:
+            threading.setprofile(None)
+        self.main.disable()
+
+        stats = pstats.Stats(self.main)
+        with self.lock:
+            for profile in self.threads:
+                # Other threads may still be running; read their stats without
+                # disabling (disable() only works from the profiled thread)
+                profile.snapshot_stats()
+                stats.add(ThreadStats(profile.stats))
+
+        stats.dump_stats(self.path)
+        print("\nProfile saved to %s (open it with pstats or snakeviz)" % self.path)
+        stats.sort_stats(c.PROFILE_SORT).print_stats(c.PROFILE_TOP)
+
+
+class ThreadStats:
+    def __init__(self, stats):
+    #===========================================================================
+    # Stats already taken from a profiler, in the form pstats.Stats.add takes
+    #===========================================================================
+        self.stats = stats
+
+
+    def create_stats(self):
+        pass
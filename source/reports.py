@@ -0,0 +1,304 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import os
+import csv
+import html
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Only the reports need NumPy; everything else runs without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import constants as c
+
+DAY = 86400
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+def reportsAvailable():
+#===============================================================================
+# Whether NumPy is installed
+#===============================================================================
+    return numpy is not None
+
+
+class VisitArrays:
+    def __init__(self):
+    #===========================================================================
+    # Collects the batches from DB.scanVisits into NumPy arrays: visit times in
+    # seconds since the epoch, and user numbers (the order cards were first seen)
+    #===========================================================================
+        self.timeBatches = []
+        self.userBatches = []
+        self.userNumbers = {}
+
+
+    def add(self, batch):
+    #===========================================================================
+    # Convert one batch of (CUID, seconds) rows
+    #===========================================================================
+        CUIDs, times = zip(*batch)
+
+        # Only the batch's distinct cards are numbered in Python
+        batchCUIDs, inverse = numpy.unique(numpy.array(CUIDs), return_inverse=True)
+        numbers = numpy.fromiter((self.userNumbers.setdefault(CUID, len(self.userNumbers)) for CUID in batchCUIDs.tolist()),
+                                 dtype=numpy.int64, count=len(batchCUIDs))
+
+        self.timeBatches.append(numpy.fromiter(times, dtype=numpy.int64, count=len(times)))
+        self.userBatches.append(numbers[inverse.reshape(-1)])
+
+
+    def arrays(self):
+    #===========================================================================
+    # Returns (times, users) for every visit added
+    #===========================================================================
+        if not self.timeBatches:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+        return numpy.concatenate(self.timeBatches), numpy.concatenate(self.userBatches)
+
+
+def uniquePairs(groups, users):
+#===============================================================================
+# How many distinct users each group (0..n) has, counting a user once per group
+#===============================================================================
+    nUsers = int(users.max()) + 1
+    pairs = numpy.unique(groups * nUsers + users)
+    return numpy.bincount(pairs // nUsers, minlength=int(groups.max()) + 1)
+
+
+def dailyVisits(times, users):
+#===============================================================================
+# Visits and distinct visitors for each day
+#===============================================================================
+    days = times // DAY
+    first = int(days.min())
+    days = days - first
+
+    visits = numpy.bincount(days)
+    visitors = uniquePairs(days, users)
+    dates = numpy.arange(first, first + len(visits)).astype("datetime64[D]")
+
+    return (["Date", "Visits", "Visitors"],
+            [(str(date), int(visitCount), int(visitorCount)) for date, visitCount, visitorCount in zip(dates, visits, visitors)])
+
+
+def hourlyVisits(times, users):
+#===============================================================================
+# Visits by day of the week and hour of the day
+#===============================================================================
+    # 1970-01-01 was a Thursday
+    weekdays = (times // DAY + 3) % 7
+    hours = (times % DAY) // 3600
+    grid = numpy.bincount(weekdays * 24 + hours, minlength=7 * 24).reshape(7, 24)
+
+    return (["Day"] + ["%02d:00" % hour for hour in range(24)],
+            [[WEEKDAYS[day]] + grid[day].tolist() for day in range(7)])
+
+
+def weeklyVisitors(times, users):
+#===============================================================================
+# Visits, distinct visitors and first-time visitors for each week (Monday on)
+#===============================================================================
+    weeks = (times // DAY + 3) // 7
+    first = int(weeks.min())
+    weeks = weeks - first
+
+    visits = numpy.bincount(weeks)
+    visitors = uniquePairs(weeks, users)
+
+    firstWeeks = numpy.full(int(users.max()) + 1, len(visits), dtype=numpy.int64)
+    numpy.minimum.at(firstWeeks, users, weeks)
+    newVisitors = numpy.bincount(firstWeeks, minlength=len(visits))
+
+    starts = (numpy.arange(first, first + len(visits)) * 7 - 3).astype("datetime64[D]")
+
+    return (["Week of", "Visits", "Visitors", "New visitors"],
+            [(str(start), int(visits[i]), int(visitors[i]), int(newVisitors[i])) for i, start in enumerate(starts)])
+
+
+def cohorts(times, users, months=None):
+#===============================================================================
+# Users grouped by the month of their first visit, and how many of each group
+# came back 1, 2, ... months later. Months after the last visit are left blank
+#===============================================================================
+    months = months or c.REPORT_COHORT_MONTHS
+    visitMonths = times.astype("datetime64[s]").astype("datetime64[M]").astype(numpy.int64)
+    first = int(visitMonths.min())
+    last = int(visitMonths.max())
+    visitMonths = visitMonths - first
+
+    firstMonths = numpy.full(int(users.max()) + 1, last - first + 1, dtype=numpy.int64)
+    numpy.minimum.at(firstMonths, users, visitMonths)
+    sizes = numpy.bincount(firstMonths, minlength=last - first + 1)
+
+    # Count each user once per month since their first visit
+    later = visitMonths - firstMonths[users]
+    followed = later <= months
+    pairs = numpy.unique(users[followed] * (months + 1) + later[followed])
+    cohortUsers = pairs // (months + 1)
+    cells = firstMonths[cohortUsers] * (months + 1) + pairs % (months + 1)
+    grid = numpy.bincount(cells, minlength=len(sizes) * (months + 1)).reshape(len(sizes), months + 1)
+
+    rows = []
+    for cohort in range(len(sizes)):
+        if sizes[cohort] == 0:
+            continue
+        label = str(numpy.datetime64(first + cohort, "M"))
+        returning = [int(grid[cohort][month]) if first + cohort + month <= last else ""
+                     for month in range(1, months + 1)]
+        rows.append([label, int(sizes[cohort])] + returning)
+
+    return (["First visit", "Users"] + ["+%d mo" % month for month in range(1, months + 1)], rows)
+
+
+# Each report is (file name, title, function of (times, users) returning (header, rows))
+REPORTS = [("daily_visits", "Visits per day", dailyVisits),
+           ("hourly_visits", "Visits by weekday and hour", hourlyVisits),
+           ("weekly_visitors", "Visitors per week", weeklyVisitors),
+           ("cohorts", "Returning visitors by month of first visit", cohorts)]
+
+
+def computeReports(times, users, workers=None):
+#===============================================================================
+# Run every report, in a pool of worker processes if workers > 1 and there
+# are enough visits to make starting them worthwhile
+# Returns a (header, rows) table per entry in REPORTS
+#===============================================================================
+    workers = c.REPORT_WORKERS if workers is None else workers
+
+    if workers <= 1 or len(times) < c.REPORT_PARALLEL_MIN:
+        return [report(times, users) for name, title, report in REPORTS]
+
+    # Spawn rather than fork: the caller has database connections, threads and
+    # maybe Qt open, which a forked child would inherit in an unknown state
+    with ProcessPoolExecutor(max_workers=min(workers, len(REPORTS)), mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(report, times, users) for name, title, report in REPORTS]
+        return [future.result() for future in futures]
+
+
+def runReports(db, outDir=None, start=None, end=None, workers=None):
+#===============================================================================
+# Read the visits (optionally start <= timein < end) and write each report as
+# CSV and HTML to outDir, plus an index.html linking them
+# Returns {"reportStatus", "paths", "index", "visits", "sqlError", "error"}
+# where error is why the reports couldn't be computed or written (FAILURE)
+#===============================================================================
+    outDir = outDir or c.REPORT_DIR
+    reportResult = {"reportStatus": c.SUCCESS, "paths": [], "index": None, "visits": 0, "sqlError": None, "error": None}
+
+    if numpy is None:
+        reportResult["reportStatus"] = c.FAILURE
+        return reportResult
+
+    visits = VisitArrays()
+    scanResult = db.scanVisits(visits.add, start, end)
+    if scanResult["scanStatus"] != c.SUCCESS:
+        reportResult.update({"reportStatus": scanResult["scanStatus"], "sqlError": scanResult["sqlError"]})
+        return reportResult
+
+    times, users = visits.arrays()
+    reportResult["visits"] = len(times)
+    if len(times) == 0:
+        reportResult["reportStatus"] = c.NO_RESULTS
+        return reportResult
+
+    # An unwritable outDir or a worker process that died (killed, out of memory)
+    try:
+        tables = computeReports(times, users, workers)
+
+        os.makedirs(outDir, exist_ok=True)
+        period = describePeriod(times)
+        links = []
+        for (name, title, report), (header, rows) in zip(REPORTS, tables):
+            csvPath = os.path.join(outDir, name + ".csv")
+            htmlPath = os.path.join(outDir, name + ".html")
+            writeCSV(csvPath, header, rows)
+            writeHTML(htmlPath, title, period, header, rows)
+            reportResult["paths"] += [csvPath, htmlPath]
+            links.append((title, name))
+
+        reportResult["index"] = os.path.join(outDir, "index.html")
+        writeIndex(reportResult["index"], period, len(times), links)
+    except (OSError, BrokenProcessPool) as e:
+        reportResult.update({"reportStatus": c.FAILURE, "index": None, "error": e})
+
+    return reportResult
+
+
+def describePeriod(times):
+#===============================================================================
+# The dates a report covers, for its heading
+#===============================================================================
+    first = str(numpy.datetime64(int(times.min()), "s").astype("datetime64[D]"))
+    last = str(numpy.datetime64(int(times.max()), "s").astype("datetime64[D]"))
+    return "Visits from %s to %s" % (first, last)
+
+
+def writeCSV(path, header, rows):
+#===============================================================================
+# Write one report table as CSV
+#===============================================================================
+    with open(path, "w", newline="") as csvFile:
+        writer = csv.writer(csvFile)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def htmlPage(title, body):
+#===============================================================================
+# A complete HTML page around some body markup
+#===============================================================================
+    return ("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>%s</title>\n"
+            "<style>body{font-family:sans-serif;margin:2em}table{border-collapse:collapse}"
+            "th,td{border:1px solid #ccc;padding:3px 8px;text-align:right}th:first-child,td:first-child{text-align:left}"
+            "th{background:#eee}</style></head>\n<body>\n%s\n</body></html>\n") % (html.escape(title), body)
+
+
+def writeHTML(path, title, period, header, rows):
+#===============================================================================
+# Write one report table as an HTML page
+#===============================================================================
+    lines = ["<h1>%s</h1>" % html.escape(title), "<p>%s</p>" % html.escape(period), "<table>",
+             "<tr>" + "".join("<th>%s</th>" % html.escape(str(cell)) for cell in header) + "</tr>"]
+    lines += ["<tr>" + "".join("<td>%s</td>" % html.escape(str(cell)) for cell in row) + "</tr>" for row in rows]
+    lines.append("</table>")
+
+    with open(path, "w") as htmlFile:
+        htmlFile.write(htmlPage(title, "\n".join(lines)))
+
+
+def writeIndex(path, period, visits, links):
+#===============================================================================
+# Write the page linking every report
+#===============================================================================
+    title = c.GROUP_NAME + " Attendance Reports"
+    lines = ["<h1>%s</h1>" % html.escape(title),
+             "<p>%s (%d visits). Generated %s.</p>" % (html.escape(period), visits, datetime.now().strftime("%Y-%m-%d %H:%M")),
+             "<ul>"]
+    lines += ["<li><a href=\"%s.html\">%s</a> (<a href=\"%s.csv\">CSV</a>)</li>" % (name, html.escape(reportTitle), name)
+              for reportTitle, name in links]
+    lines.append("</ul>")
+
+    with open(path, "w") as htmlFile:
+        htmlFile.write(htmlPage(title, "\n".join(lines)))
@@ -0,0 +1,166 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import os
+import sys
+import mmap
+import struct
+import bisect
+import threading
+from array import array
+
+# File layout: magic, version, byte order, CUID count, then the sorted uint32 CUIDs
+MAGIC = b"MSRS"
+VERSION = 1
+HEADER = struct.Struct("<4sIIQ")
+BYTE_ORDER = {"little": 1, "big": 2}
+MAX_CUID = 2 ** 32 - 1
+
+
+class Roster:
+    def __init__(self, cuids=None):
+    #===========================================================================
+    # Compact set of every CUID in the users table
+    # The snapshot is a sorted array of 32-bit CUIDs searched with bisect.
+    # CUIDs added since the snapshot was taken are kept in a small delta set
+    #===========================================================================
+        self.cuids = cuids if cuids is not None else array("I")
+        self.added = set()
+        self.lock = threading.Lock()
+        self.mmapFile = None
+
+
+    @staticmethod
+    def toInt(CUID):
+    #===========================================================================
+    # The CUID as an int, or None if it can't be stored in the snapshot
+    #===========================================================================
+        CUID = str(CUID)
+        if not CUID.isdigit():
+            return None
+
+        value = int(CUID)
+        return value if value <= MAX_CUID else None
+
+
+    @classmethod
+    def build(cls, CUIDs):
+    #===========================================================================
+    # Build a roster from an iterable of CUIDs
+    # Returns the roster and a list of CUIDs that could not be stored
+    #===========================================================================
+        values = array("I")
+        unstorable = []
+
+        for CUID in CUIDs:
+            value = cls.toInt(CUID)
+            if value is None:
+                unstorable.append(CUID)
+            else:
+                values.append(value)
+
+        return cls(array("I", sorted(values))), unstorable
+
+
+    @classmethod
+    def load(cls, path):
+    #===========================================================================
+    # Memory map a snapshot file. Returns None if it is missing or invalid
+    #===========================================================================
+        try:
+            snapshotFile = open(path, "rb")
+        except OSError:
+            return None
+
+        with snapshotFile:
+            try:
+                mapped = mmap.mmap(snapshotFile.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                return None
+
+        if len(mapped) < HEADER.size:
+            mapped.close()
+            return None
+
+        magic, version, byteOrder, count = HEADER.unpack_from(mapped)
+        itemSize = array("I").itemsize
+
+        if (magic != MAGIC or version != VERSION or byteOrder != BYTE_ORDER[sys.byteorder]
+                or len(mapped) != HEADER.size + count * itemSize):
+            mapped.close()
+            return None
+
+        roster = cls(memoryview(mapped)[HEADER.size:].cast("I"))
+        roster.mmapFile = mapped
+        return roster
+
+
+    def save(self, path):
+    #===========================================================================
+    # Write the snapshot (including deltas) atomically
+    #===========================================================================
+        with self.lock:
+            values = array("I", sorted(set(self.cuids) | self.added))
+
+        tmpPath = path + ".tmp"
+        with open(tmpPath, "wb") as snapshotFile:
+            snapshotFile.write(HEADER.pack(MAGIC, VERSION, BYTE_ORDER[sys.byteorder], len(values)))
+            snapshotFile.write(values.tobytes())
+            snapshotFile.flush()
+            os.fsync(snapshotFile.fileno())
+        os.replace(tmpPath, path)
+
+
+    def contains(self, CUID):
+    #===========================================================================
+    # True if the CUID is in the roster, False if not, and None if the CUID
+    # can't be stored in the roster (so the database must be asked)
+    #===========================================================================
+        value = self.toInt(CUID)
+        if value is None:
+            return None
+
+        if value in self.added:
+            return True
+
+        i = bisect.bisect_left(self.cuids, value)
+        return i < len(self.cuids) and self.cuids[i] == value
+
+
+    def add(self, CUID):
+    #===========================================================================
+    # Record a CUID added since the snapshot was taken
+    #===========================================================================
+        value = self.toInt(CUID)
+        if value is not None:
+            with self.lock:
+                self.added.add(value)
+
+
+    def __len__(self):
+        return len(self.cuids) + len(self.added)
+
+
+    def close(self):
+    #===========================================================================
+    # Release the memory map
+    #===========================================================================
+        if self.mmapFile is not None:
+            self.cuids.release()
+            self.mmapFile.close()
+            self.mmapFile = None
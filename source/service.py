@@ -0,0 +1,428 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import json
+import hmac
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from engine import Engine
+from metrics import STAGE_SECONDS, TRACE, newTrace
+import constants as c
+
+# Endpoints
+#   POST /checkin         {"cuid": ...}                                   -> checkIn result
+#   POST /checkin/batch   {"cuids": [...]}                                -> {"results": [checkIn result, ...]}
+#   POST /cards           {"cuid", "firstName", "lastName", "email"}      -> addCard result
+#   GET  /visits          ?userID=&limit=&offset=&orderBy=&descending=    -> showVisits result
+#   GET  /rank            ?userID=                                        -> showRank result
+#   GET  /health                                                          -> {"status": "ok"}
+# Result dicts are the ones DB returns, with sqlError as text and times in ISO format
+
+
+class ServiceError(Exception):
+    def __init__(self, message):
+    #===========================================================================
+    # An error reported by (or reaching) the service. Has a pgerror attribute
+    # so the front ends can show it like a database error
+    #===========================================================================
+        super(ServiceError, self).__init__(message)
+        self.pgerror = message
+
+
+def toJSON(result):
+#===============================================================================
+# Make a DB result dict JSON serializable
+#===============================================================================
+    encoded = {}
+    for key, value in result.items():
+        if isinstance(value, Exception):
+            value = getattr(value, "pgerror", None) or str(value)
+        elif isinstance(value, datetime):
+            value = value.isoformat()
+        encoded[key] = value
+    return encoded
+
+
+class CheckInService(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, db, host=None, port=None, token=None):
+    #===========================================================================
+    # Headless HTTP/JSON front end to a connected DB so kiosks don't need
+    # database credentials. Requests are handled on their own threads and run
+    # on the request engine, which bounds the DB work to the connection pool
+    # If a token is set, requests must send "Authorization: Bearer <token>"
+    #===========================================================================
+        self.db = db
+        self.token = c.SERVICE_TOKEN if token is None else token
+        self.engine = Engine(db)
+
+        super(CheckInService, self).__init__((host or c.SERVICE_HOST, port if port is not None else c.SERVICE_PORT),
+                                             ServiceHandler)
+
+
+    def serve(self):
+    #===========================================================================
+    # Handle requests until interrupted
+    #===========================================================================
+        self.engine.start()
+        print("Serving check-ins on http://%s:%d" % self.server_address[:2])
+
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+            self.engine.stop()
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+    #===========================================================================
+    # Read only endpoints
+    #===========================================================================
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        engine = self.server.engine
+
+        if url.path == "/health":
+            self.reply(200, {"status": "ok"})
+        elif not self.authorized():
+            self.reply(401, {"error": "unauthorized"})
+        elif url.path == "/visits":
+            try:
+                limit = int(query.get("limit", c.VISITS_FETCH_BATCH))
+                offset = int(query.get("offset", 0))
+            except ValueError:
+                limit = offset = -1
+
+            if limit < 0 or offset < 0:
+                self.reply(400, {"error": "limit and offset must be non-negative integers"})
+                return
+
+            if query.get("orderBy", "visits") not in ("visits", "userID"):
+                self.reply(400, {"error": "orderBy must be visits or userID"})
+                return
+
+            result = engine.run(engine.showVisits(query.get("userID", ""), limit=min(limit, c.SERVICE_MAX_ROWS),
+                                                  offset=offset, orderBy=query.get("orderBy", "visits"),
+                                                  descending=query.get("descending", "1") not in ("0", "false")))
+            if result["visitsTuple"] is not None:
+                result["visitsTuple"] = [list(row) for row in result["visitsTuple"]]
+            self.reply(200, toJSON(result))
+        elif url.path == "/rank":
+            self.reply(200, toJSON(engine.run(engine.showRank(query.get("userID", "")))))
+        elif url.path in ("/top", "/trend"):
+            try:
+                start = date.fromisoformat(query["from"])
+                end = date.fromisoformat(query["to"])
+                limit = int(query.get("limit", c.LEADERBOARD_SIZE))
+            except (KeyError, ValueError):
+                self.reply(400, {"error": "from and to must be YYYY-MM-DD dates and limit an integer"})
+                return
+
+            if url.path == "/top":
+                result = engine.run(engine.topVisitors(start, end, min(limit, c.SERVICE_MAX_ROWS)))
+            else:
+                # One row per day, so bound the window like any other response
+                result = engine.run(engine.visitTrend(start, min(end, start + timedelta(days=c.SERVICE_MAX_ROWS))))
+                if result["rows"] is not None:
+                    result["rows"] = [[day.isoformat(), visits, visitors] for day, visits, visitors in result["rows"]]
+            self.reply(200, toJSON(result))
+        else:
+            self.reply(404, {"error": "not found"})
+
+
+    def do_POST(self):
+    #===========================================================================
+    # Endpoints that change the database
+    #===========================================================================
+        engine = self.server.engine
+
+        if not self.authorized():
+            self.reply(401, {"error": "unauthorized"})
+            return
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            body = None
+
+        if not isinstance(body, dict):
+            self.reply(400, {"error": "the body must be a JSON object"})
+            return
+
+        # Kiosks send the swipe's trace id so both ends log it
+        trace = self.headers.get("X-Trace-Id") or newTrace()
+
+        if self.path == "/checkin" and isinstance(body.get("cuid"), str):
+            self.reply(200, toJSON(engine.run(engine.checkIn(body["cuid"], trace))))
+        elif self.path == "/checkin/batch" and isinstance(body.get("cuids"), list):
+            CUIDs = [str(CUID) for CUID in body["cuids"]]
+            if len(CUIDs) > c.SERVICE_MAX_BATCH:
+                self.reply(400, {"error": "at most %d cuids per batch" % c.SERVICE_MAX_BATCH})
+                return
+            results = engine.run(engine.checkInBatch(CUIDs, trace)) if CUIDs else []
+            self.reply(200, {"results": [toJSON(result) for result in results]})
+        elif self.path == "/cards" and all(isinstance(body.get(key), str) for key in ("cuid", "firstName", "lastName", "email")):
+            self.reply(200, toJSON(engine.run(engine.addCard(body["cuid"], body["firstName"], body["lastName"], body["email"]))))
+        elif self.path in ("/checkin", "/checkin/batch", "/cards"):
+            self.reply(400, {"error": "missing or invalid fields"})
+        else:
+            self.reply(404, {"error": "not found"})
+
+
+    def authorized(self):
+    #===========================================================================
+    # Check the bearer token if the service has one
+    #===========================================================================
+        if not self.server.token:
+            return True
+        return hmac.compare_digest(self.headers.get("Authorization", ""), "Bearer " + self.server.token)
+
+
+    def reply(self, status, body):
+    #===========================================================================
+    # Send a JSON response
+    #===========================================================================
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def log_message(self, format, *args):
+    #===========================================================================
+    # Only log requests when asked to; a busy service would flood the console
+    #===========================================================================
+        if c.SERVICE_LOG_REQUESTS:
+            super(ServiceHandler, self).log_message(format, *args)
+
+
+class ServiceClient:
+    def __init__(self, url, token=None, timeout=None):
+    #===========================================================================
+    # Thin client with the same interface as DB for the methods the front ends
+    # use, so a kiosk can run against a CheckInService instead of Postgres
+    #===========================================================================
+        self.url = url.rstrip("/")
+        self.token = c.SERVICE_TOKEN if token is None else token
+        self.timeout = timeout or c.SERVICE_CLIENT_TIMEOUT
+
+        # The service does its own journaling and schema checks
+        self.journal = None
+        self.schemaProblems = []
+
+
+    def request(self, method, path, body=None):
+    #===========================================================================
+    # Send a request and return the decoded JSON response
+    # Raises ServiceError if the service can't be reached or refuses the request
+    #===========================================================================
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method)
+        request.add_header("Content-Type", "application/json")
+        if self.token:
+            request.add_header("Authorization", "Bearer " + self.token)
+        request.add_header("X-Trace-Id", TRACE.get())
+
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise ServiceError("Service refused the request (HTTP %d)" % e.code)
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            raise ServiceError("Could not reach the check-in service: %s" % e)
+
+
+    def decode(self, result):
+    #===========================================================================
+    # Turn a JSON result back into what DB would have returned
+    #===========================================================================
+        if result.get("sqlError") is not None:
+            result["sqlError"] = ServiceError(result["sqlError"])
+        if result.get("timeIn") is not None:
+            result["timeIn"] = datetime.fromisoformat(result["timeIn"])
+        return result
+
+
+    def connect(self):
+    #===========================================================================
+    # Check that the service is up
+    #===========================================================================
+        try:
+            self.request("GET", "/health")
+        except ServiceError as e:
+            print("\n", e)
+            return c.FAILURE
+        return c.SUCCESS
+
+
+    def close(self):
+    #===========================================================================
+    # Nothing to close; each request uses its own HTTP connection
+    #===========================================================================
+        pass
+
+
+    def warmUp(self):
+    #===========================================================================
+    # Nothing to warm up; the service keeps its own connections ready
+    #===========================================================================
+        return c.SUCCESS
+
+
+    def checkInResult(self, CUID, status, userID=None, sqlError=None, timeIn=None):
+    #===========================================================================
+    # Build the result dict returned by checkIn
+    #===========================================================================
+        return {"checkInStatus": status, "userID": userID, "CUID": CUID, "sqlError": sqlError, "timeIn": timeIn}
+
+
+    def checkIn(self, CUID):
+    #===========================================================================
+    # Same as DB.checkIn, done by the service
+    # An unreachable service gives SQL_ERROR with the ServiceError as sqlError
+    #===========================================================================
+        started = time.perf_counter()
+        try:
+            return self.decode(self.request("POST", "/checkin", {"cuid": CUID}))
+        except ServiceError as e:
+            return self.checkInResult(CUID, c.SQL_ERROR, sqlError=e)
+        finally:
+            STAGE_SECONDS.observe("service", time.perf_counter() - started)
+
+
+    def checkInBatch(self, CUIDs):
+    #===========================================================================
+    # Same as DB.checkInBatch: one request for the list of CUIDs and a
+    # result dict for each. If the request fails, every CUID gets SQL_ERROR
+    #===========================================================================
+        started = time.perf_counter()
+        try:
+            return [self.decode(result) for result in self.request("POST", "/checkin/batch", {"cuids": CUIDs})["results"]]
+        except ServiceError as e:
+            return [self.checkInResult(CUID, c.SQL_ERROR, sqlError=e) for CUID in CUIDs]
+        finally:
+            STAGE_SECONDS.observe("service", time.perf_counter() - started)
+
+
+    def addCard(self, cuid, firstName, lastName, email):
+    #===========================================================================
+    # Same as DB.addCard, including the check-in of the new card
+    #===========================================================================
+        try:
+            return self.decode(self.request("POST", "/cards", {"cuid": cuid, "firstName": firstName,
+                                                               "lastName": lastName, "email": email}))
+        except ServiceError as e:
+            return {"addCardStatus": c.SQL_ERROR, "Name": firstName, "userID": email, "CUID": cuid, "sqlError": e}
+
+
+    def showVisits(self, userID="", stream=False, limit=None, offset=0, orderBy="visits", descending=True):
+    #===========================================================================
+    # Same as DB.showVisits. Without a limit, pages are fetched until the end;
+    # with stream=True they are fetched lazily as the rows are iterated
+    #===========================================================================
+        query = {"userID": userID, "offset": offset, "orderBy": orderBy, "descending": int(descending),
+                 "limit": limit if limit is not None else c.VISITS_FETCH_BATCH}
+        try:
+            result = self.decode(self.request("GET", "/visits?" + urllib.parse.urlencode(query)))
+        except ServiceError as e:
+            return {"showVisitsStatus": c.SQL_ERROR, "visitsTuple": None, "sqlError": e}
+
+        if limit is None and result["showVisitsStatus"] == c.SUCCESS:
+            rows = self.iterPages(result["visitsTuple"], query, result)
+            result["visitsTuple"] = rows if stream else list(rows)
+        elif result["visitsTuple"] is not None:
+            result["visitsTuple"] = [tuple(row) for row in result["visitsTuple"]]
+
+        return result
+
+
+    def iterPages(self, rows, query, result):
+    #===========================================================================
+    # Yield the first page and then fetch the rest, recording errors in result
+    #===========================================================================
+        while True:
+            for row in rows:
+                yield tuple(row)
+
+            if len(rows) < query["limit"]:
+                return
+
+            query["offset"] += len(rows)
+            try:
+                page = self.decode(self.request("GET", "/visits?" + urllib.parse.urlencode(query)))
+            except ServiceError as e:
+                page = {"showVisitsStatus": c.SQL_ERROR, "sqlError": e}
+
+            if page["showVisitsStatus"] != c.SUCCESS:
+                if page["showVisitsStatus"] != c.NO_RESULTS:
+                    result["showVisitsStatus"] = page["showVisitsStatus"]
+                    result["sqlError"] = page.get("sqlError")
+                return
+            rows = page["visitsTuple"]
+
+
+    def topVisitors(self, start, end, limit=None):
+    #===========================================================================
+    # Same as DB.topVisitors. JSON has no tuples, so the rows are turned back into them
+    #===========================================================================
+        query = {"from": start.isoformat(), "to": end.isoformat(), "limit": limit or c.LEADERBOARD_SIZE}
+        try:
+            result = self.decode(self.request("GET", "/top?" + urllib.parse.urlencode(query)))
+        except ServiceError as e:
+            return {"topStatus": c.SQL_ERROR, "rows": None, "sqlError": e}
+
+        if result["rows"] is not None:
+            result["rows"] = [tuple(row) for row in result["rows"]]
+        return result
+
+
+    def visitTrend(self, start, end):
+    #===========================================================================
+    # Same as DB.visitTrend, with the days turned back into dates
+    #===========================================================================
+        query = {"from": start.isoformat(), "to": end.isoformat()}
+        try:
+            result = self.decode(self.request("GET", "/trend?" + urllib.parse.urlencode(query)))
+        except ServiceError as e:
+            return {"trendStatus": c.SQL_ERROR, "rows": None, "sqlError": e}
+
+        if result["rows"] is not None:
+            result["rows"] = [(date.fromisoformat(day), visits, visitors) for day, visits, visitors in result["rows"]]
+        return result
+
+
+    def showRank(self, userID):
+    #===========================================================================
+    # Same as DB.showRank
+    #===========================================================================
+        try:
+            return self.decode(self.request("GET", "/rank?" + urllib.parse.urlencode({"userID": userID})))
+        except ServiceError as e:
+            return {"showRankStatus": c.SQL_ERROR, "userID": userID, "visits": None, "rank": None,
+                    "total": None, "percentile": None, "sqlError": e}
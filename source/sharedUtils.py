@@ -16,22 +16,26 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>. 
 #===============================================================================
 
-import re
 import getpass
 import constants as c
+from cardReader import SwipeDecoder
 
 class Utils:
     def __init__(self):
     #===========================================================================
-    # Compile regex for CUID on Tiger One card. Do this here to avoid duplicates
+    # Card decoder for the formats in CARD_FORMATS. Do this here to avoid duplicates
     #===========================================================================
-        self.regex = re.compile("%(.+)..\?;")
+        self.decoder = SwipeDecoder()
     
     
     def sanitizeInput(self, input):
     #===========================================================================
     # Sanitize inputs to save your database
+    # Queries are parameterized, so this can be disabled with SANITIZE_INPUT
     #===========================================================================
+        if not c.SANITIZE_INPUT:
+            return input
+
         # Keep a copy of the possibly mixed-case input
         origInput = input
         input.upper()
@@ -52,17 +56,29 @@ class Utils:
     def getCardSwipe(self):
     #===========================================================================
     # Read the card swipe as a password so it doesn't show on the screen
-    # Regex the card data to find CUID
+    # Decode the card data to find CUID
     #===========================================================================
         # Read the card data as a password so it doesn't show on the screen
         CUID = self.sanitizeInput(getpass.getpass("\nWaiting for card swipe..."))
-        try:
-            # Return the card ID
-            return self.regex.search(CUID).group(1)
-        except AttributeError:
-            # If exit or back, just return to go back
-            if "exit" in CUID or "back" in CUID:
-                return c.BACK
-            # Else card read error or not a Tiger One Card
-            else:
-                return c.ERROR_READING_CARD
+
+        # Return the card ID
+        cardID = self.parseCardSwipe(CUID)
+        if cardID is not None:
+            return cardID
+        # If exit or back, just return to go back
+        elif "exit" in CUID or "back" in CUID:
+            return c.BACK
+        # Else card read error or not a Tiger One Card
+        else:
+            return c.ERROR_READING_CARD
+
+
+    def parseCardSwipe(self, cardData):
+    #===========================================================================
+    # Pull the CUID out of one swipe's raw card data, or None if it isn't there
+    #===========================================================================
+        self.decoder.reset()
+        for result in self.decoder.feed(cardData + "\n"):
+            if result != c.ERROR_READING_CARD:
+                return result
+        return None
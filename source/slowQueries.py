@@ -0,0 +1,139 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+
+import time
+import logging
+import logging.handlers
+
+# Only Postgres connections are timed, so psycopg2 is optional here
+try:
+    import psycopg2
+    import psycopg2.extensions
+except ImportError:
+    psycopg2 = None
+
+from metrics import TraceFilter
+import constants as c
+
+# Statements EXPLAIN can run. Others (BEGIN, PREPARE, DDL...) are only logged
+EXPLAINABLE = ("select", "insert", "update", "delete", "with", "values", "execute")
+
+
+class SlowQueryLog:
+    def __init__(self, threshold=None, path=None, explain=None):
+    #===========================================================================
+    # Rotating log of statements that took longer than threshold seconds, with
+    # their parameters. With explain set, each slow statement is run again
+    # under EXPLAIN (ANALYZE, BUFFERS) in a transaction that is rolled back, so
+    # the plan is captured without changing any data. A statement is explained
+    # at most once every SLOW_QUERY_EXPLAIN_GAP seconds so a slow database
+    # isn't made slower
+    #===========================================================================
+        self.threshold = c.SLOW_QUERY_THRESHOLD if threshold is None else threshold
+        self.explain = c.SLOW_QUERY_EXPLAIN if explain is None else explain
+        self.lastExplained = {}
+
+        self.log = logging.getLogger("magstripe.slowqueries")
+        self.log.setLevel(logging.INFO)
+        self.log.propagate = False
+
+        # Logging in again reuses the handler. The file is only created once something is slow
+        if not self.log.handlers:
+            handler = logging.handlers.RotatingFileHandler(path or c.SLOW_QUERY_LOG, maxBytes=c.SLOW_QUERY_LOG_BYTES,
+                                                           backupCount=c.SLOW_QUERY_LOG_BACKUPS, delay=True)
+            handler.addFilter(TraceFilter())
+            handler.setFormatter(logging.Formatter("%(asctime)s [%(trace)s] %(message)s"))
+            self.log.addHandler(handler)
+
+
+    def cursorFactory(self):
+    #===========================================================================
+    # A cursor class that times its statements, for psycopg2.connect()
+    #===========================================================================
+        slowQueries = self
+
+        class SlowQueryCursor(psycopg2.extensions.cursor):
+            def execute(self, query, vars=None):
+                started = time.perf_counter()
+                failed = True
+                try:
+                    super(SlowQueryCursor, self).execute(query, vars)
+                    failed = False
+                finally:
+                    elapsed = time.perf_counter() - started
+                    if elapsed >= slowQueries.threshold:
+                        slowQueries.record(self, query, vars, elapsed, failed)
+
+        return SlowQueryCursor
+
+
+    def record(self, cursor, query, params, elapsed, failed=False):
+    #===========================================================================
+    # Log one slow statement, with its plan if explaining is on
+    #===========================================================================
+        lines = ["%.1f ms%s: %s" % (elapsed * 1000, " (failed)" if failed else "", " ".join(str(query).split()))]
+        if params:
+            lines.append("    params: %r" % (params,))
+
+        if self.explain and not failed and self.shouldExplain(cursor, query):
+            lines += ["    " + line for line in self.explainQuery(cursor.connection, query, params)]
+
+        self.log.info("\n".join(lines))
+
+
+    def shouldExplain(self, cursor, query):
+    #===========================================================================
+    # Whether a slow statement can be explained now
+    #===========================================================================
+        # Named (server side) cursors are in the middle of being read
+        if cursor.name is not None or not query.lstrip().lower().startswith(EXPLAINABLE):
+            return False
+        # A failed transaction can't run anything until it is rolled back
+        if cursor.connection.info.transaction_status not in (psycopg2.extensions.TRANSACTION_STATUS_IDLE,
+                                                              psycopg2.extensions.TRANSACTION_STATUS_INTRANS):
+            return False
+
+        now = time.monotonic()
+        if now - self.lastExplained.get(query, -c.SLOW_QUERY_EXPLAIN_GAP) < c.SLOW_QUERY_EXPLAIN_GAP:
+            return False
+        self.lastExplained[query] = now
+        return True
+
+
+    def explainQuery(self, conn, query, params):
+    #===========================================================================
+    # Run a statement under EXPLAIN ANALYZE and undo it. Inside a transaction a
+    # savepoint is rolled back instead, leaving the transaction as it was
+    # Returns the plan lines, or the error if it could not be explained
+    #===========================================================================
+        inTransaction = conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        # A plain cursor, so the EXPLAIN isn't timed and logged itself
+        cursor = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+        try:
+            cursor.execute("SAVEPOINT slow_query_explain;" if inTransaction else "BEGIN;")
+            try:
+                cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params)
+                return [row[0] for row in cursor.fetchall()]
+            finally:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain; RELEASE SAVEPOINT slow_query_explain;"
+                               if inTransaction else "ROLLBACK;")
+        except psycopg2.Error as e:
+            return ["EXPLAIN failed: %s" % str(e).strip()]
+        finally:
+            cursor.close()
@@ -0,0 +1,703 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import io
+import csv
+import gzip
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+from storage import Storage
+from metrics import STAGE_SECONDS, DB_ERRORS, log
+import constants as c
+
+
+class SQLiteError(Exception):
+    def __init__(self, error):
+    #===========================================================================
+    # A SQLite error with a pgerror attribute so the front ends can show it
+    # like a Postgres error
+    #===========================================================================
+        super(SQLiteError, self).__init__(str(error))
+        self.pgerror = str(error)
+
+
+def toTimestamp(value):
+#===============================================================================
+# Timestamps are stored as fixed width ISO text so they sort and compare as text
+#===============================================================================
+    return value.isoformat(" ", "microseconds") if value is not None else None
+
+
+def fromTimestamp(text):
+#===============================================================================
+# Read back a timestamp written by toTimestamp
+#===============================================================================
+    return datetime.fromisoformat(text) if text is not None else None
+
+
+class SQLiteDB(Storage):
+    def __init__(self, dbPath, dbUsersTable, dbVisitsTable):
+    #===========================================================================
+    # Storage backend that keeps the users and visits tables in a local SQLite
+    # file instead of on a Postgres server, with the same schema, result dicts
+    # and status codes as DB. Check-ins are an in-process transaction, so no
+    # server, login or network is needed
+    # Each thread gets its own connection. The file is in WAL mode so reads
+    # never wait for the writer, and write transactions take the write lock up
+    # front (BEGIN IMMEDIATE), waiting up to SQLITE_BUSY_TIMEOUT for another
+    # writer before giving up with DB_BUSY
+    #===========================================================================
+        super(SQLiteDB, self).__init__(dbUsersTable, dbVisitsTable)
+        self.dbPath = dbPath
+        # No user cache (reading a user is as cheap as the cache, and other
+        # programs may write the file) and no partitioning, which SQLite lacks
+
+        self.local = threading.local()
+        self.connections = []
+        self.connLock = threading.Lock()
+        self.opened = False
+        self.registerStatements()
+
+
+    def registerStatements(self):
+    #===========================================================================
+    # Build the queries used by this class. sqlite3 keeps a per-connection cache
+    # of compiled statements, so each is prepared once per connection
+    #===========================================================================
+        names = self.schemaNames()
+
+        self.queries = {
+            "addCard": """INSERT INTO %(users)s (%(cuidCol)s, %(firstCol)s, %(lastNameCol)s, %(emailCol)s, %(visitCol)s)
+                          VALUES (?, ?, ?, ?, ?);""" % names,
+
+            "checkInUser": """SELECT %(emailCol)s, %(lastCol)s, %(visitCol)s FROM %(users)s
+                              WHERE %(cuidCol)s = ?;""" % names,
+
+            "checkInUpdate": """UPDATE %(users)s SET %(lastCol)s = ?, %(visitCol)s = ? WHERE %(cuidCol)s = ?;""" % names,
+
+            "checkInVisit": """INSERT INTO %(visits)s (%(vCuidCol)s, %(vTimeCol)s, %(vVisitCol)s)
+                               VALUES (?, ?, ?);""" % names,
+
+            # Rollups. Nothing changes if the user already has a row for the day,
+            # so a failed update means a new visitor
+            "rollupUserDay": """UPDATE %(byUserDay)s SET visits = visits + 1 WHERE day = ? AND %(vCuidCol)s = ?;""" % names,
+
+            "rollupNewUserDay": """INSERT INTO %(byUserDay)s (day, %(vCuidCol)s, visits) VALUES (?, ?, 1);""" % names,
+
+            "rollupDay": """INSERT INTO %(byDay)s (day, visits, visitors) VALUES (?, 1, ?)
+                            ON CONFLICT (day) DO UPDATE
+                            SET visits = visits + 1, visitors = visitors + excluded.visitors;""" % names,
+
+            "topVisitors": """SELECT u.%(emailCol)s, r.visits, r.days
+                              FROM (SELECT %(vCuidCol)s AS cuid, sum(visits) AS visits, count(*) AS days FROM %(byUserDay)s
+                                    WHERE day >= ? AND day < ?
+                                    GROUP BY %(vCuidCol)s ORDER BY 2 DESC, 1 LIMIT ?) r
+                              JOIN %(users)s u ON u.%(cuidCol)s = r.cuid
+                              ORDER BY r.visits DESC, u.%(emailCol)s;""" % names,
+
+            "visitTrend": """SELECT day, visits, visitors FROM %(byDay)s WHERE day >= ? AND day < ? ORDER BY day;""" % names,
+
+            # Counted with the visit_num index; fine for the size of a local database
+            "showRank": """SELECT u.%(emailCol)s, u.%(visitCol)s,
+                                  (SELECT count(*) FROM %(users)s a WHERE a.%(visitCol)s > u.%(visitCol)s) + 1,
+                                  (SELECT count(*) FROM %(users)s),
+                                  (SELECT count(*) FROM %(users)s a WHERE a.%(visitCol)s <= u.%(visitCol)s)
+                           FROM %(users)s u WHERE u.%(emailCol)s = ? LIMIT 1;""" % names,
+
+            # The last row for a CUID wins if a roster lists it more than once
+            "importRoster": """INSERT INTO %(users)s (%(cuidCol)s, %(firstCol)s, %(lastNameCol)s, %(emailCol)s, %(visitCol)s)
+                               VALUES (?, ?, ?, ?, ?)
+                               ON CONFLICT (%(cuidCol)s) DO UPDATE
+                               SET %(firstCol)s = excluded.%(firstCol)s, %(lastNameCol)s = excluded.%(lastNameCol)s,
+                                   %(emailCol)s = excluded.%(emailCol)s;""" % names,
+        }
+
+
+    def connect(self):
+    #===========================================================================
+    # Open the database file, creating it and its tables if it is new
+    #===========================================================================
+        self.opened = True
+
+        try:
+            missingTables, missingIndexes = self.findMissingSchema()
+            if missingTables:
+                self.initSchema()
+            else:
+                self.schemaProblems = self.checkSchema()
+        except sqlite3.Error as e:
+            print("\n", e)
+            self.close()
+            return c.FAILURE
+
+        if c.GROUP_COMMIT:
+            self.enableGroupCommit(c.GROUP_COMMIT_WINDOW, c.GROUP_COMMIT_MAX)
+
+        return c.SUCCESS
+
+
+    def newConnection(self):
+    #===========================================================================
+    # Open a connection to the database file with the tuned pragmas
+    #===========================================================================
+        if not self.opened:
+            raise sqlite3.ProgrammingError("Not connected to the database")
+
+        # Autocommit; write transactions are begun explicitly by transaction()
+        conn = sqlite3.connect(self.dbPath, timeout=c.SQLITE_BUSY_TIMEOUT, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL;")
+        # In WAL mode NORMAL only syncs at checkpoints: a crash of the program loses nothing
+        conn.execute("PRAGMA synchronous = %s;" % c.SQLITE_SYNCHRONOUS)
+        conn.execute("PRAGMA foreign_keys = ON;")
+        conn.execute("PRAGMA cache_size = -%d;" % c.SQLITE_CACHE_SIZE)
+        conn.execute("PRAGMA mmap_size = %d;" % c.SQLITE_MMAP_SIZE)
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        return conn
+
+
+    def connection(self):
+    #===========================================================================
+    # This thread's connection, opened on first use
+    #===========================================================================
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.newConnection()
+            self.local.conn = conn
+            with self.connLock:
+                self.connections.append(conn)
+        return conn
+
+
+    @contextmanager
+    def transaction(self):
+    #===========================================================================
+    # Run the body of a with statement as one write transaction
+    #===========================================================================
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            yield conn
+        except BaseException:
+            # SQLite has already rolled back after some errors
+            if conn.in_transaction:
+                conn.execute("ROLLBACK;")
+            raise
+        conn.execute("COMMIT;")
+
+
+    def isBusy(self, error):
+    #===========================================================================
+    # Whether an error means another writer held the lock for too long
+    #===========================================================================
+        return isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error))
+
+
+    def errorStatus(self, error):
+    #===========================================================================
+    # The status code and sqlError for a failed query
+    #===========================================================================
+        if self.isBusy(error):
+            return c.DB_BUSY, None
+        return c.SQL_ERROR, SQLiteError(error)
+
+
+    def close(self):
+    #===========================================================================
+    # Close every thread's connection
+    #===========================================================================
+        super(SQLiteDB, self).close()
+
+        with self.connLock:
+            self.opened = False
+            connections = self.connections
+            self.connections = []
+
+        for i, conn in enumerate(connections):
+            try:
+                # Let SQLite refresh any statistics the queries would benefit from
+                if i == 0:
+                    conn.execute("PRAGMA optimize;")
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+
+    def findMissingSchema(self):
+    #===========================================================================
+    # Look up which tables and schemaIndexes() entries don't exist
+    # Returns (missing table names, missing schemaIndexes() entries)
+    #===========================================================================
+        conn = self.connection()
+        missingTables = []
+        indexes = {}
+
+        for table in self.schemaTableNames():
+            if conn.execute("""SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;""", (table,)).fetchone() is None:
+                missingTables.append(table)
+                continue
+
+            # Column names of every index on the table (including primary keys), in index order
+            indexes[table] = [tuple(column[2] for column in conn.execute("""PRAGMA index_info("%s");""" % index[1]))
+                              for index in conn.execute("""PRAGMA index_list("%s");""" % table).fetchall()]
+
+        return missingTables, self.findMissingIndexes(indexes)
+
+
+    def visitsPartitioned(self):
+    #===========================================================================
+    # The visits table is a single table in SQLite
+    #===========================================================================
+        return False
+
+
+    def maintainPartitions(self, now=None):
+    #===========================================================================
+    # Nothing to maintain without partitions
+    #===========================================================================
+        return {"partitionStatus": c.FAILURE, "created": [], "retired": [], "moved": 0, "sqlError": None}
+
+
+    def convertVisitsToPartitions(self):
+    #===========================================================================
+    # SQLite can't partition the visits table
+    #===========================================================================
+        return self.maintainPartitions()
+
+
+    def initSchema(self):
+    #===========================================================================
+    # Create the users and visits tables and their indexes if they don't exist
+    # Safe to run again on an existing database; only missing pieces are added
+    #===========================================================================
+        status = c.SUCCESS
+        sqlError = None
+        problems = []
+
+        try:
+            newRollups = any(table in self.findMissingSchema()[0] for table in self.rollupTableNames())
+
+            with self.transaction() as conn:
+                for createTable in self.schemaTables():
+                    conn.execute(createTable)
+
+            # Fill new rollup tables from the visits already recorded
+            if newRollups:
+                backfillResult = self.backfillRollups()
+                if backfillResult["backfillStatus"] != c.SUCCESS:
+                    status, sqlError = backfillResult["backfillStatus"], backfillResult["sqlError"]
+
+            # Tables created above already have their keys; only add what is still missing
+            missingTables, missingIndexes = self.findMissingSchema()
+            with self.transaction() as conn:
+                for table, columns, createIndex in missingIndexes:
+                    conn.execute(createIndex)
+            conn.execute("""ANALYZE;""")
+
+            problems = self.checkSchema()
+        except sqlite3.Error as e:
+            status, sqlError = self.errorStatus(e)
+
+        self.schemaProblems = problems
+        return {"initSchemaStatus": status, "problems": problems, "sqlError": sqlError}
+
+
+    def addCard(self, cuid, firstName, lastName, email):
+    #===========================================================================
+    # add a CUID and userID to the database
+    #===========================================================================
+        try:
+            with self.transaction() as conn:
+                conn.execute(self.queries["addCard"], (cuid, firstName, lastName, email, c.DEFAULT_VISITS))
+        except sqlite3.Error as e:
+            status, sqlError = self.errorStatus(e)
+            return {"addCardStatus": status, "Name": firstName, "userID": email, "CUID": cuid, "sqlError": sqlError}
+
+        checkInResult = self.checkIn(cuid)
+
+        return {"addCardStatus": checkInResult["checkInStatus"], "Name": firstName, "userID": checkInResult["userID"],
+                "CUID": cuid, "sqlError": checkInResult["sqlError"]}
+
+
+    def checkInBatch(self, CUIDs, times=None):
+    #===========================================================================
+    # Check in a list of CUIDs in one transaction and return a result dict for
+    # each. If the transaction fails each CUID is retried on its own so one bad
+    # swipe can't fail the rest of the group
+    # times optionally gives each check-in's time instead of the local clock
+    #===========================================================================
+        if times is None:
+            times = [None] * len(CUIDs)
+
+        rows = []
+
+        started = time.perf_counter()
+        try:
+            with self.transaction() as conn:
+                for CUID, timeIn in zip(CUIDs, times):
+                    rows.append(self.checkInRow(conn, CUID, timeIn))
+        except sqlite3.Error as e:
+            status, sqlError = self.errorStatus(e)
+            DB_ERRORS.inc("busy" if status == c.DB_BUSY else "sql")
+            log.warning("check-in failed: %s", e)
+            if status == c.SQL_ERROR and len(CUIDs) > 1:
+                return [self.checkInBatch([CUID], [timeIn])[0] for CUID, timeIn in zip(CUIDs, times)]
+            return [self.checkInResult(CUID, status, sqlError=sqlError) for CUID in CUIDs]
+
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe("db", elapsed)
+        log.debug("%d check-ins took %.1f ms in the database", len(CUIDs), elapsed * 1000)
+        return self.checkInResults(CUIDs, rows)
+
+
+    def checkInRow(self, conn, CUID, timeIn):
+    #===========================================================================
+    # Apply the hour rule and record the visit for one CUID inside a write
+    # transaction. Returns the same row as the Postgres check-in query, or None
+    # if the card is unknown. The write lock is held, so reading the visit
+    # count and writing it back can't race another kiosk
+    #===========================================================================
+        row = conn.execute(self.queries["checkInUser"], (CUID,)).fetchone()
+        if row is None:
+            return None
+
+        userID, lastCheckIn, visitNum = row[0], fromTimestamp(row[1]), row[2]
+        now = timeIn or datetime.now()
+
+        if not (c.ALLOW_CHECKIN_WITHIN_HOUR or lastCheckIn is None or lastCheckIn <= now - timedelta(hours=1)):
+            return userID, lastCheckIn, now, None
+
+        visitNum = (visitNum or 0) + 1
+        conn.execute(self.queries["checkInUpdate"], (toTimestamp(now), visitNum, CUID))
+        conn.execute(self.queries["checkInVisit"], (CUID, toTimestamp(now), visitNum))
+
+        day = now.date().isoformat()
+        newVisitor = conn.execute(self.queries["rollupUserDay"], (day, CUID)).rowcount == 0
+        if newVisitor:
+            conn.execute(self.queries["rollupNewUserDay"], (day, CUID))
+        conn.execute(self.queries["rollupDay"], (day, int(newVisitor)))
+
+        return userID, lastCheckIn, now, visitNum
+
+
+    def showRank(self, userID):
+    #===========================================================================
+    # Visit count, rank (1 is the most visits; ties share a rank) and
+    # percentile (share of users with as many visits or fewer) of one user
+    #===========================================================================
+        rankResult = {"showRankStatus": c.FAILURE, "userID": userID, "visits": None, "rank": None,
+                      "total": None, "percentile": None, "sqlError": None}
+
+        try:
+            row = self.connection().execute(self.queries["showRank"], (userID,)).fetchone()
+        except sqlite3.Error as e:
+            rankResult["showRankStatus"], rankResult["sqlError"] = self.errorStatus(e)
+            return rankResult
+
+        if row is None:
+            rankResult["showRankStatus"] = c.NO_RESULTS
+            return rankResult
+
+        userID, visits, rank, total, atOrBelow = row
+        rankResult.update({"showRankStatus": c.SUCCESS, "userID": userID, "visits": visits, "rank": rank,
+                           "total": total, "percentile": 100.0 * atOrBelow / total})
+        return rankResult
+
+
+    def warmUp(self):
+    #===========================================================================
+    # Read the users table once so its pages are in the OS cache (and the
+    # memory map) before the first swipe. Returns SUCCESS or FAILURE
+    #===========================================================================
+        try:
+            self.connection().execute("""SELECT count(*) FROM %s;""" % self.dbUsersTable).fetchone()
+        except sqlite3.Error:
+            return c.FAILURE
+        return c.SUCCESS
+
+
+    def hasRollups(self):
+    #===========================================================================
+    # connect() creates any missing tables, so the rollups are always there
+    #===========================================================================
+        return True
+
+
+    def backfillRollups(self):
+    #===========================================================================
+    # Rebuild the rollup tables from the visits table in one transaction
+    #===========================================================================
+        names = self.schemaNames()
+        backfillResult = {"backfillStatus": c.SUCCESS, "days": 0, "sqlError": None}
+
+        try:
+            with self.transaction() as conn:
+                conn.execute("""DELETE FROM %(byUserDay)s;""" % names)
+                conn.execute("""DELETE FROM %(byDay)s;""" % names)
+                # Timestamps are ISO text, so the day is the first 10 characters
+                conn.execute("""INSERT INTO %(byUserDay)s (day, %(vCuidCol)s, visits)
+                                SELECT substr(%(vTimeCol)s, 1, 10), %(vCuidCol)s, count(*) FROM %(visits)s GROUP BY 1, 2;""" % names)
+                backfillResult["days"] = conn.execute("""INSERT INTO %(byDay)s (day, visits, visitors)
+                                                         SELECT day, sum(visits), count(*) FROM %(byUserDay)s
+                                                         GROUP BY day;""" % names).rowcount
+        except sqlite3.Error as e:
+            backfillResult["backfillStatus"], backfillResult["sqlError"] = self.errorStatus(e)
+
+        return backfillResult
+
+
+    def topVisitors(self, start, end, limit=None):
+    #===========================================================================
+    # The users with the most visits on the days start <= day < end
+    #===========================================================================
+        topResult = {"topStatus": c.SUCCESS, "rows": None, "sqlError": None}
+
+        try:
+            topResult["rows"] = self.connection().execute(self.queries["topVisitors"],
+                                                          (start.isoformat(), end.isoformat(),
+                                                           limit or c.LEADERBOARD_SIZE)).fetchall()
+        except sqlite3.Error as e:
+            topResult["topStatus"], topResult["sqlError"] = self.errorStatus(e)
+
+        if topResult["rows"] == []:
+            topResult["topStatus"] = c.NO_RESULTS
+        return topResult
+
+
+    def visitTrend(self, start, end):
+    #===========================================================================
+    # Visits and distinct visitors for each day start <= day < end
+    #===========================================================================
+        trendResult = {"trendStatus": c.SUCCESS, "rows": None, "sqlError": None}
+
+        try:
+            rows = self.connection().execute(self.queries["visitTrend"], (start.isoformat(), end.isoformat())).fetchall()
+            trendResult["rows"] = self.fillDays([(date.fromisoformat(day), visits, visitors)
+                                                 for day, visits, visitors in rows], start, end)
+        except sqlite3.Error as e:
+            trendResult["trendStatus"], trendResult["sqlError"] = self.errorStatus(e)
+
+        return trendResult
+
+
+    def visitsQuery(self, userID, limit, offset, orderBy, descending):
+    #===========================================================================
+    # The query and parameters for showVisits
+    #===========================================================================
+        names = dict(self.schemaNames(), direction="DESC" if descending else "ASC")
+        params = []
+
+        if userID == "":
+            # Break ties by user ID so limit/offset pages are stable
+            if orderBy == "userID":
+                query = "SELECT %(emailCol)s, %(visitCol)s FROM %(users)s ORDER BY %(emailCol)s %(direction)s" % names
+            else:
+                query = "SELECT %(emailCol)s, %(visitCol)s FROM %(users)s ORDER BY %(visitCol)s %(direction)s, %(emailCol)s" % names
+        else:
+            query = "SELECT %(emailCol)s, %(visitCol)s FROM %(users)s WHERE %(emailCol)s = ?" % names
+            params.append(userID)
+
+        # SQLite only takes an OFFSET after a LIMIT; -1 is no limit
+        if limit is not None or offset:
+            query += " LIMIT ? OFFSET ?"
+            params += [limit if limit is not None else -1, offset]
+
+        return query + ";", params
+
+
+    def showVisits(self, userID="", stream=False, limit=None, offset=0, orderBy="visits", descending=True):
+    #===========================================================================
+    # Check visits associated with userID and return value
+    # With stream=True visitsTuple is an iterator that fetches rows in batches
+    # instead of a list of every row. A stream has its own connection, closed
+    # when the rows run out, since it may be read on another thread
+    # orderBy ("visits" or "userID") and descending pick the order
+    #===========================================================================
+        query, params = self.visitsQuery(userID, limit, offset, orderBy, descending)
+        showVisitsResult = {"showVisitsStatus": c.SUCCESS, "visitsTuple": None, "sqlError": None}
+
+        try:
+            if not stream:
+                rows = self.connection().execute(query, params).fetchall()
+                if rows:
+                    showVisitsResult["visitsTuple"] = rows
+                else:
+                    showVisitsResult["showVisitsStatus"] = c.NO_RESULTS
+                return showVisitsResult
+
+            conn = self.newConnection()
+            try:
+                cursor = conn.execute(query, params)
+                # Fetch the first row to tell an empty result from a full one
+                first = cursor.fetchone()
+            except sqlite3.Error:
+                conn.close()
+                raise
+
+            if first is None:
+                conn.close()
+                showVisitsResult["showVisitsStatus"] = c.NO_RESULTS
+            else:
+                showVisitsResult["visitsTuple"] = self.streamRows(conn, cursor, first, showVisitsResult)
+        except sqlite3.Error as e:
+            showVisitsResult["showVisitsStatus"], showVisitsResult["sqlError"] = self.errorStatus(e)
+
+        return showVisitsResult
+
+
+    def streamRows(self, conn, cursor, first, showVisitsResult):
+    #===========================================================================
+    # Yield the first row and then the rest, recording errors in the result
+    #===========================================================================
+        try:
+            yield first
+            while True:
+                rows = cursor.fetchmany(c.VISITS_FETCH_BATCH)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        except sqlite3.Error as e:
+            showVisitsResult["showVisitsStatus"], showVisitsResult["sqlError"] = self.errorStatus(e)
+        finally:
+            conn.close()
+
+
+    def scanVisits(self, consume, start=None, end=None, batchSize=None):
+    #===========================================================================
+    # Read the visits table as (CUID, seconds since the epoch) rows on a
+    # connection of its own and pass them to consume batchSize rows at a time
+    #===========================================================================
+        names = {"visits": self.dbVisitsTable, "cuidCol": c.CUID_COLUMN_VISIT, "timeCol": c.TIMEIN_COLUMN_VISIT}
+        batchSize = batchSize or c.REPORT_FETCH_BATCH
+
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append('%(timeCol)s >= ?' % names)
+            params.append(toTimestamp(start))
+        if end is not None:
+            conditions.append('%(timeCol)s < ?' % names)
+            params.append(toTimestamp(end))
+        names["where"] = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+
+        status = c.SUCCESS
+        rows = 0
+        sqlError = None
+
+        try:
+            conn = self.newConnection()
+            try:
+                cursor = conn.execute("""SELECT %(cuidCol)s, CAST(strftime('%%s', %(timeCol)s) AS INTEGER)
+                                         FROM %(visits)s %(where)s;""" % names, params)
+                while True:
+                    batch = cursor.fetchmany(batchSize)
+                    if not batch:
+                        break
+                    consume(batch)
+                    rows += len(batch)
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            status, sqlError = self.errorStatus(e)
+
+        return {"scanStatus": status, "rows": rows, "sqlError": sqlError}
+
+
+    def importRosterBatch(self, batch, lastLine, checkpointPath, importResult):
+    #===========================================================================
+    # Upsert one batch of [line number, CUID, first, last, email] rows in one
+    # transaction and save a checkpoint. Returns False if the import must stop
+    #===========================================================================
+        try:
+            with self.transaction() as conn:
+                conn.executemany(self.queries["importRoster"],
+                                 [(CUID, firstName, lastName, email, c.DEFAULT_VISITS)
+                                  for lineNum, CUID, firstName, lastName, email in batch])
+        except sqlite3.Error as e:
+            importResult["importStatus"], importResult["sqlError"] = self.errorStatus(e)
+            return False
+
+        importResult["imported"] += len(batch)
+        self.writeCheckpoint(checkpointPath, lastLine)
+        return True
+
+
+    def exportVisits(self, path, fmt="csv", start=None, end=None, CUID=None, compress=False):
+    #===========================================================================
+    # Write the visits table to a CSV or JSON Lines file in the same format as
+    # the Postgres export, optionally limited to start <= timein < end and/or
+    # one CUID, and optionally gzipped. Rows are written as they are read
+    #===========================================================================
+        names = {"visits": self.dbVisitsTable, "cuidCol": c.CUID_COLUMN_VISIT,
+                 "timeCol": c.TIMEIN_COLUMN_VISIT, "visitCol": c.VISIT_NUM_COLUMN_VISIT}
+
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append("%(timeCol)s >= ?" % names)
+            params.append(toTimestamp(start))
+        if end is not None:
+            conditions.append("%(timeCol)s < ?" % names)
+            params.append(toTimestamp(end))
+        if CUID is not None:
+            conditions.append("%(cuidCol)s = ?" % names)
+            params.append(CUID)
+        names["where"] = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+
+        query = """SELECT %(cuidCol)s, %(timeCol)s, %(visitCol)s FROM %(visits)s %(where)s ORDER BY %(timeCol)s;""" % names
+
+        status = c.SUCCESS
+        sqlError = None
+
+        rawFile = None
+        textFile = None
+
+        try:
+            rawFile = open(path, "wb")
+            outFile = gzip.GzipFile(fileobj=rawFile, mode="wb") if compress else rawFile
+            textFile = io.TextIOWrapper(outFile, encoding="utf-8", newline="")
+
+            rows = self.connection().execute(query, params)
+
+            if fmt == "jsonl":
+                for CUID, timeIn, visitNum in rows:
+                    textFile.write(json.dumps({names["cuidCol"]: CUID, names["timeCol"]: timeIn.replace(" ", "T"),
+                                               names["visitCol"]: visitNum}) + "\n")
+            else:
+                writer = csv.writer(textFile, lineterminator="\n")
+                writer.writerow([names["cuidCol"], names["timeCol"], names["visitCol"]])
+                writer.writerows(rows)
+        except sqlite3.Error as e:
+            status, sqlError = self.errorStatus(e)
+        except OSError:
+            # The file couldn't be created or written
+            status = c.FAILURE
+        finally:
+            # Closing the text and gzip streams flushes them; rawFile is closed separately
+            if textFile is not None:
+                textFile.close()
+            if rawFile is not None:
+                rawFile.close()
+
+        return {"exportStatus": status, "path": path, "sqlError": sqlError}
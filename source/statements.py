@@ -0,0 +1,115 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import re
+import threading
+
+# Statements are only executed on Postgres connections, so psycopg2 is optional here
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+
+class StatementRegistry:
+    def __init__(self, prefix="magstripe"):
+    #===========================================================================
+    # Registry of named queries that are prepared once per connection on the
+    # server and then executed with bound parameters
+    #===========================================================================
+        self.prefix = prefix
+        # Name -> (query text with $n placeholders, ordered parameter names)
+        self.statements = {}
+        # id(connection) -> set of statement names prepared on that connection
+        self.prepared = {}
+        self.lock = threading.Lock()
+
+
+    def register(self, name, query):
+    #===========================================================================
+    # Register a query. Parameters are written as %(name)s like psycopg2 and are
+    # rewritten to positional $n placeholders for PREPARE
+    #===========================================================================
+        params = []
+
+        def toPositional(match):
+            if match.group(1) not in params:
+                params.append(match.group(1))
+            return "$%d" % (params.index(match.group(1)) + 1)
+
+        # Unescape literal percent signs after rewriting the placeholders
+        query = re.sub(r"%\((\w+)\)s", toPositional, query).replace("%%", "%")
+        self.statements[name] = (query.strip().rstrip(";"), params)
+
+
+    def serverName(self, name):
+    #===========================================================================
+    # Name of the prepared statement on the server
+    #===========================================================================
+        return "%s_%s" % (self.prefix, name)
+
+
+    def prepare(self, cursor, name):
+    #===========================================================================
+    # Prepare a statement on the cursor's connection if it is not already
+    #===========================================================================
+        connID = id(cursor.connection)
+
+        with self.lock:
+            if name in self.prepared.get(connID, ()):
+                return
+
+        query = self.statements[name][0]
+        cursor.execute("PREPARE %s AS %s;" % (self.serverName(name), query))
+
+        with self.lock:
+            self.prepared.setdefault(connID, set()).add(name)
+
+
+    def execute(self, cursor, name, params=None):
+    #===========================================================================
+    # Execute a registered statement with the given parameter dict
+    #===========================================================================
+        params = params or {}
+        paramNames = self.statements[name][1]
+
+        self.prepare(cursor, name)
+
+        if paramNames:
+            placeholders = ", ".join(["%s"] * len(paramNames))
+            query = "EXECUTE %s (%s);" % (self.serverName(name), placeholders)
+        else:
+            query = "EXECUTE %s;" % self.serverName(name)
+
+        values = [params[param] for param in paramNames]
+
+        try:
+            cursor.execute(query, values)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # The server dropped our statements (e.g. DISCARD ALL). Prepare again and retry once
+            self.forget(cursor.connection)
+            self.prepare(cursor, name)
+            cursor.execute(query, values)
+
+
+    def forget(self, conn):
+    #===========================================================================
+    # Forget all statements prepared on a connection (call when closing it)
+    #===========================================================================
+        with self.lock:
+            self.prepared.pop(id(conn), None)
@@ -0,0 +1,581 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import os
+import csv
+from datetime import datetime, timedelta
+
+from groupCommit import GroupCommitter
+from metrics import GROUP_COMMIT_PENDING
+import constants as c
+
+# Storage backends. Each is a Storage subclass with the same result dicts and
+# status codes, so the front ends and the engine don't care where the data lives
+#   postgres    dbUtil.DB, tables on a Postgres server (needs psycopg2)
+#   sqlite      sqliteDB.SQLiteDB, tables in a local file (no server or login)
+# service.ServiceClient offers the same calls on top of a check-in service
+BACKENDS = ["postgres", "sqlite"]
+
+
+class Storage:
+    def __init__(self, dbUsersTable, dbVisitsTable):
+    #===========================================================================
+    # Base class of the storage backends. It holds the schema description,
+    # check-in bookkeeping, group commit and roster import shared by every
+    # backend; the methods that raise NotImplementedError are what a backend
+    # has to provide
+    #===========================================================================
+        self.dbUsersTable = dbUsersTable
+        self.dbVisitsTable = dbVisitsTable
+        self.groupCommitter = None
+        self.userCache = None
+        # Offline journal for swipes the database couldn't take, if the backend keeps one
+        self.journal = None
+        # Create new visits tables partitioned by month
+        self.partitionVisits = False
+        # Whether check-ins update the rollup tables (they exist in this database)
+        self.rollups = False
+        # Missing tables and indexes found at connect (see checkSchema)
+        self.schemaProblems = []
+
+
+    def schemaNames(self):
+    #===========================================================================
+    # Table and column names for building schema DDL
+    #===========================================================================
+        byUserDay, byDay = self.rollupTableNames()
+
+        return {"users": self.dbUsersTable, "visits": self.dbVisitsTable,
+                "cuidCol": c.CUID_COLUMN_USER, "firstCol": c.FIRST_NAME_COLUMN_USER,
+                "lastNameCol": c.LAST_NAME_COLUMN_USER, "emailCol": c.EMAIL_COLUMN_USER,
+                "lastCol": c.LAST_CHECKIN_COLUMN_USER, "visitCol": c.VISIT_NUM_COLUMN_USER,
+                "vCuidCol": c.CUID_COLUMN_VISIT, "vTimeCol": c.TIMEIN_COLUMN_VISIT,
+                "vVisitCol": c.VISIT_NUM_COLUMN_VISIT,
+                "byUserDay": byUserDay, "byDay": byDay}
+
+
+    def schemaTableNames(self):
+    #===========================================================================
+    # Every table in the schema, in the order schemaTables() creates them
+    #===========================================================================
+        return [self.dbUsersTable, self.dbVisitsTable] + self.rollupTableNames()
+
+
+    def rollupTableNames(self):
+    #===========================================================================
+    # The rollup tables: visits per user per day, and visits and visitors per day
+    #===========================================================================
+        return [self.dbVisitsTable + "_by_user_day", self.dbVisitsTable + "_by_day"]
+
+
+    def schemaTables(self, partitioned=None):
+    #===========================================================================
+    # CREATE TABLE statements for the users and visits tables and the rollups
+    # kept from the visits. The visits table is partitioned by month if
+    # partitionVisits is set (or partitioned is True)
+    #===========================================================================
+        names = self.schemaNames()
+        partitioned = self.partitionVisits if partitioned is None else partitioned
+        names["partitionBy"] = " PARTITION BY RANGE (%(vTimeCol)s)" % names if partitioned else ""
+
+        return ["""CREATE TABLE IF NOT EXISTS %(users)s (
+                       %(cuidCol)s varchar PRIMARY KEY,
+                       %(firstCol)s text,
+                       %(lastNameCol)s text,
+                       %(emailCol)s varchar NOT NULL,
+                       %(visitCol)s int NOT NULL DEFAULT 0,
+                       %(lastCol)s timestamp
+                   );""" % names,
+                """CREATE TABLE IF NOT EXISTS %(visits)s (
+                       %(vCuidCol)s varchar NOT NULL REFERENCES %(users)s (%(cuidCol)s)
+                           ON UPDATE CASCADE ON DELETE CASCADE,
+                       %(vTimeCol)s timestamp NOT NULL,
+                       %(vVisitCol)s int NOT NULL,
+                       PRIMARY KEY (%(vCuidCol)s, %(vTimeCol)s)
+                   )%(partitionBy)s;""" % names,
+                # The leaderboard reads a range of days, so day leads the key
+                """CREATE TABLE IF NOT EXISTS %(byUserDay)s (
+                       day date NOT NULL,
+                       %(vCuidCol)s varchar NOT NULL,
+                       visits int NOT NULL,
+                       PRIMARY KEY (day, %(vCuidCol)s)
+                   );""" % names,
+                """CREATE TABLE IF NOT EXISTS %(byDay)s (
+                       day date PRIMARY KEY,
+                       visits int NOT NULL,
+                       visitors int NOT NULL
+                   );""" % names]
+
+
+    def schemaIndexes(self):
+    #===========================================================================
+    # The indexes the queries in this class rely on, as (table, leading columns,
+    # CREATE INDEX statement). Any index starting with those columns will do
+    #===========================================================================
+        names = self.schemaNames()
+
+        return [
+            # checkIn, addCard and the roster import upsert look users up by CUID
+            (self.dbUsersTable, (c.CUID_COLUMN_USER,),
+             "CREATE UNIQUE INDEX IF NOT EXISTS %(users)s_cuid_key ON %(users)s (%(cuidCol)s);" % names),
+            # showVisits and showRank for one user, and the standings sorted by user ID
+            (self.dbUsersTable, (c.EMAIL_COLUMN_USER,),
+             "CREATE INDEX IF NOT EXISTS %(users)s_email_idx ON %(users)s (%(emailCol)s);" % names),
+            # The standings (ORDER BY visits DESC, user ID) and showRank
+            (self.dbUsersTable, (c.VISIT_NUM_COLUMN_USER,),
+             "CREATE INDEX IF NOT EXISTS %(users)s_visit_num_idx ON %(users)s (%(visitCol)s DESC, %(emailCol)s);" % names),
+            # Journal replay duplicate check and exports filtered by CUID
+            (self.dbVisitsTable, (c.CUID_COLUMN_VISIT, c.TIMEIN_COLUMN_VISIT),
+             "CREATE INDEX IF NOT EXISTS %(visits)s_cuid_timein_idx ON %(visits)s (%(vCuidCol)s, %(vTimeCol)s);" % names),
+            # Exports filtered by date
+            (self.dbVisitsTable, (c.TIMEIN_COLUMN_VISIT,),
+             "CREATE INDEX IF NOT EXISTS %(visits)s_timein_idx ON %(visits)s (%(vTimeCol)s);" % names),
+        ]
+
+
+    def findMissingIndexes(self, indexes):
+    #===========================================================================
+    # The schemaIndexes() entries not covered by any existing index, given the
+    # column names of each table's indexes
+    #===========================================================================
+        return [index for index in self.schemaIndexes()
+                if index[0] in indexes
+                and not any(columns[:len(index[1])] == index[1] for columns in indexes[index[0]])]
+
+
+    def checkSchema(self):
+    #===========================================================================
+    # Verify the tables and the indexes from schemaIndexes() exist
+    # Returns a list of problems, empty if the schema is complete
+    #===========================================================================
+        missingTables, missingIndexes = self.findMissingSchema()
+
+        problems = (["table %s is missing" % table for table in missingTables] +
+                    ["no index on %s (%s)" % (table, ", ".join(columns)) for table, columns, createIndex in missingIndexes])
+
+
+        return problems
+
+
+    def serverNow(self):
+    #===========================================================================
+    # Best guess of the database's current time. A local database's clock is ours
+    #===========================================================================
+        return datetime.now()
+
+
+    def cacheStats(self):
+    #===========================================================================
+    # User cache hit/miss counters, or None if the cache is disabled
+    #===========================================================================
+        return self.userCache.stats() if self.userCache is not None else None
+
+
+    def fillDays(self, rows, start, end):
+    #===========================================================================
+    # Add a (day, 0, 0) row for each day in the window the rollup has no row for
+    #===========================================================================
+        byDay = {day: (visits, visitors) for day, visits, visitors in rows}
+        return [(start + timedelta(days=i),) + byDay.get(start + timedelta(days=i), (0, 0))
+                for i in range((end - start).days)]
+
+
+    def enableGroupCommit(self, window, maxBatch):
+    #===========================================================================
+    # Batch concurrent check-ins into shared transactions (see GroupCommitter)
+    #===========================================================================
+        self.disableGroupCommit()
+        self.groupCommitter = GroupCommitter(self, window, maxBatch)
+        self.groupCommitter.start()
+        GROUP_COMMIT_PENDING.setFunction(self.groupCommitter.swipes.qsize)
+
+
+    def disableGroupCommit(self):
+    #===========================================================================
+    # Go back to one transaction per check-in
+    #===========================================================================
+        if self.groupCommitter is not None:
+            self.groupCommitter.stop()
+            self.groupCommitter.join()
+            self.groupCommitter = None
+            GROUP_COMMIT_PENDING.setFunction(None)
+
+
+    def close(self):
+    #===========================================================================
+    # Close out db connections. Backends close their own after this
+    #===========================================================================
+        self.disableGroupCommit()
+
+
+    def checkIn(self, CUID, timeIn=None):
+    #===========================================================================
+    # Check in to db with CUID already in db
+    # The hour rule, visit bump, visit insert and name lookup are done by the
+    # backend's checkInBatch in one transaction using the database's clock
+    # In group commit mode the check-in is batched with concurrent swipes
+    # A regular that is cached and still inside the hour is turned away
+    # without a trip to the database
+    # timeIn overrides the server's clock (used to simulate time in load tests)
+    #===========================================================================
+        if self.userCache is not None and not c.ALLOW_CHECKIN_WITHIN_HOUR:
+            record = self.userCache.get(CUID)
+
+            if record is not None:
+                status = self.checkCheckInTime(record["lastCheckIn"], timeIn or self.serverNow())
+                if status != c.SUCCESS:
+                    return self.checkInResult(CUID, status, record["userID"])
+
+        # Unknown cards may be caught without a trip to the database
+        if self.rosterRejects(CUID):
+            return self.checkInResult(CUID, c.CUID_NOT_IN_DB)
+
+        if self.groupCommitter is not None:
+            return self.groupCommitter.submit(CUID, timeIn)
+
+        return self.checkInBatch([CUID], [timeIn])[0]
+
+
+    def rosterRejects(self, CUID):
+    #===========================================================================
+    # Whether CUID is known not to be in the database without asking it
+    # Backends without a roster always ask
+    #===========================================================================
+        return False
+
+
+    def checkInResults(self, CUIDs, rows):
+    #===========================================================================
+    # Turn the (userID, last check-in, check-in time, visit number) row of each
+    # check-in into its result dict. The row is None for unknown cards and the
+    # visit number is None if the check-in was refused
+    #===========================================================================
+        results = []
+        for CUID, row in zip(CUIDs, rows):
+            # Ensure that the card is in the database
+            if row is None:
+                results.append(self.checkInResult(CUID, c.CUID_NOT_IN_DB))
+                continue
+
+            userID, lastCheckIn, curDate, visitNum = row
+
+            # A visit number is only returned if the server accepted the check-in
+            if visitNum is not None:
+                status = c.SUCCESS
+            else:
+                status = self.checkCheckInTime(lastCheckIn, curDate)
+
+            results.append(self.checkInResult(CUID, status, userID, timeIn=curDate))
+
+            if self.userCache is not None:
+                self.userCache.put(CUID, {"userID": userID, "visitNum": visitNum,
+                                          "lastCheckIn": curDate if status == c.SUCCESS else lastCheckIn})
+
+        return results
+
+
+    def checkInResult(self, CUID, status, userID=None, sqlError=None, timeIn=None):
+    #===========================================================================
+    # Build the result dict returned by checkIn
+    #===========================================================================
+        return {"checkInStatus": status, "userID": userID, "CUID": CUID, "sqlError": sqlError, "timeIn": timeIn}
+
+
+    def checkCheckInTime(self, lastCheckIn, curDate=None):
+    #===========================================================================
+    # Verifies that we are not checking into the past or the future
+    # curDate defaults to the local time but should be the server time if known
+    #===========================================================================
+        # Get the current date/time
+        if curDate is None:
+            curDate = datetime.now()
+
+        # The last_checkIn column was added after the DB was initially populated meaning it could be a NoneType
+        # Only check the dates if this is not the case
+        if lastCheckIn is None:
+            return c.SUCCESS
+        # If the last check-in is after the current time, do not allow check-in
+        elif lastCheckIn > curDate:
+            return c.FUTURE_CHECKIN_TIME
+        # Check that the current time is at least one hour after the last check-in time
+        elif curDate - lastCheckIn < timedelta(hours=1):
+            return c.BAD_CHECKIN_TIME
+        else:
+            return c.SUCCESS
+
+
+    def importRoster(self, csvPath, batchSize=None):
+    #===========================================================================
+    # Bulk load users from a CSV of CUID, first name, last name, email (a header
+    # row is allowed). Rows are streamed in batches through a COPY into a staging
+    # table and upserted on CUID. Invalid rows are written to <csv>.rejects.csv.
+    # Progress is saved to <csv>.checkpoint after each batch so a failed import
+    # resumes where it stopped
+    #===========================================================================
+        batchSize = batchSize or c.IMPORT_BATCH_SIZE
+        checkpointPath = csvPath + ".checkpoint"
+        rejectPath = csvPath + ".rejects.csv"
+        resumedFrom = self.readCheckpoint(checkpointPath)
+
+        importResult = {"importStatus": c.SUCCESS, "imported": 0, "rejected": 0, "resumedFrom": resumedFrom,
+                        "csvPath": csvPath, "rejectPath": rejectPath, "sqlError": None}
+
+        try:
+            csvFile = open(csvPath, newline="", encoding="utf-8")
+        except OSError:
+            importResult["importStatus"] = c.FAILURE
+            return importResult
+
+        # Rejects from an earlier attempt are kept when resuming
+        with csvFile, open(rejectPath, "a" if resumedFrom else "w", newline="", encoding="utf-8") as rejectFile:
+            rejects = csv.writer(rejectFile)
+            batch = []
+            # Rejects are written with their batch so a resumed import doesn't repeat them
+            batchRejects = []
+
+            for lineNum, row in enumerate(csv.reader(csvFile), 1):
+                if lineNum <= resumedFrom:
+                    continue
+
+                row = [field.strip() for field in row]
+                if not row or (lineNum == 1 and row[0].lower() == c.CUID_COLUMN_USER):
+                    continue
+
+                reason = self.validateRosterRow(row)
+                if reason is not None:
+                    batchRejects.append([lineNum, reason] + row)
+                    continue
+
+                batch.append([lineNum] + row)
+
+                if len(batch) >= batchSize:
+                    if not self.importRosterBatch(batch, lineNum, checkpointPath, importResult):
+                        return importResult
+                    rejects.writerows(batchRejects)
+                    importResult["rejected"] += len(batchRejects)
+                    batch = []
+                    batchRejects = []
+
+            if batch and not self.importRosterBatch(batch, lineNum, checkpointPath, importResult):
+                return importResult
+            rejects.writerows(batchRejects)
+            importResult["rejected"] += len(batchRejects)
+
+        # Finished. The next import of this file starts from the top
+        if os.path.exists(checkpointPath):
+            os.remove(checkpointPath)
+
+        return importResult
+
+
+    def validateRosterRow(self, row):
+    #===========================================================================
+    # Reason a roster row can't be imported, or None if it is fine
+    #===========================================================================
+        if len(row) != 4:
+            return "expected 4 columns, got %d" % len(row)
+        elif not (row[0].isdigit() and len(row[0]) == 9):
+            return "CUID must be 9 digits"
+        elif row[3] == "":
+            return "missing email"
+        else:
+            return None
+
+
+    def readCheckpoint(self, checkpointPath):
+    #===========================================================================
+    # Last CSV line committed by an earlier import, or 0
+    #===========================================================================
+        try:
+            with open(checkpointPath) as checkpointFile:
+                return int(checkpointFile.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+
+    def writeCheckpoint(self, checkpointPath, lineNum):
+    #===========================================================================
+    # Atomically save the last committed CSV line
+    #===========================================================================
+        tmpPath = checkpointPath + ".tmp"
+        with open(tmpPath, "w") as checkpointFile:
+            checkpointFile.write(str(lineNum))
+            checkpointFile.flush()
+            os.fsync(checkpointFile.fileno())
+        os.replace(tmpPath, checkpointPath)
+
+
+    # Backend interface
+
+    def connect(self):
+    #===========================================================================
+    # Open the database. Sets schemaProblems and rollups
+    # Returns SUCCESS, FAILURE or BAD_PASSWD
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def initSchema(self):
+    #===========================================================================
+    # Create the tables and indexes that don't exist yet
+    # Returns {"initSchemaStatus", "problems", "sqlError"}
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def findMissingSchema(self):
+    #===========================================================================
+    # Look up which tables and schemaIndexes() entries don't exist
+    # Returns (missing table names, missing schemaIndexes() entries)
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def addCard(self, cuid, firstName, lastName, email):
+    #===========================================================================
+    # Add a user and check them in
+    # Returns {"addCardStatus", "Name", "userID", "CUID", "sqlError"}
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def checkInBatch(self, CUIDs, times=None):
+    #===========================================================================
+    # Check in a list of CUIDs in one transaction and return a checkInResult
+    # dict for each. times optionally overrides the database's clock
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def showVisits(self, userID="", stream=False, limit=None, offset=0, orderBy="visits", descending=True):
+    #===========================================================================
+    # Visit counts of one user, or of every user in the given order
+    # Returns {"showVisitsStatus", "visitsTuple", "sqlError"}
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def showRank(self, userID):
+    #===========================================================================
+    # Visit count, rank and percentile of one user
+    # Returns {"showRankStatus", "userID", "visits", "rank", "total",
+    # "percentile", "sqlError"}
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def topVisitors(self, start, end, limit=None):
+    #===========================================================================
+    # The users with the most visits on the days start <= day < end
+    # Returns {"topStatus", "rows", "sqlError"}
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def visitTrend(self, start, end):
+    #===========================================================================
+    # Visits and distinct visitors for each day start <= day < end
+    # Returns {"trendStatus", "rows", "sqlError"}
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def hasRollups(self):
+    #===========================================================================
+    # Whether both rollup tables exist
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def backfillRollups(self):
+    #===========================================================================
+    # Rebuild the rollup tables from the visits table
+    # Returns {"backfillStatus", "days", "sqlError"}
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def warmUp(self):
+    #===========================================================================
+    # Get ready for the first swipes. Returns SUCCESS or FAILURE
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def visitsPartitioned(self):
+    #===========================================================================
+    # Whether the visits table is partitioned
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def maintainPartitions(self, now=None):
+    #===========================================================================
+    # Create upcoming visits partitions and retire old ones
+    # Returns {"partitionStatus", "created", "retired", "moved", "sqlError"}
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def convertVisitsToPartitions(self):
+    #===========================================================================
+    # Convert an unpartitioned visits table into monthly partitions
+    # Returns the same dict as maintainPartitions
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def importRosterBatch(self, batch, lastLine, checkpointPath, importResult):
+    #===========================================================================
+    # Upsert one batch of [line number, CUID, first, last, email] rows in one
+    # transaction and save a checkpoint. Returns False if the import must stop
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def exportVisits(self, path, fmt="csv", start=None, end=None, CUID=None, compress=False):
+    #===========================================================================
+    # Write the visits table to a CSV or JSON Lines file
+    # Returns {"exportStatus", "path", "sqlError"}
+    #===========================================================================
+        raise NotImplementedError
+
+
+    def scanVisits(self, consume, start=None, end=None, batchSize=None):
+    #===========================================================================
+    # Pass the visits table to consume as lists of (CUID, seconds since the
+    # epoch) rows, batchSize rows at a time
+    # Returns {"scanStatus", "rows", "sqlError"}
+    #===========================================================================
+        raise NotImplementedError
+
+
+def newDB(backend, dbHost, dbDatabase, dbUsersTable, dbVisitsTable, dbUser, dbPass):
+#===============================================================================
+# Create an unconnected DB object for a backend. For SQLite, dbDatabase is the
+# path of the database file and the host and login are not used
+# Backends are imported when first used so neither needs the other's modules
+#===============================================================================
+    if backend == "sqlite":
+        from sqliteDB import SQLiteDB
+        return SQLiteDB(dbDatabase or c.SQLITE_PATH, dbUsersTable, dbVisitsTable)
+    elif backend == "postgres":
+        from dbUtil import DB
+        return DB(dbHost, dbDatabase, dbUsersTable, dbVisitsTable, dbUser, dbPass)
+    else:
+        raise ValueError("Unknown storage backend: %s" % backend)
@@ -0,0 +1,120 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import unittest
+
+from cardReader import SwipeDecoder
+import constants as c
+
+# A Tiger One swipe: track 1 is the CUID plus two check characters, then track 2
+SWIPE = "%12345678900?;1234567890=1234?"
+CUID = "123456789"
+
+
+class SwipeDecoderTest(unittest.TestCase):
+    def setUp(self):
+        self.decoder = SwipeDecoder(["tigerone"], timeout=0.3)
+
+
+    def testCleanSwipe(self):
+    #===========================================================================
+    # A whole swipe ending in Enter gives its CUID
+    #===========================================================================
+        self.assertEqual(self.decoder.feed(SWIPE + "\n", now=0), [CUID])
+        self.assertFalse(self.decoder.pending())
+
+
+    def testSwipeInPieces(self):
+    #===========================================================================
+    # Keys arrive a few at a time; the result doesn't depend on how they are split
+    #===========================================================================
+        results = []
+        for i in range(0, len(SWIPE), 3):
+            results += self.decoder.feed(SWIPE[i:i + 3], now=i * 0.001)
+        results += self.decoder.feed("\r\n", now=0.05)
+
+        self.assertEqual(results, [CUID])
+
+
+    def testBackToBackSwipes(self):
+    #===========================================================================
+    # Two swipes in one read give two CUIDs
+    #===========================================================================
+        self.assertEqual(self.decoder.feed(SWIPE + "\n%98765432100?\n", now=0), [CUID, "987654321"])
+
+
+    def testGarbledTrack(self):
+    #===========================================================================
+    # A track cut off by the start of another is an error, not a wrong CUID
+    #===========================================================================
+        self.assertEqual(self.decoder.feed("%1234%12345678900?\n", now=0), [c.ERROR_READING_CARD])
+
+
+    def testOverlongTrack(self):
+    #===========================================================================
+    # A track longer than the standard allows is an error
+    #===========================================================================
+        self.assertEqual(self.decoder.feed("%" + "1" * 100 + "?\n", now=0), [c.ERROR_READING_CARD])
+
+
+    def testUnknownFormat(self):
+    #===========================================================================
+    # A clean swipe of a card no format recognizes is an error
+    #===========================================================================
+        self.assertEqual(self.decoder.feed("%ABC?\n", now=0), [c.ERROR_READING_CARD])
+
+
+    def testTimeout(self):
+    #===========================================================================
+    # A reader that doesn't send Enter finishes once it has been quiet long enough
+    #===========================================================================
+        self.assertEqual(self.decoder.feed(SWIPE, now=0), [])
+        self.assertTrue(self.decoder.pending())
+
+        self.assertEqual(self.decoder.poll(now=0.2), [])
+        self.assertEqual(self.decoder.poll(now=0.5), [CUID])
+        self.assertFalse(self.decoder.pending())
+
+
+    def testTimeoutBeforeNextSwipe(self):
+    #===========================================================================
+    # The next swipe's keys first finish a swipe that timed out
+    #===========================================================================
+        self.decoder.feed(SWIPE, now=0)
+        self.assertEqual(self.decoder.feed("%98765432100?\n", now=1), [CUID, "987654321"])
+
+
+    def testStrayKeys(self):
+    #===========================================================================
+    # Typing outside a swipe is ignored, before and after one
+    #===========================================================================
+        self.assertEqual(self.decoder.feed("hello world\n", now=0), [])
+        self.assertEqual(self.decoder.feed("abc " + SWIPE + "x\n", now=1), [CUID])
+        self.assertFalse(self.decoder.pending())
+
+
+    def testTrack2Format(self):
+    #===========================================================================
+    # ISO 7813 cards give their track 2 account number
+    #===========================================================================
+        decoder = SwipeDecoder(["track2"], timeout=0.3)
+        self.assertEqual(decoder.feed(";4000123412341234=2512101?\n", now=0), ["4000123412341234"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import time
+import threading
+import unittest
+
+from dbPool import ConnectionPool, PoolTimeout, psycopg2
+
+
+class FakeConnection:
+    def __init__(self):
+    #===========================================================================
+    # Just enough of a psycopg2 connection for the pool
+    #===========================================================================
+        self.closed = False
+
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        # Three connections for normal callers and one more for priority callers
+        self.pool = ConnectionPool(FakeConnection, 0, 4, 2, 60, reserved=1)
+        self.normal = [self.pool.getConn() for i in range(3)]
+        self.priority = self.pool.getConn(priority=True)
+        self.results = {}
+
+
+    def tearDown(self):
+        self.pool.closeAll()
+
+
+    def wait(self, name, priority):
+    #===========================================================================
+    # Thread body: check out a connection and record how long it took
+    #===========================================================================
+        started = time.monotonic()
+        try:
+            self.pool.getConn(timeout=2, priority=priority)
+            self.results[name] = ("ok", time.monotonic() - started)
+        except PoolTimeout:
+            self.results[name] = ("timeout", time.monotonic() - started)
+
+
+    def startWaiters(self):
+    #===========================================================================
+    # A normal waiter queued before a priority one, both blocked
+    #===========================================================================
+        waiters = [threading.Thread(target=self.wait, args=("normal", False)),
+                   threading.Thread(target=self.wait, args=("priority", True))]
+        for waiter in waiters:
+            waiter.start()
+            time.sleep(0.1)
+        return waiters
+
+
+    def testNormalCallersCantTakeReserve(self):
+    #===========================================================================
+    # Only priority callers get the reserved connection
+    #===========================================================================
+        with self.assertRaises(PoolTimeout):
+            self.pool.getConn(timeout=0.1)
+        self.assertEqual(self.pool.inUse(), 4)
+
+
+    @unittest.skipIf(psycopg2 is None, "putConn needs psycopg2")
+    def testReturnedReserveWakesPriorityWaiter(self):
+    #===========================================================================
+    # A returned reserved connection goes to the priority waiter right away,
+    # even though a normal waiter that can't use it was queued first
+    #===========================================================================
+        waiters = self.startWaiters()
+        self.pool.putConn(self.priority)
+        for waiter in waiters:
+            waiter.join()
+
+        self.assertEqual(self.results["priority"][0], "ok")
+        self.assertLess(self.results["priority"][1], 1)
+        self.assertEqual(self.results["normal"][0], "timeout")
+
+
+    def testFreedSlotWakesPriorityWaiter(self):
+    #===========================================================================
+    # Same when the reserved connection is discarded instead of returned
+    #===========================================================================
+        waiters = self.startWaiters()
+        self.pool.discard(self.priority)
+        for waiter in waiters:
+            waiter.join()
+
+        self.assertEqual(self.results["priority"][0], "ok")
+        self.assertLess(self.results["priority"][1], 1)
+        self.assertEqual(self.results["normal"][0], "timeout")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+
+import asyncio
+import threading
+import unittest
+import concurrent.futures
+
+from engine import Engine
+import constants as c
+
+
+class FakeDB:
+    def __init__(self):
+    #===========================================================================
+    # Checks in every CUID. Clear `proceed` to hold calls until it is set again
+    #===========================================================================
+        self.proceed = threading.Event()
+        self.proceed.set()
+        self.started = threading.Event()
+        self.finished = []
+        self.journal = None
+
+
+    def checkIn(self, CUID):
+        self.started.set()
+        self.proceed.wait()
+        self.finished.append(CUID)
+        return self.checkInResult(CUID, c.SUCCESS, CUID + "@test")
+
+
+    def checkInResult(self, CUID, status, userID=None, sqlError=None, timeIn=None):
+        return {"checkInStatus": status, "userID": userID, "CUID": CUID, "sqlError": sqlError, "timeIn": timeIn}
+
+
+class EngineTest(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeDB()
+        self.engine = Engine(self.db, workers=1, timeout=5)
+        self.engine.start()
+        self.addCleanup(self.engine.stop)
+        # Never leave a worker blocked when a test fails
+        self.addCleanup(self.db.proceed.set)
+
+
+    def holdWorker(self, CUID="111111111"):
+    #===========================================================================
+    # Start a check-in that keeps the only worker busy until proceed is set
+    #===========================================================================
+        self.db.proceed.clear()
+        future = self.engine.submit(self.engine.checkIn(CUID))
+        self.assertTrue(self.db.started.wait(5))
+        return future
+
+
+    def testCheckIn(self):
+    #===========================================================================
+    # A check-in runs on a worker and its result carries the trace id
+    #===========================================================================
+        result = self.engine.run(self.engine.checkIn("111111111", "abc123"))
+
+        self.assertEqual(result["checkInStatus"], c.SUCCESS)
+        self.assertEqual(result["userID"], "111111111@test")
+        self.assertEqual(result["trace"], "abc123")
+
+
+    def testWaitForWorkerTimesOut(self):
+    #===========================================================================
+    # A call that can't get a worker in time gives up with DB_BUSY
+    #===========================================================================
+        held = self.holdWorker()
+        self.engine.timeout = 0.1
+
+        result = self.engine.run(self.engine.checkIn("222222222"))
+
+        self.assertEqual(result["checkInStatus"], c.DB_BUSY)
+        self.db.proceed.set()
+        self.assertEqual(held.result(5)["checkInStatus"], c.SUCCESS)
+        self.assertEqual(self.db.finished, ["111111111"])
+
+
+    def testAbandonTimesOutWhileRunning(self):
+    #===========================================================================
+    # Read only calls passing abandon=True also time out while running
+    #===========================================================================
+        async def abandoned():
+            return await self.engine.call(self.db.checkIn, "111111111", timeout=0.1, abandon=True)
+
+        self.db.proceed.clear()
+        with self.assertRaises((asyncio.TimeoutError, concurrent.futures.TimeoutError)):
+            self.engine.run(abandoned())
+
+
+    def testCancelledCallerKeepsWorker(self):
+    #===========================================================================
+    # A check-in whose caller is cancelled still runs to the end, and its
+    # worker isn't handed to the next call until then
+    #===========================================================================
+        held = self.holdWorker()
+        held.cancel()
+        self.engine.timeout = 0.2
+
+        self.assertEqual(self.engine.submit(self.engine.checkIn("222222222")).result(5)["checkInStatus"], c.DB_BUSY)
+
+        self.db.proceed.set()
+        self.engine.timeout = 5
+        self.assertEqual(self.engine.run(self.engine.checkIn("333333333"))["checkInStatus"], c.SUCCESS)
+        self.assertEqual(self.db.finished, ["111111111", "333333333"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+
+import os
+import gzip
+import types
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from contextlib import contextmanager
+from datetime import datetime
+
+import dbUtil
+from dbUtil import DB
+from dbPool import PoolTimeout
+import constants as c
+
+ROWS = b"cuid,timein,visit_num\n111111111,2024-09-02 09:00:00,1\n"
+
+
+class FakeError(Exception):
+    pass
+
+
+class FakeCursor:
+    def __init__(self, pool):
+        self.pool = pool
+
+
+    def mogrify(self, query, params):
+        self.pool.params = params
+        return query.encode()
+
+
+    def copy_expert(self, query, outFile):
+        self.pool.query = query
+        if self.pool.error is not None:
+            raise self.pool.error
+        outFile.write(ROWS)
+
+
+    def close(self):
+        pass
+
+
+class FakePool:
+    def __init__(self):
+    #===========================================================================
+    # Hands out a connection whose COPY writes ROWS. Set `error` to make the
+    # COPY raise it, or `busy` to time out checking out a connection
+    #===========================================================================
+        self.error = None
+        self.busy = False
+        self.query = None
+        self.params = None
+
+
+    @contextmanager
+    def connection(self, timeout=None, priority=False):
+        if self.busy:
+            raise PoolTimeout()
+        yield types.SimpleNamespace(cursor=lambda: FakeCursor(self))
+
+
+class ExportVisitsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+        # The export only needs psycopg2 for its error class
+        patcher = mock.patch.object(dbUtil, "psycopg2", types.SimpleNamespace(Error=FakeError))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.db = DB(None, None, "users", "visits", None, None)
+        self.db.pool = FakePool()
+        self.path = os.path.join(self.dir, "visits.csv")
+
+
+    def testCopyToFile(self):
+    #===========================================================================
+    # The COPY output is written to the file as is, with the filters bound
+    #===========================================================================
+        start = datetime(2024, 9, 1)
+        end = datetime(2024, 10, 1)
+
+        exportResult = self.db.exportVisits(self.path, start=start, end=end, CUID="111111111")
+
+        self.assertEqual(exportResult, {"exportStatus": c.SUCCESS, "path": self.path, "sqlError": None})
+        with open(self.path, "rb") as csvFile:
+            self.assertEqual(csvFile.read(), ROWS)
+        self.assertEqual(self.db.pool.params, [start, end, "111111111"])
+        self.assertIn("HEADER", self.db.pool.query)
+
+
+    def testJsonLinesGzip(self):
+    #===========================================================================
+    # JSON Lines exports build the objects on the server and can be gzipped
+    #===========================================================================
+        path = self.path + ".gz"
+
+        self.assertEqual(self.db.exportVisits(path, fmt="jsonl", compress=True)["exportStatus"], c.SUCCESS)
+
+        with gzip.open(path, "rb") as jsonFile:
+            self.assertEqual(jsonFile.read(), ROWS)
+        self.assertIn("json_build_object", self.db.pool.query)
+        self.assertEqual(self.db.pool.params, [])
+
+
+    def testUnwritablePath(self):
+    #===========================================================================
+    # A file that can't be created fails the export without touching the
+    # database
+    #===========================================================================
+        exportResult = self.db.exportVisits(os.path.join(self.dir, "missing", "visits.csv"))
+
+        self.assertEqual(exportResult["exportStatus"], c.FAILURE)
+        self.assertIsNone(exportResult["sqlError"])
+        self.assertIsNone(self.db.pool.query)
+
+
+    def testWriteFails(self):
+    #===========================================================================
+    # A write that fails part way (a full disk, say) fails the export
+    #===========================================================================
+        self.db.pool.error = OSError(28, "No space left on device")
+
+        exportResult = self.db.exportVisits(self.path, compress=True)
+
+        self.assertEqual(exportResult["exportStatus"], c.FAILURE)
+        self.assertIsNone(exportResult["sqlError"])
+
+
+    def testDatabaseErrors(self):
+    #===========================================================================
+    # Query errors are returned as SQL_ERROR and a busy pool as DB_BUSY
+    #===========================================================================
+        error = FakeError("relation \"visits\" does not exist")
+        self.db.pool.error = error
+
+        exportResult = self.db.exportVisits(self.path)
+        self.assertEqual(exportResult["exportStatus"], c.SQL_ERROR)
+        self.assertIs(exportResult["sqlError"], error)
+
+        self.db.pool.busy = True
+        self.assertEqual(self.db.exportVisits(self.path)["exportStatus"], c.DB_BUSY)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import threading
+import unittest
+
+from groupCommit import GroupCommitter
+import constants as c
+
+
+class FakeDB:
+    def __init__(self):
+    #===========================================================================
+    # Records each batch it is asked to check in. Clear `proceed` to hold
+    # check-ins until it is set again, or set `error` to make them fail
+    #===========================================================================
+        self.batches = []
+        self.lock = threading.Lock()
+        self.proceed = threading.Event()
+        self.proceed.set()
+        self.started = threading.Event()
+        self.error = None
+
+
+    def checkInBatch(self, CUIDs, times=None):
+        self.started.set()
+        self.proceed.wait()
+        if self.error is not None:
+            raise self.error
+        with self.lock:
+            self.batches.append(list(CUIDs))
+        return [self.checkInResult(CUID, c.SUCCESS) for CUID in CUIDs]
+
+
+    def checkInResult(self, CUID, status, userID=None, sqlError=None, timeIn=None):
+        return {"checkInStatus": status, "userID": userID, "CUID": CUID, "sqlError": sqlError, "timeIn": timeIn}
+
+
+class GroupCommitterTest(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeDB()
+        self.results = {}
+
+
+    def startCommitter(self, window, maxBatch):
+        committer = GroupCommitter(self.db, window, maxBatch)
+        committer.start()
+        self.addCleanup(committer.join, 5)
+        self.addCleanup(committer.stop)
+        return committer
+
+
+    def submitAll(self, committer, CUIDs):
+    #===========================================================================
+    # Submit each CUID from its own thread and wait for every result
+    #===========================================================================
+        def submit(CUID):
+            self.results[CUID] = committer.submit(CUID)
+
+        threads = [threading.Thread(target=submit, args=(CUID,)) for CUID in CUIDs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+
+    def testConcurrentSwipesShareCommit(self):
+    #===========================================================================
+    # Swipes arriving inside the window are checked in as one batch, and each
+    # caller gets its own result
+    #===========================================================================
+        committer = self.startCommitter(0.5, 10)
+        CUIDs = ["%09d" % i for i in range(5)]
+
+        self.submitAll(committer, CUIDs)
+
+        self.assertEqual(len(self.db.batches), 1)
+        self.assertEqual(sorted(self.db.batches[0]), CUIDs)
+        self.assertEqual({CUID: result["CUID"] for CUID, result in self.results.items()}, {CUID: CUID for CUID in CUIDs})
+
+
+    def testMaxBatch(self):
+    #===========================================================================
+    # A batch is sent as soon as it is full
+    #===========================================================================
+        committer = self.startCommitter(0.5, 2)
+
+        self.submitAll(committer, ["%09d" % i for i in range(5)])
+
+        self.assertTrue(all(len(batch) <= 2 for batch in self.db.batches))
+        self.assertEqual(sum(len(batch) for batch in self.db.batches), 5)
+
+
+    def testFailedBatchAnswersCallers(self):
+    #===========================================================================
+    # Callers aren't left waiting when the batch raises
+    #===========================================================================
+        committer = self.startCommitter(0.01, 10)
+        self.db.error = RuntimeError("database went away")
+
+        self.submitAll(committer, ["111111111", "222222222"])
+
+        self.assertEqual([result["checkInStatus"] for result in self.results.values()], [c.FAILURE, c.FAILURE])
+
+
+    def testSubmitAfterStop(self):
+    #===========================================================================
+    # Once stopped, check-ins are applied on the caller's thread, outside the
+    # lock so other callers aren't held up by the database
+    #===========================================================================
+        committer = self.startCommitter(0.01, 10)
+        committer.stop()
+        committer.join(5)
+
+        self.db.proceed.clear()
+        self.addCleanup(self.db.proceed.set)
+        caller = threading.Thread(target=lambda: self.results.update(direct=committer.submit("111111111")), daemon=True)
+        caller.start()
+        self.assertTrue(self.db.started.wait(5))
+
+        # The direct check-in is still running
+        self.assertTrue(committer.lock.acquire(timeout=1))
+        committer.lock.release()
+
+        self.db.proceed.set()
+        caller.join(5)
+        self.assertEqual(self.results["direct"]["checkInStatus"], c.SUCCESS)
+        self.assertEqual(self.db.batches, [["111111111"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+
+import os
+import csv
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from sqliteDB import SQLiteDB
+import constants as c
+
+
+class ImportRosterTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+        self.db = SQLiteDB(os.path.join(self.dir, "attendance.db"), "users", "visits")
+        self.assertEqual(self.db.connect(), c.SUCCESS)
+        self.addCleanup(self.db.close)
+
+        self.csvPath = os.path.join(self.dir, "roster.csv")
+
+
+    def writeRoster(self, rows):
+        with open(self.csvPath, "w", newline="") as csvFile:
+            csv.writer(csvFile).writerows(rows)
+
+
+    def users(self):
+    #===========================================================================
+    # Every user as (CUID, first name, email), in CUID order
+    #===========================================================================
+        with self.db.transaction() as conn:
+            return conn.execute("SELECT %s, %s, %s FROM users ORDER BY %s;" %
+                                (c.CUID_COLUMN_USER, c.FIRST_NAME_COLUMN_USER, c.EMAIL_COLUMN_USER,
+                                 c.CUID_COLUMN_USER)).fetchall()
+
+
+    def testImportWithHeaderAndRejects(self):
+    #===========================================================================
+    # The header row is skipped, good rows are imported and bad ones are
+    # written to the rejects file with their line number and reason
+    #===========================================================================
+        self.writeRoster([["cuid", "first", "last", "email"],
+                          ["111111111", "Ada", "Lovelace", "ada"],
+                          ["12345", "Bad", "Card", "bad"],
+                          ["222222222", "Alan", "Turing", ""],
+                          ["333333333", "Grace", "Hopper"],
+                          [" 444444444 ", " Edsger ", "Dijkstra", "edsger"]])
+
+        importResult = self.db.importRoster(self.csvPath)
+
+        self.assertEqual(importResult["importStatus"], c.SUCCESS)
+        self.assertEqual((importResult["imported"], importResult["rejected"]), (2, 3))
+        self.assertEqual(self.users(), [("111111111", "Ada", "ada"), ("444444444", "Edsger", "edsger")])
+        with open(importResult["rejectPath"], newline="") as rejectFile:
+            self.assertEqual([row[:2] for row in csv.reader(rejectFile)],
+                             [["3", "CUID must be 9 digits"], ["4", "missing email"], ["5", "expected 4 columns, got 3"]])
+        self.assertFalse(os.path.exists(self.csvPath + ".checkpoint"))
+
+
+    def testExistingCardsUpdated(self):
+    #===========================================================================
+    # Importing a card that is already in the database updates it in place
+    #===========================================================================
+        self.db.addCard("111111111", "Ada", "Byron", "ada")
+        self.writeRoster([["111111111", "Augusta", "Lovelace", "augusta"]])
+
+        importResult = self.db.importRoster(self.csvPath)
+
+        self.assertEqual(importResult["imported"], 1)
+        self.assertEqual(self.users(), [("111111111", "Augusta", "augusta")])
+        self.assertEqual(self.db.showVisits("augusta")["visitsTuple"], [("augusta", 1)])
+
+
+    def testResumeFromCheckpoint(self):
+    #===========================================================================
+    # An import that fails part way resumes after its last committed batch,
+    # and rejects already written aren't repeated
+    #===========================================================================
+        self.writeRoster([["%09d" % i, "First", "Last", "user%d" % i] if i != 2 else ["bad"] for i in range(1, 7)])
+        importRosterBatch = self.db.importRosterBatch
+        calls = []
+
+        def failSecondBatch(batch, lastLine, checkpointPath, importResult):
+            calls.append(lastLine)
+            if len(calls) == 2:
+                importResult["importStatus"], importResult["sqlError"] = self.db.errorStatus(sqlite3.OperationalError("disk I/O error"))
+                return False
+            return importRosterBatch(batch, lastLine, checkpointPath, importResult)
+
+        with mock.patch.object(self.db, "importRosterBatch", side_effect=failSecondBatch):
+            failed = self.db.importRoster(self.csvPath, batchSize=2)
+
+        self.assertNotEqual(failed["importStatus"], c.SUCCESS)
+        self.assertEqual(failed["imported"], 2)
+        self.assertEqual(self.db.readCheckpoint(self.csvPath + ".checkpoint"), 3)
+
+        resumed = self.db.importRoster(self.csvPath, batchSize=2)
+
+        self.assertEqual(resumed["importStatus"], c.SUCCESS)
+        self.assertEqual(resumed["resumedFrom"], 3)
+        self.assertEqual(resumed["imported"], 3)
+        self.assertEqual([user[0] for user in self.users()], ["%09d" % i for i in (1, 3, 4, 5, 6)])
+        with open(resumed["rejectPath"], newline="") as rejectFile:
+            self.assertEqual([row[0] for row in csv.reader(rejectFile)], ["2"])
+        self.assertFalse(os.path.exists(self.csvPath + ".checkpoint"))
+
+
+    def testMissingFile(self):
+    #===========================================================================
+    # A roster that can't be opened fails the import without an exception
+    #===========================================================================
+        importResult = self.db.importRoster(os.path.join(self.dir, "missing.csv"))
+
+        self.assertEqual(importResult["importStatus"], c.FAILURE)
+        self.assertEqual(importResult["imported"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
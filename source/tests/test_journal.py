@@ -0,0 +1,207 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from journal import SwipeJournal, JournalReplayer
+from dbUtil import DB
+import constants as c
+
+START = datetime(2024, 9, 2, 9, 0, 0, 250000)
+
+
+class FakeDB:
+    def __init__(self):
+    #===========================================================================
+    # Records the batches it is asked to replay. Set status to make it fail
+    #===========================================================================
+        self.batches = []
+        self.status = c.SUCCESS
+
+
+    def replaySwipes(self, records):
+        if self.status == c.SUCCESS:
+            self.batches.append(records)
+        return {"replayStatus": self.status, "applied": len(records), "unknown": 0, "refused": 0, "sqlError": None}
+
+
+class FakeCursor:
+    def __init__(self, visits):
+    #===========================================================================
+    # Answers the recorded visits query with (CUID, timeIn) rows, and keeps
+    # the rows deleted from swipe_replay
+    #===========================================================================
+        self.visits = visits
+        self.deleted = None
+
+
+    def execute(self, query, params=None):
+        if query.lstrip().startswith("DELETE"):
+            self.deleted = sorted(zip(*params))
+
+
+    def fetchall(self):
+        return self.visits
+
+
+class SwipeJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+        self.path = os.path.join(self.dir, "swipes.journal")
+        self.journal = SwipeJournal(self.path, "kiosk1", 1, 0.05, clock=lambda: START)
+        self.addCleanup(self.journal.close)
+
+
+    def testAppendAndRead(self):
+    #===========================================================================
+    # Records come back in order with their times to the microsecond
+    #===========================================================================
+        self.journal.append("111111111", START + timedelta(minutes=1))
+        self.journal.append("222222222", START + timedelta(minutes=2))
+
+        records, offset = self.journal.readPending(10)
+
+        self.assertEqual(records, [(START + timedelta(minutes=1), "111111111", "kiosk1"),
+                                   (START + timedelta(minutes=2), "222222222", "kiosk1")])
+        self.assertEqual(offset, os.path.getsize(self.path))
+
+
+    def testClockStampsSwipes(self):
+    #===========================================================================
+    # Swipes without a time are stamped with the journal's clock
+    #===========================================================================
+        self.assertEqual(self.journal.append("111111111"), START)
+        self.assertEqual(self.journal.readPending(10)[0], [(START, "111111111", "kiosk1")])
+
+
+    def testPartialAndBadLines(self):
+    #===========================================================================
+    # Malformed lines are skipped and a partly written last line is left for
+    # the next read
+    #===========================================================================
+        self.journal.append("111111111")
+        with open(self.path, "a") as journalFile:
+            journalFile.write("not a record\n2024-09-02 09:05:00.000000\t2222")
+        complete = os.path.getsize(self.path) - len("2024-09-02 09:05:00.000000\t2222")
+
+        records, offset = self.journal.readPending(10)
+
+        self.assertEqual(records, [(START, "111111111", "kiosk1")])
+        self.assertEqual(offset, complete)
+
+
+    def testMarkReplayed(self):
+    #===========================================================================
+    # Replayed records aren't read again, and a fully replayed journal is emptied
+    #===========================================================================
+        self.journal.append("111111111")
+        self.journal.append("222222222")
+        records, offset = self.journal.readPending(1)
+
+        self.journal.markReplayed(offset)
+        self.assertEqual(self.journal.readPending(10)[0], [(START, "222222222", "kiosk1")])
+
+        self.journal.markReplayed(os.path.getsize(self.path))
+        self.assertFalse(self.journal.hasPending())
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.assertEqual(self.journal.readOffset(), 0)
+
+
+class JournalReplayerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+        self.journal = SwipeJournal(os.path.join(self.dir, "swipes.journal"), "kiosk1", 1, 0.05)
+        self.addCleanup(self.journal.close)
+        self.db = FakeDB()
+        self.replayer = JournalReplayer(self.db, self.journal, 60, 2)
+
+        for i in range(5):
+            self.journal.append("%09d" % i, START + timedelta(hours=i))
+
+
+    def testReplayInBatches(self):
+    #===========================================================================
+    # The backlog is replayed batchSize records at a time, in order
+    #===========================================================================
+        self.replayer.replay()
+
+        self.assertEqual([[record[1] for record in batch] for batch in self.db.batches],
+                         [["000000000", "000000001"], ["000000002", "000000003"], ["000000004"]])
+        self.assertFalse(self.journal.hasPending())
+
+
+    def testReplayKeepsBacklogOffline(self):
+    #===========================================================================
+    # Nothing is marked replayed while the database fails, and the next
+    # attempt starts from the same record
+    #===========================================================================
+        self.db.status = c.SQL_ERROR
+        self.replayer.replay()
+        self.assertTrue(self.journal.hasPending())
+        self.assertEqual(self.journal.readOffset(), 0)
+
+        self.db.status = c.SUCCESS
+        self.replayer.replay()
+        self.assertEqual(sum(len(batch) for batch in self.db.batches), 5)
+        self.assertFalse(self.journal.hasPending())
+
+
+class ReplayHourRuleTest(unittest.TestCase):
+    def setUp(self):
+        self.db = DB(None, None, "users", "visits", None, None)
+
+
+    def testRefuseWithinHour(self):
+    #===========================================================================
+    # Swipes less than an hour after the last kept one, or from a recorded
+    # visit, are deleted. A recorded visit at the same time is a duplicate and
+    # left for the replay to skip; unknown cards are left to be counted
+    #===========================================================================
+        cuid = "111111111"
+        records = [(START + timedelta(minutes=minutes), cuid, "kiosk1") for minutes in (0, 10, 120, 150, 120, -30, -90)]
+        records.append((START, "999999999", "kiosk1"))
+        records.append((START + timedelta(minutes=5), "999999999", "kiosk1"))
+        cursor = FakeCursor([(cuid, START)])
+
+        refused = self.db.refuseReplayWithinHour(cursor, records)
+
+        self.assertEqual(refused, 3)
+        self.assertEqual(cursor.deleted, sorted((cuid, START + timedelta(minutes=minutes)) for minutes in (10, 150, -30)))
+
+
+    def testNothingRefused(self):
+    #===========================================================================
+    # Swipes an hour or more apart are all kept
+    #===========================================================================
+        records = [(START + timedelta(hours=hours), "111111111", "kiosk1") for hours in range(3)]
+        cursor = FakeCursor([("111111111", None)])
+
+        self.assertEqual(self.db.refuseReplayWithinHour(cursor, records), 0)
+        self.assertIsNone(cursor.deleted)
+
+
+if __name__ == "__main__":
+    unittest.main()
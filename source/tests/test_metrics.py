@@ -0,0 +1,127 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+
+import unittest
+
+from metrics import Histogram, Counter, Gauge, CHECKINS, TRACE, countCheckIn, traced
+import constants as c
+
+
+class HistogramTest(unittest.TestCase):
+    def setUp(self):
+        self.histogram = Histogram("test_seconds", "Test latencies", "stage", [0.1, 0.01, 1])
+
+
+    def testBuckets(self):
+    #===========================================================================
+    # A value on a bucket's bound falls in that bucket, and values past the
+    # last bound fall in +Inf
+    #===========================================================================
+        for seconds in (0.005, 0.01, 0.05, 0.1, 2, 30):
+            self.histogram.observe("db", seconds)
+
+        counts, total = self.histogram.values["db"]
+        self.assertEqual(self.histogram.buckets, [0.01, 0.1, 1])
+        self.assertEqual(counts, [2, 2, 0, 2])
+        self.assertAlmostEqual(total, 32.165)
+
+
+    def testRender(self):
+    #===========================================================================
+    # Buckets are rendered cumulatively per label value, with the sum and count
+    #===========================================================================
+        self.histogram.observe("ui", 0.5)
+        self.histogram.observe("db", 0.005)
+        self.histogram.observe("db", 0.05)
+
+        self.assertEqual(self.histogram.render(),
+                         ["# HELP test_seconds Test latencies",
+                          "# TYPE test_seconds histogram",
+                          'test_seconds_bucket{stage="db",le="0.01"} 1',
+                          'test_seconds_bucket{stage="db",le="0.1"} 2',
+                          'test_seconds_bucket{stage="db",le="1"} 2',
+                          'test_seconds_bucket{stage="db",le="+Inf"} 2',
+                          'test_seconds_sum{stage="db"} 0.055000',
+                          'test_seconds_count{stage="db"} 2',
+                          'test_seconds_bucket{stage="ui",le="0.01"} 0',
+                          'test_seconds_bucket{stage="ui",le="0.1"} 0',
+                          'test_seconds_bucket{stage="ui",le="1"} 1',
+                          'test_seconds_bucket{stage="ui",le="+Inf"} 1',
+                          'test_seconds_sum{stage="ui"} 0.500000',
+                          'test_seconds_count{stage="ui"} 1'])
+
+
+    def testEmpty(self):
+    #===========================================================================
+    # A histogram with no observations only has its header
+    #===========================================================================
+        self.assertEqual(self.histogram.render(), ["# HELP test_seconds Test latencies", "# TYPE test_seconds histogram"])
+
+
+class MetricsTest(unittest.TestCase):
+    def testCounter(self):
+    #===========================================================================
+    # Counts are kept per label value and rendered in label order
+    #===========================================================================
+        counter = Counter("test_total", "Test counts", "status")
+        counter.inc("success")
+        counter.inc("busy", 2)
+        counter.inc("success")
+
+        self.assertEqual(counter.render()[2:], ['test_total{status="busy"} 2', 'test_total{status="success"} 2'])
+
+
+    def testGauge(self):
+    #===========================================================================
+    # A gauge is read when rendered, and left out until something provides it
+    #===========================================================================
+        gauge = Gauge("test_depth", "Test depth")
+        self.assertEqual(gauge.render(), [])
+
+        depth = [3]
+        gauge.setFunction(lambda: depth[0])
+        depth[0] = 5
+        self.assertEqual(gauge.render()[2:], ["test_depth 5"])
+
+
+    def testCountCheckIn(self):
+    #===========================================================================
+    # Check-in and add card results are counted by status name
+    #===========================================================================
+        before = dict(CHECKINS.values)
+
+        countCheckIn({"checkInStatus": c.DB_BUSY})
+        countCheckIn({"addCardStatus": c.SUCCESS})
+
+        self.assertEqual(CHECKINS.values["busy"], before.get("busy", 0) + 1)
+        self.assertEqual(CHECKINS.values["success"], before.get("success", 0) + 1)
+
+
+    def testTraced(self):
+    #===========================================================================
+    # A trace id applies inside the with statement only
+    #===========================================================================
+        outside = TRACE.get()
+        with traced("abc123"):
+            self.assertEqual(TRACE.get(), "abc123")
+        self.assertEqual(TRACE.get(), outside)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import os
+import shutil
+import calendar
+import tempfile
+import unittest
+from datetime import datetime
+
+import reports
+from reports import numpy
+import constants as c
+
+
+def at(*when):
+#===============================================================================
+# Seconds since the epoch of a UTC time
+#===============================================================================
+    return calendar.timegm(datetime(*when).timetuple())
+
+
+# (CUID, time) of each visit. 2024-01-01 and 2024-02-05 are Mondays
+VISITS = [("100000000", at(2024, 1, 1, 9, 30)),
+          ("100000000", at(2024, 1, 1, 17, 0)),
+          ("100000000", at(2024, 1, 3, 10, 0)),
+          ("200000000", at(2024, 1, 3, 10, 15)),
+          ("100000000", at(2024, 2, 5, 9, 0)),
+          ("300000000", at(2024, 2, 6, 8, 0)),
+          ("200000000", at(2024, 3, 4, 12, 0))]
+
+
+class FakeDB:
+    def __init__(self, visits):
+    #===========================================================================
+    # Stands in for DB, handing the visits to scanVisits in two batches
+    #===========================================================================
+        self.visits = visits
+
+
+    def scanVisits(self, consume, start=None, end=None, batchSize=None):
+    #===========================================================================
+    # Like DB.scanVisits, which never passes on an empty batch
+    #===========================================================================
+        half = len(self.visits) // 2
+        for batch in (self.visits[:half], self.visits[half:]):
+            if batch:
+                consume(batch)
+        return {"scanStatus": c.SUCCESS, "rows": len(self.visits), "sqlError": None}
+
+
+@unittest.skipIf(numpy is None, "the reports need NumPy")
+class ReportsTest(unittest.TestCase):
+    def setUp(self):
+        visits = reports.VisitArrays()
+        visits.add(VISITS[:3])
+        visits.add(VISITS[3:])
+        self.times, self.users = visits.arrays()
+
+
+    def testVisitArrays(self):
+    #===========================================================================
+    # Each card keeps its user number across batches
+    #===========================================================================
+        self.assertEqual(self.times.tolist(), [when for CUID, when in VISITS])
+        numbers = {}
+        for (CUID, when), user in zip(VISITS, self.users.tolist()):
+            self.assertEqual(numbers.setdefault(CUID, user), user)
+        self.assertEqual(sorted(numbers.values()), [0, 1, 2])
+
+
+    def testDailyVisits(self):
+    #===========================================================================
+    # Every day from the first visit to the last, with visits and visitors
+    #===========================================================================
+        header, rows = reports.dailyVisits(self.times, self.users)
+
+        self.assertEqual(header, ["Date", "Visits", "Visitors"])
+        self.assertEqual(len(rows), 64)
+        self.assertEqual(rows[0], ("2024-01-01", 2, 1))
+        self.assertEqual(rows[1], ("2024-01-02", 0, 0))
+        self.assertEqual(rows[2], ("2024-01-03", 2, 2))
+        self.assertEqual(rows[-1], ("2024-03-04", 1, 1))
+        self.assertEqual(sum(row[1] for row in rows), len(VISITS))
+
+
+    def testHourlyVisits(self):
+    #===========================================================================
+    # Visits counted by weekday and hour
+    #===========================================================================
+        header, rows = reports.hourlyVisits(self.times, self.users)
+        grid = {row[0]: row[1:] for row in rows}
+
+        self.assertEqual(len(header), 25)
+        self.assertEqual(grid["Monday"][9], 2)
+        self.assertEqual(grid["Monday"][12], 1)
+        self.assertEqual(grid["Monday"][17], 1)
+        self.assertEqual(grid["Tuesday"][8], 1)
+        self.assertEqual(grid["Wednesday"][10], 2)
+        self.assertEqual(sum(sum(hours) for hours in grid.values()), len(VISITS))
+
+
+    def testWeeklyVisitors(self):
+    #===========================================================================
+    # Weeks start on Monday; new visitors are counted in their first week only
+    #===========================================================================
+        header, rows = reports.weeklyVisitors(self.times, self.users)
+        weeks = {row[0]: row[1:] for row in rows}
+
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(weeks["2024-01-01"], (4, 2, 2))
+        self.assertEqual(weeks["2024-01-08"], (0, 0, 0))
+        self.assertEqual(weeks["2024-02-05"], (2, 2, 1))
+        self.assertEqual(weeks["2024-03-04"], (1, 1, 0))
+
+
+    def testCohorts(self):
+    #===========================================================================
+    # Users by month of first visit and how many came back in later months
+    # Months after the last visit are blank
+    #===========================================================================
+        header, rows = reports.cohorts(self.times, self.users, months=2)
+
+        self.assertEqual(header, ["First visit", "Users", "+1 mo", "+2 mo"])
+        self.assertEqual(rows, [["2024-01", 2, 1, 1], ["2024-02", 1, 0, ""]])
+
+
+    def testRunReports(self):
+    #===========================================================================
+    # Every report is written as CSV and HTML with an index page
+    #===========================================================================
+        outDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outDir)
+
+        reportResult = reports.runReports(FakeDB(VISITS), outDir, workers=1)
+
+        self.assertEqual(reportResult["reportStatus"], c.SUCCESS)
+        self.assertEqual(reportResult["visits"], len(VISITS))
+        self.assertEqual(len(reportResult["paths"]), 2 * len(reports.REPORTS))
+        for path in reportResult["paths"] + [reportResult["index"]]:
+            self.assertTrue(os.path.isfile(path))
+
+
+    def testRunReportsNoVisits(self):
+    #===========================================================================
+    # Nothing to report on is NO_RESULTS
+    #===========================================================================
+        reportResult = reports.runReports(FakeDB([]), tempfile.gettempdir(), workers=1)
+        self.assertEqual(reportResult["reportStatus"], c.NO_RESULTS)
+
+
+    def testRunReportsUnwritable(self):
+    #===========================================================================
+    # A report directory that can't be created is FAILURE, not an exception
+    #===========================================================================
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        blocker = os.path.join(tmpDir, "file")
+        open(blocker, "w").close()
+
+        reportResult = reports.runReports(FakeDB(VISITS), os.path.join(blocker, "reports"), workers=1)
+
+        self.assertEqual(reportResult["reportStatus"], c.FAILURE)
+        self.assertIsInstance(reportResult["error"], OSError)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from roster import Roster, MAX_CUID
+
+
+class RosterTest(unittest.TestCase):
+    def setUp(self):
+        self.roster, self.unstorable = Roster.build(["300000000", "100000000", "200000000", "abc", str(MAX_CUID + 1)])
+
+
+    def testBuild(self):
+    #===========================================================================
+    # The snapshot is sorted and CUIDs that aren't 32-bit numbers are returned
+    #===========================================================================
+        self.assertEqual(list(self.roster.cuids), [100000000, 200000000, 300000000])
+        self.assertEqual(self.unstorable, ["abc", str(MAX_CUID + 1)])
+        self.assertEqual(len(self.roster), 3)
+
+
+    def testContains(self):
+    #===========================================================================
+    # True for known CUIDs, False for unknown ones, None if it can't tell
+    #===========================================================================
+        self.assertIs(self.roster.contains("100000000"), True)
+        self.assertIs(self.roster.contains("300000000"), True)
+        self.assertIs(self.roster.contains("150000000"), False)
+        self.assertIs(self.roster.contains("999999999"), False)
+        self.assertIsNone(self.roster.contains("abc"))
+        self.assertIsNone(self.roster.contains(str(MAX_CUID + 1)))
+
+
+    def testEmpty(self):
+    #===========================================================================
+    # An empty roster knows no CUIDs
+    #===========================================================================
+        self.assertIs(Roster().contains("100000000"), False)
+
+
+    def testAdd(self):
+    #===========================================================================
+    # Added CUIDs are found without rebuilding the snapshot
+    #===========================================================================
+        self.roster.add("150000000")
+        self.assertIs(self.roster.contains("150000000"), True)
+        self.assertEqual(len(self.roster), 4)
+
+
+    def testSaveAndLoad(self):
+    #===========================================================================
+    # A saved snapshot, deltas included, loads back through the memory map
+    #===========================================================================
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        path = os.path.join(tmpDir, "roster.snapshot")
+
+        self.roster.add("150000000")
+        self.roster.save(path)
+
+        loaded = Roster.load(path)
+        self.addCleanup(loaded.close)
+        self.assertEqual(list(loaded.cuids), [100000000, 150000000, 200000000, 300000000])
+        self.assertIs(loaded.contains("150000000"), True)
+        self.assertIs(loaded.contains("250000000"), False)
+
+
+    def testLoadInvalid(self):
+    #===========================================================================
+    # Missing and corrupt snapshots are not loaded
+    #===========================================================================
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        path = os.path.join(tmpDir, "roster.snapshot")
+
+        self.assertIsNone(Roster.load(path))
+
+        with open(path, "wb") as snapshotFile:
+            snapshotFile.write(b"not a roster snapshot at all")
+        self.assertIsNone(Roster.load(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
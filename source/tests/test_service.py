@@ -0,0 +1,171 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from datetime import date, datetime, timedelta
+
+from service import CheckInService, ServiceClient, ServiceError
+from sqliteDB import SQLiteDB
+from metrics import TRACE
+import constants as c
+
+
+class ServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+        self.db = SQLiteDB(os.path.join(self.dir, "attendance.db"), "users", "visits")
+        self.assertEqual(self.db.connect(), c.SUCCESS)
+        self.addCleanup(self.db.close)
+
+        self.service = self.startService("secret")
+        self.client = ServiceClient("http://127.0.0.1:%d/" % self.service.server_address[1], token="secret", timeout=5)
+
+
+    def startService(self, token):
+    #===========================================================================
+    # Serve the test database on a free port until the test ends
+    #===========================================================================
+        service = CheckInService(self.db, "127.0.0.1", 0, token)
+        service.engine.start()
+        thread = threading.Thread(target=service.serve_forever, daemon=True)
+        thread.start()
+
+        self.addCleanup(service.engine.stop)
+        self.addCleanup(service.server_close)
+        self.addCleanup(service.shutdown)
+        return service
+
+
+    def testCheckIn(self):
+    #===========================================================================
+    # Check-ins come back as DB result dicts, with the kiosk's trace id
+    #===========================================================================
+        self.assertEqual(self.client.connect(), c.SUCCESS)
+        addCardResult = self.client.addCard("123456789", "Ada", "Lovelace", "ada")
+        self.assertEqual(addCardResult["addCardStatus"], c.SUCCESS)
+
+        TRACE.set("abc123")
+        with mock.patch.object(c, "ALLOW_CHECKIN_WITHIN_HOUR", 1):
+            result = self.client.checkIn("123456789")
+
+        self.assertEqual(result["checkInStatus"], c.SUCCESS)
+        self.assertEqual(result["userID"], "ada")
+        self.assertIsInstance(result["timeIn"], datetime)
+        self.assertEqual(result["trace"], "abc123")
+        self.assertEqual(self.client.checkIn("999999999")["checkInStatus"], c.CUID_NOT_IN_DB)
+
+
+    def testCheckInBatch(self):
+    #===========================================================================
+    # A batch gets a result per CUID, in order
+    #===========================================================================
+        self.client.addCard("111111111", "Ada", "Lovelace", "ada")
+
+        with mock.patch.object(c, "ALLOW_CHECKIN_WITHIN_HOUR", 1):
+            results = self.client.checkInBatch(["111111111", "999999999"])
+
+        self.assertEqual([(result["CUID"], result["checkInStatus"]) for result in results],
+                         [("111111111", c.SUCCESS), ("999999999", c.CUID_NOT_IN_DB)])
+
+
+    def testShowVisitsPages(self):
+    #===========================================================================
+    # Without a limit every page is fetched, all at once or as the rows are
+    # iterated, and gives the same rows as the database
+    #===========================================================================
+        for i in range(5):
+            self.client.addCard("%09d" % i, "First", "Last", "user%d" % i)
+        expected = self.db.showVisits()["visitsTuple"]
+
+        with mock.patch.object(c, "VISITS_FETCH_BATCH", 2):
+            self.assertEqual(self.client.showVisits()["visitsTuple"], expected)
+            self.assertEqual(list(self.client.showVisits(stream=True)["visitsTuple"]), expected)
+        self.assertEqual(self.client.showVisits(limit=2, offset=3)["visitsTuple"], expected[3:])
+        self.assertEqual(self.client.showRank("user0")["showRankStatus"], c.SUCCESS)
+
+
+    def testVisitTrend(self):
+    #===========================================================================
+    # Trend rows come back with their days as dates, including empty days
+    #===========================================================================
+        self.client.addCard("111111111", "Ada", "Lovelace", "ada")
+        today = self.db.serverNow().date()
+
+        trendResult = self.client.visitTrend(today - timedelta(days=1), today + timedelta(days=1))
+
+        self.assertEqual(trendResult["trendStatus"], c.SUCCESS)
+        self.assertEqual(trendResult["rows"], [(today - timedelta(days=1), 0, 0), (today, 1, 1)])
+        self.assertEqual(self.client.topVisitors(today, today + timedelta(days=1))["rows"], [("ada", 1, 1)])
+
+
+    def testToken(self):
+    #===========================================================================
+    # Only /health is open without the token; other requests are refused and
+    # reported as SQL_ERROR with a ServiceError
+    #===========================================================================
+        client = ServiceClient(self.client.url, token="wrong", timeout=5)
+
+        self.assertEqual(client.connect(), c.SUCCESS)
+        result = client.checkIn("123456789")
+        self.assertEqual(result["checkInStatus"], c.SQL_ERROR)
+        self.assertIsInstance(result["sqlError"], ServiceError)
+        self.assertIn("401", result["sqlError"].pgerror)
+        self.assertEqual(self.db.showVisits()["showVisitsStatus"], c.NO_RESULTS)
+
+
+    def testBadRequests(self):
+    #===========================================================================
+    # Missing fields, oversized batches and bad parameters are refused
+    #===========================================================================
+        for method, path, body in (("POST", "/checkin", {}),
+                                   ("POST", "/checkin/batch", {"cuids": ["111111111"] * (c.SERVICE_MAX_BATCH + 1)}),
+                                   ("GET", "/visits?limit=-1", None),
+                                   ("GET", "/top?from=yesterday&to=today", None),
+                                   ("GET", "/nowhere", None)):
+            with self.subTest(path=path):
+                with self.assertRaises(ServiceError):
+                    self.client.request(method, path, body)
+
+
+    def testServiceDown(self):
+    #===========================================================================
+    # An unreachable service fails the login and every request
+    #===========================================================================
+        # A port nothing listens on
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        client = ServiceClient("http://127.0.0.1:%d" % port, timeout=5)
+
+        self.assertEqual(client.connect(), c.FAILURE)
+        self.assertEqual(client.checkIn("123456789")["checkInStatus"], c.SQL_ERROR)
+        self.assertEqual([result["checkInStatus"] for result in client.checkInBatch(["1", "2"])], [c.SQL_ERROR] * 2)
+        self.assertEqual(client.showVisits()["showVisitsStatus"], c.SQL_ERROR)
+
+
+if __name__ == "__main__":
+    unittest.main()
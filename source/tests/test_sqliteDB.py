@@ -0,0 +1,222 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import os
+import csv
+import gzip
+import json
+import shutil
+import calendar
+import tempfile
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+
+from sqliteDB import SQLiteDB
+import constants as c
+
+
+class SQLiteDBTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+        self.db = SQLiteDB(os.path.join(self.dir, "attendance.db"), "users", "visits")
+        self.assertEqual(self.db.connect(), c.SUCCESS)
+        self.addCleanup(self.db.close)
+
+
+    def addUsers(self, visits):
+    #===========================================================================
+    # Add a user per {CUID: [check-in times]} entry and check them in at those
+    # times. Their user IDs are <CUID>@test. They are inserted directly since
+    # addCard would also check them in now
+    #===========================================================================
+        for CUID, times in visits.items():
+            with self.db.transaction() as conn:
+                conn.execute(self.db.queries["addCard"], (CUID, "First", "Last", CUID + "@test", c.DEFAULT_VISITS))
+            for timeIn in times:
+                self.assertEqual(self.db.checkIn(CUID, timeIn)["checkInStatus"], c.SUCCESS)
+
+
+    def testNewFileHasSchema(self):
+    #===========================================================================
+    # Connecting to a new file creates every table and index
+    #===========================================================================
+        self.assertEqual(self.db.schemaProblems, [])
+        self.assertEqual(self.db.checkSchema(), [])
+
+
+    def testAddCardChecksIn(self):
+    #===========================================================================
+    # A new card is added and checked in once
+    #===========================================================================
+        addCardResult = self.db.addCard("123456789", "Ada", "Lovelace", "ada")
+
+        self.assertEqual(addCardResult["addCardStatus"], c.SUCCESS)
+        self.assertEqual(addCardResult["userID"], "ada")
+        self.assertEqual(self.db.showVisits("ada")["visitsTuple"], [("ada", 1)])
+
+
+    def testAddCardTwice(self):
+    #===========================================================================
+    # A card that is already in the database can't be added again
+    #===========================================================================
+        self.db.addCard("123456789", "Ada", "Lovelace", "ada")
+        addCardResult = self.db.addCard("123456789", "Ada", "Lovelace", "ada")
+
+        self.assertEqual(addCardResult["addCardStatus"], c.SQL_ERROR)
+        self.assertIsNotNone(addCardResult["sqlError"].pgerror)
+
+
+    def testCheckInUnknownCard(self):
+    #===========================================================================
+    # Cards that aren't in the database are turned away
+    #===========================================================================
+        self.assertEqual(self.db.checkIn("999999999")["checkInStatus"], c.CUID_NOT_IN_DB)
+
+
+    def testCheckInHourRule(self):
+    #===========================================================================
+    # A second check-in within the hour is refused and not counted
+    #===========================================================================
+        start = datetime(2024, 9, 2, 9, 0)
+        self.addUsers({"123456789": [start]})
+
+        with mock.patch.object(c, "ALLOW_CHECKIN_WITHIN_HOUR", 0):
+            refused = self.db.checkIn("123456789", start + timedelta(minutes=30))
+            accepted = self.db.checkIn("123456789", start + timedelta(hours=1))
+            past = self.db.checkIn("123456789", start)
+
+        self.assertEqual(refused["checkInStatus"], c.BAD_CHECKIN_TIME)
+        self.assertEqual(accepted["checkInStatus"], c.SUCCESS)
+        self.assertEqual(accepted["timeIn"], start + timedelta(hours=1))
+        self.assertEqual(past["checkInStatus"], c.FUTURE_CHECKIN_TIME)
+        self.assertEqual(self.db.showVisits("123456789@test")["visitsTuple"], [("123456789@test", 2)])
+
+
+    def testCheckInBatch(self):
+    #===========================================================================
+    # A batch gets a result per CUID, in order, with unknown cards marked
+    #===========================================================================
+        start = datetime(2024, 9, 2, 9, 0)
+        self.addUsers({"111111111": [], "222222222": []})
+
+        results = self.db.checkInBatch(["111111111", "999999999", "222222222"], [start] * 3)
+
+        self.assertEqual([result["CUID"] for result in results], ["111111111", "999999999", "222222222"])
+        self.assertEqual([result["checkInStatus"] for result in results], [c.SUCCESS, c.CUID_NOT_IN_DB, c.SUCCESS])
+
+
+    def testShowVisits(self):
+    #===========================================================================
+    # Everyone is listed by visits (ties by user ID), pages and streams give
+    # the same rows, and unknown users have no results
+    #===========================================================================
+        start = datetime(2024, 9, 2, 9, 0)
+        self.addUsers({"111111111": [start],
+                       "222222222": [start, start + timedelta(hours=2)],
+                       "333333333": [start]})
+        expected = [("222222222@test", 2), ("111111111@test", 1), ("333333333@test", 1)]
+
+        self.assertEqual(self.db.showVisits()["visitsTuple"], expected)
+        self.assertEqual(self.db.showVisits(limit=2, offset=1)["visitsTuple"], expected[1:])
+        self.assertEqual(list(self.db.showVisits(stream=True)["visitsTuple"]), expected)
+        self.assertEqual(self.db.showVisits(orderBy="userID", descending=False)["visitsTuple"], sorted(expected))
+        self.assertEqual(self.db.showVisits("nobody@test")["showVisitsStatus"], c.NO_RESULTS)
+
+
+    def testExportVisitsCsv(self):
+    #===========================================================================
+    # Visits are exported in time order with a header row, and filters apply
+    #===========================================================================
+        start = datetime(2024, 9, 2, 9, 0)
+        self.addUsers({"111111111": [start + timedelta(hours=3)], "222222222": [start]})
+        path = os.path.join(self.dir, "visits.csv")
+
+        self.assertEqual(self.db.exportVisits(path)["exportStatus"], c.SUCCESS)
+        with open(path, newline="") as csvFile:
+            rows = list(csv.reader(csvFile))
+        self.assertEqual(rows, [[c.CUID_COLUMN_VISIT, c.TIMEIN_COLUMN_VISIT, c.VISIT_NUM_COLUMN_VISIT],
+                                ["222222222", "2024-09-02 09:00:00.000000", "1"],
+                                ["111111111", "2024-09-02 12:00:00.000000", "1"]])
+
+        self.db.exportVisits(path, start=start + timedelta(hours=1))
+        with open(path, newline="") as csvFile:
+            self.assertEqual([row[0] for row in csv.reader(csvFile)][1:], ["111111111"])
+
+        self.db.exportVisits(path, CUID="222222222")
+        with open(path, newline="") as csvFile:
+            self.assertEqual([row[0] for row in csv.reader(csvFile)][1:], ["222222222"])
+
+
+    def testExportVisitsJsonLinesGzip(self):
+    #===========================================================================
+    # JSON Lines exports can be gzipped on the fly
+    #===========================================================================
+        start = datetime(2024, 9, 2, 9, 0)
+        self.addUsers({"111111111": [start]})
+        path = os.path.join(self.dir, "visits.jsonl.gz")
+
+        self.assertEqual(self.db.exportVisits(path, fmt="jsonl", compress=True)["exportStatus"], c.SUCCESS)
+        with gzip.open(path, "rt") as jsonFile:
+            rows = [json.loads(line) for line in jsonFile]
+        self.assertEqual(rows, [{c.CUID_COLUMN_VISIT: "111111111", c.TIMEIN_COLUMN_VISIT: "2024-09-02T09:00:00.000000",
+                                 c.VISIT_NUM_COLUMN_VISIT: 1}])
+
+
+    def testExportVisitsUnwritablePath(self):
+    #===========================================================================
+    # A file that can't be created fails the export without an exception
+    #===========================================================================
+        notADirectory = os.path.join(self.dir, "file")
+        open(notADirectory, "w").close()
+
+        exportResult = self.db.exportVisits(os.path.join(notADirectory, "visits.csv"))
+
+        self.assertEqual(exportResult["exportStatus"], c.FAILURE)
+        self.assertIsNone(exportResult["sqlError"])
+
+
+    def testScanVisits(self):
+    #===========================================================================
+    # Every visit in the window is passed on as (CUID, epoch seconds) rows in
+    # batches of at most batchSize
+    #===========================================================================
+        start = datetime(2024, 9, 2, 9, 0)
+        times = [start + timedelta(hours=2 * i) for i in range(5)]
+        self.addUsers({"111111111": times, "222222222": times[:1]})
+        batches = []
+
+        scanResult = self.db.scanVisits(batches.append, batchSize=2)
+
+        self.assertEqual(scanResult["scanStatus"], c.SUCCESS)
+        self.assertEqual(scanResult["rows"], 6)
+        self.assertTrue(all(len(batch) <= 2 for batch in batches))
+        self.assertEqual(sorted(row for batch in batches for row in batch),
+                         sorted([("111111111", calendar.timegm(t.timetuple())) for t in times] +
+                                [("222222222", calendar.timegm(start.timetuple()))]))
+
+        batches = []
+        scanResult = self.db.scanVisits(batches.append, start=times[3], end=times[4])
+        self.assertEqual(scanResult["rows"], 1)
+        self.assertEqual(batches, [[("111111111", calendar.timegm(times[3].timetuple()))]])
+
+
+if __name__ == "__main__":
+    unittest.main()
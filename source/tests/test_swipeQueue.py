@@ -0,0 +1,200 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+
+import time
+import threading
+import unittest
+from datetime import datetime
+
+from engine import Engine, SwipeQueue
+import constants as c
+
+NOW = datetime(2024, 9, 2, 9, 0)
+
+
+class FakeJournal:
+    def __init__(self):
+        self.CUIDs = []
+
+
+    def append(self, CUID, timeIn=None):
+        self.CUIDs.append(CUID)
+        return NOW
+
+
+class FakeDB:
+    def __init__(self):
+    #===========================================================================
+    # Checks in every CUID. Clear `proceed` to hold check-ins until it is set
+    # again. Set `journal` to a FakeJournal to let swipes be spilled
+    #===========================================================================
+        self.proceed = threading.Event()
+        self.proceed.set()
+        self.started = threading.Event()
+        self.journal = None
+
+
+    def checkIn(self, CUID):
+        self.started.set()
+        self.proceed.wait()
+        return self.checkInResult(CUID, c.SUCCESS, CUID + "@test")
+
+
+    def checkInResult(self, CUID, status, userID=None, sqlError=None, timeIn=None):
+        return {"checkInStatus": status, "userID": userID, "CUID": CUID, "sqlError": sqlError, "timeIn": timeIn}
+
+
+class SwipeQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeDB()
+        self.engine = Engine(self.db, workers=1, timeout=5)
+        self.engine.start()
+        self.addCleanup(self.engine.stop)
+        # Never leave a worker blocked when a test fails
+        self.addCleanup(self.db.proceed.set)
+
+        self.results = []
+        self.resultsLock = threading.Lock()
+
+
+    def handler(self, result):
+        with self.resultsLock:
+            self.results.append(result)
+
+
+    def startQueue(self, maxSize, overflow="spill"):
+        swipeQueue = SwipeQueue(self.engine, self.handler, maxSize, overflow)
+        swipeQueue.start()
+        self.addCleanup(swipeQueue.stop)
+        return swipeQueue
+
+
+    def waitForResults(self, count):
+    #===========================================================================
+    # The handler's results once it has had count of them
+    #===========================================================================
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            with self.resultsLock:
+                if len(self.results) >= count:
+                    return list(self.results)
+            time.sleep(0.01)
+        self.fail("expected %d results, got %d" % (count, len(self.results)))
+
+
+    def holdWorker(self, swipeQueue):
+    #===========================================================================
+    # Queue a swipe that keeps the worker busy until proceed is set
+    #===========================================================================
+        self.db.proceed.clear()
+        self.assertEqual(swipeQueue.submit("000000000"), c.SUCCESS)
+        self.assertTrue(self.db.started.wait(5))
+
+
+    def testSwipesCheckedInOrder(self):
+    #===========================================================================
+    # Queued swipes are checked in one at a time in the order they came in
+    #===========================================================================
+        swipeQueue = self.startQueue(10)
+        CUIDs = ["%09d" % i for i in range(5)]
+
+        self.assertEqual([swipeQueue.submit(CUID, "trace%d" % i) for i, CUID in enumerate(CUIDs)], [c.SUCCESS] * 5)
+
+        results = self.waitForResults(5)
+        self.assertEqual([result["CUID"] for result in results], CUIDs)
+        self.assertEqual([result["trace"] for result in results], ["trace%d" % i for i in range(5)])
+        stats = swipeQueue.stats()
+        self.assertEqual((stats["processed"], stats["depth"], stats["spilled"], stats["rejected"]), (5, 0, 0, 0))
+
+
+    def testOverflowSpilledToJournal(self):
+    #===========================================================================
+    # With the spill policy, a swipe that doesn't fit is journaled and the
+    # handler is told so
+    #===========================================================================
+        self.db.journal = FakeJournal()
+        swipeQueue = self.startQueue(2)
+        self.holdWorker(swipeQueue)
+        swipeQueue.submit("111111111")
+
+        self.assertEqual(swipeQueue.submit("222222222", "abc123"), c.CHECKIN_JOURNALED)
+
+        self.assertEqual(self.db.journal.CUIDs, ["222222222"])
+        self.assertEqual(self.results, [dict(self.db.checkInResult("222222222", c.CHECKIN_JOURNALED, timeIn=NOW),
+                                             trace="abc123")])
+        self.db.proceed.set()
+        self.assertEqual([result["CUID"] for result in self.waitForResults(3)[1:]], ["000000000", "111111111"])
+        self.assertEqual(swipeQueue.stats()["spilled"], 1)
+
+
+    def testOverflowRejected(self):
+    #===========================================================================
+    # With the reject policy, or with nowhere to spill to, a swipe that
+    # doesn't fit is turned away
+    #===========================================================================
+        for overflow, journal in (("reject", FakeJournal()), ("spill", None)):
+            with self.subTest(overflow=overflow, journal=journal):
+                self.db = FakeDB()
+                self.db.journal = journal
+                self.engine.db = self.db
+                swipeQueue = self.startQueue(1, overflow)
+                self.holdWorker(swipeQueue)
+
+                self.assertEqual(swipeQueue.submit("111111111"), c.SWIPE_QUEUE_FULL)
+                self.assertEqual(swipeQueue.stats()["rejected"], 1)
+                if journal is not None:
+                    self.assertEqual(journal.CUIDs, [])
+
+                self.db.proceed.set()
+                swipeQueue.stop()
+
+
+    def testStopSpillsQueuedSwipes(self):
+    #===========================================================================
+    # Swipes still queued when the kiosk stops are journaled, not lost
+    #===========================================================================
+        self.db.journal = FakeJournal()
+        swipeQueue = self.startQueue(10)
+        self.holdWorker(swipeQueue)
+        swipeQueue.submit("111111111")
+        swipeQueue.submit("222222222")
+
+        swipeQueue.stop()
+
+        self.assertEqual(self.db.journal.CUIDs, ["111111111", "222222222"])
+        self.assertEqual(swipeQueue.stats()["spilled"], 2)
+
+
+    def testStopWithoutJournal(self):
+    #===========================================================================
+    # Without a journal, swipes still queued at stop are counted as rejected
+    #===========================================================================
+        swipeQueue = self.startQueue(10)
+        self.holdWorker(swipeQueue)
+        swipeQueue.submit("111111111")
+
+        with self.assertLogs("magstripe", "WARNING") as logs:
+            swipeQueue.stop()
+
+        self.assertEqual(swipeQueue.stats()["rejected"], 1)
+        self.assertTrue(any("111111111 dropped" in line for line in logs.output))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+
+from userCache import UserCache
+from sqliteDB import SQLiteDB
+import constants as c
+
+
+class UserCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = UserCache(2)
+
+
+    def record(self, userID):
+        return {"userID": userID, "visitNum": 1, "lastCheckIn": datetime(2024, 9, 2, 9, 0)}
+
+
+    def testLeastRecentlyUsedEvicted(self):
+    #===========================================================================
+    # Once full, the record that was used longest ago is evicted
+    #===========================================================================
+        self.cache.put("111111111", self.record("a"))
+        self.cache.put("222222222", self.record("b"))
+        self.cache.get("111111111")
+        self.cache.put("333333333", self.record("c"))
+
+        self.assertIsNone(self.cache.get("222222222"))
+        self.assertEqual(self.cache.get("111111111")["userID"], "a")
+        self.assertEqual(self.cache.get("333333333")["userID"], "c")
+        self.assertEqual(self.cache.stats(), {"size": 2, "hits": 3, "misses": 1, "evictions": 1, "invalidations": 0})
+
+
+    def testPutRefreshesRecord(self):
+    #===========================================================================
+    # Putting a cached CUID again replaces its record and makes it the most
+    # recently used, without evicting anything
+    #===========================================================================
+        self.cache.put("111111111", self.record("a"))
+        self.cache.put("222222222", self.record("b"))
+        self.cache.put("111111111", self.record("a2"))
+        self.cache.put("333333333", self.record("c"))
+
+        self.assertEqual(self.cache.get("111111111")["userID"], "a2")
+        self.assertIsNone(self.cache.get("222222222"))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+
+    def testInvalidate(self):
+    #===========================================================================
+    # A single CUID or everything can be dropped, and only records that were
+    # cached are counted
+    #===========================================================================
+        self.cache.put("111111111", self.record("a"))
+        self.cache.put("222222222", self.record("b"))
+
+        self.cache.invalidate("111111111")
+        self.cache.invalidate("999999999")
+        self.assertIsNone(self.cache.get("111111111"))
+        self.assertEqual(self.cache.stats()["invalidations"], 1)
+
+        self.cache.invalidate(None)
+        self.assertIsNone(self.cache.get("222222222"))
+        self.assertEqual(self.cache.stats()["size"], 0)
+        self.assertEqual(self.cache.stats()["invalidations"], 2)
+
+
+class CachedCheckInTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+        self.db = SQLiteDB(os.path.join(self.dir, "attendance.db"), "users", "visits")
+        self.assertEqual(self.db.connect(), c.SUCCESS)
+        self.addCleanup(self.db.close)
+        self.db.userCache = UserCache(10)
+
+        with self.db.transaction() as conn:
+            conn.execute(self.db.queries["addCard"], ("123456789", "Ada", "Lovelace", "ada", c.DEFAULT_VISITS))
+
+
+    def testRegularTurnedAwayFromCache(self):
+    #===========================================================================
+    # A cached regular checking in again inside the hour is refused without
+    # asking the database, and is let in again an hour later
+    #===========================================================================
+        start = datetime(2024, 9, 2, 9, 0)
+
+        with mock.patch.object(c, "ALLOW_CHECKIN_WITHIN_HOUR", 0):
+            self.assertEqual(self.db.checkIn("123456789", start)["checkInStatus"], c.SUCCESS)
+
+            with mock.patch.object(self.db, "checkInBatch", side_effect=AssertionError("asked the database")):
+                refused = self.db.checkIn("123456789", start + timedelta(minutes=30))
+
+            accepted = self.db.checkIn("123456789", start + timedelta(hours=1))
+
+        self.assertEqual(refused["checkInStatus"], c.BAD_CHECKIN_TIME)
+        self.assertEqual(refused["userID"], "ada")
+        self.assertEqual(accepted["checkInStatus"], c.SUCCESS)
+        self.assertEqual(self.db.userCache.get("123456789")["lastCheckIn"], start + timedelta(hours=1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -18,48 +18,145 @@
 
 import sys
 import getpass
+import threading
+from datetime import datetime, timedelta
 
-from dbUtil import DB
+from storage import newDB
+from engine import Engine
 from sharedUtils import Utils
+from metrics import CHECKINS, STATUS_NAMES, newTrace
 import constants as c
 
 class TextUI:
-    def __init__(self):
+    def __init__(self, serverURL=None, backend=None, dbPath=None):
+        # With a server URL, requests go to a check-in service instead of a database
+        self.serverURL = serverURL
+        self.backend = backend or c.DEFAULT_BACKEND
+        # SQLite database file
+        self.dbPath = dbPath
         self.db = None
+        self.engine = None
         self.tools = Utils()
+        self.warnSchema = True
         
 
     def start(self):
     #===========================================================================
     # Main function - start connection to db then open main menu
+    #===========================================================================
+        self.runWithDatabase(self.displayMenu, warmUp=True)
+
+
+    def importRoster(self, csvPath):
+    #===========================================================================
+    # Connect to the db and bulk import a roster CSV
+    #===========================================================================
+        self.runWithDatabase(lambda: self.showImportResult(self.db.importRoster(csvPath)))
+
+
+    def exportVisits(self, path, fmt, start, end, CUID, compress):
+    #===========================================================================
+    # Connect to the db and export the visits table
+    #===========================================================================
+        self.runWithDatabase(lambda: self.showExportResult(self.db.exportVisits(path, fmt, start, end, CUID, compress)))
+
+
+    def initSchema(self):
+    #===========================================================================
+    # Connect to the db and create any missing tables and indexes
+    #===========================================================================
+        # Everything missing is about to be created, so don't warn about it first
+        self.warnSchema = False
+        self.runWithDatabase(lambda: self.showInitSchemaResult(self.db.initSchema()))
+
+
+    def partitionVisits(self):
+    #===========================================================================
+    # Connect to the db and convert the visits table to monthly partitions
+    #===========================================================================
+        self.runWithDatabase(lambda: self.showPartitionResult(self.db.convertVisitsToPartitions()))
+
+
+    def backfillRollups(self):
+    #===========================================================================
+    # Connect to the db and rebuild the rollup tables from the visits
+    #===========================================================================
+        self.runWithDatabase(lambda: self.showBackfillResult(self.db.backfillRollups()))
+
+
+    def reports(self, outDir):
+    #===========================================================================
+    # Connect to the db and write the visit reports
+    #===========================================================================
+        self.runWithDatabase(lambda: self.runReports(outDir))
+
+
+    def serve(self):
+    #===========================================================================
+    # Connect to the db and run the HTTP/JSON check-in service
+    #===========================================================================
+        from service import CheckInService
+        self.runWithDatabase(lambda: CheckInService(self.db).serve(), warmUp=True)
+
+
+    def runWithDatabase(self, action, warmUp=False):
+    #===========================================================================
+    # Ask for db info until connected, run the action, then clean up
+    # With warmUp, the connections are warmed up in the background for swipes
     #===========================================================================
         try:
-            while 1:
-                # Get DB info
-                self.getDbInfo()
+            # Kiosks using a check-in service don't need database credentials
+            if self.serverURL is not None:
+                from service import ServiceClient
+                self.db = ServiceClient(self.serverURL)
+                if self.connectToDatabase() != c.SUCCESS:
+                    print("Could not reach the check-in service at %s" % self.serverURL)
+                    sys.exit(1)
+
+            # A local database file doesn't need a login
+            elif self.backend == "sqlite":
+                self.db = newDB("sqlite", None, self.dbPath, c.TABLE_USERS, c.TABLE_VISITS, None, None)
+                if self.connectToDatabase() != c.SUCCESS:
+                    print("Could not open the database file %s" % self.db.dbPath)
+                    sys.exit(1)
 
-                # Create the DB object
-                self.db = DB(self.dbHost, self.dbName, self.dbUsersTable, self.dbVisitsTable, self.dbUser, self.dbPass)
-                
-                # Connect to the database
-                connectStatus = self.connectToDatabase()
-
-                # If we failed to connect to the database offer to re-enter db info
-                if connectStatus != c.SUCCESS:
-                    reenter = input("Failed to connect to database. Re-enter database info? (Y,n) ")
-                    if reenter.lower() == "n":
-                        print("Bye.")
-                        sys.exit(0)
-                else:
-                    break
+            else:
+                while 1:
+                    # Get DB info
+                    self.getDbInfo()
+
+                    # Create the DB object
+                    self.db = newDB(self.backend, self.dbHost, self.dbName, self.dbUsersTable, self.dbVisitsTable,
+                                    self.dbUser, self.dbPass)
+
+                    # Connect to the database
+                    connectStatus = self.connectToDatabase()
+
+                    # If we failed to connect to the database offer to re-enter db info
+                    if connectStatus != c.SUCCESS:
+                        reenter = input("Failed to connect to database. Re-enter database info? (Y,n) ")
+                        if reenter.lower() == "n":
+                            print("Bye.")
+                            sys.exit(0)
+                    else:
+                        break
 
-            # Start the main menu loop
-            self.displayMenu()
+            # All interactive requests go through the engine
+            self.engine = Engine(self.db)
+            self.engine.start()
+
+            # Warm up the connections while the menu is shown
+            if warmUp:
+                threading.Thread(target=self.db.warmUp, daemon=True).start()
+
+            action()
 
         except KeyboardInterrupt:
             pass
         finally:
             print("Cleaning up and exiting...")
+            if self.engine is not None:
+                self.engine.stop()
             if self.db is not None:
                 self.db.close()
 
@@ -72,7 +169,7 @@ class TextUI:
 
         while 1:
             # Display main menu
-            print("\n\t1.) Check-in\n\t2.) Show Visits\n\t3.) Exit")
+            print("\n\t1.) Check-in\n\t2.) Show Visits\n\t3.) Top Visitors\n\t4.) Reports\n\t5.) Exit")
             try:
                 option = input("\n>> ")
 
@@ -81,6 +178,10 @@ class TextUI:
                 elif option == "2":
                     self.showVisits()
                 elif option == "3":
+                    self.showTopVisitors()
+                elif option == "4":
+                    self.runReports()
+                elif option == "5":
                     sys.exit(0)
                 #elif option == "back" or option == "exit":
                 #    exit = input("Exit? (y,N) ")
@@ -104,6 +205,8 @@ class TextUI:
 
         if status == c.SUCCESS:
             print("done.")
+            if self.warnSchema:
+                self.showSchemaProblems(self.db.schemaProblems)
             return status
         elif status == c.BAD_PASSWD:
             print("\nError connecting to database: Bad username or password.")
@@ -131,12 +234,27 @@ class TextUI:
             else:
                 print("Invalid input. Try again.")"""
 
+        # Extra card readers are checked in from in the background
+        swipeSources = [self.engine.addSwipeSource(path, self.showCheckInResult) for path in c.SWIPE_SOURCES]
+
+        try:
+            self.checkInLoop()
+        finally:
+            for swipeSource in swipeSources:
+                swipeSource.cancel()
+
+
+    def checkInLoop(self):
+    #===========================================================================
+    # Check in swiped cards until the user goes back
+    #===========================================================================
         while 1:
             CUID = self.tools.getCardSwipe()
             # If the user requested to exit the loop, break
             if CUID == c.BACK:
                 break
             elif CUID == c.ERROR_READING_CARD:
+                CHECKINS.inc(STATUS_NAMES[c.ERROR_READING_CARD])
                 print("Error reading card. Swipe card again.")
                 continue
 
@@ -146,16 +264,10 @@ class TextUI:
             if CUID == "":
                 continue
 
-            # Do the checkIn
-            checkInResult = self.db.checkIn(CUID)
+            # Do the checkIn, tagging its log lines with a new trace id
+            checkInResult = self.engine.run(self.engine.checkIn(CUID, newTrace()))
 
-            if checkInResult["checkInStatus"] == c.SQL_ERROR:
-                self.showDatabaseError(checkInResult["sqlError"])
-            elif checkInResult["checkInStatus"] == c.BAD_CHECKIN_TIME:
-                print("Error: You may only check-in once per hour.")
-            elif checkInResult["checkInStatus"] == c.FUTURE_CHECKIN_TIME:
-                print("Error: Previous check-in time was in the future. Check your local system time.")
-            elif checkInResult["checkInStatus"] == c.CUID_NOT_IN_DB:
+            if checkInResult["checkInStatus"] == c.CUID_NOT_IN_DB:
                 # Ask if user wants to add the card
                 addCard = input("Error: Card not found in database. Add it now? (Y,n) ")
             
@@ -168,16 +280,41 @@ class TextUI:
                 email = self.tools.sanitizeInput(input("Clemson Username: "))
 
             # Add the card
-                addCardResult = self.db.addCard(CUID, firstName, lastName, email)
+                addCardResult = self.engine.run(self.engine.addCard(CUID, firstName, lastName, email))
 
                 if addCardResult["addCardStatus"] == c.SUCCESS:
                     self.showCheckinConfirmation(email)
                 elif addCardResult["addCardStatus"] == c.SQL_ERROR:
                     self.showDatabaseError(addCardResult["sqlError"])
-            elif checkInResult["checkInStatus"] == c.SUCCESS:
-                self.showCheckinConfirmation(checkInResult["userID"])
+                elif addCardResult["addCardStatus"] == c.DB_BUSY:
+                    self.showDatabaseBusy()
             else:
-                print("Unknown error checking in.")
+                self.showCheckInResult(checkInResult)
+
+
+    def showCheckInResult(self, checkInResult):
+    #===========================================================================
+    # Report the outcome of a check-in. Unknown cards are only reported here;
+    # checkInLoop offers to add them
+    #===========================================================================
+        if checkInResult["checkInStatus"] == c.SQL_ERROR:
+            self.showDatabaseError(checkInResult["sqlError"])
+        elif checkInResult["checkInStatus"] == c.DB_BUSY:
+            self.showDatabaseBusy()
+        elif checkInResult["checkInStatus"] == c.CHECKIN_JOURNALED:
+            print("\nDatabase unreachable. %s is checked in offline and will be synced later." % (checkInResult["CUID"]))
+        elif checkInResult["checkInStatus"] == c.BAD_CHECKIN_TIME:
+            print("Error: You may only check-in once per hour.")
+        elif checkInResult["checkInStatus"] == c.FUTURE_CHECKIN_TIME:
+            print("Error: Previous check-in time was in the future. Check your local system time.")
+        elif checkInResult["checkInStatus"] == c.ERROR_READING_CARD:
+            print("Error reading card. Swipe card again.")
+        elif checkInResult["checkInStatus"] == c.CUID_NOT_IN_DB:
+            print("Error: Card %s not found in database." % (checkInResult["CUID"]))
+        elif checkInResult["checkInStatus"] == c.SUCCESS:
+            self.showCheckinConfirmation(checkInResult["userID"])
+        else:
+            print("Unknown error checking in.")
                 
 
     def showVisits(self):
@@ -185,25 +322,208 @@ class TextUI:
     # Poll db for visit data based on userID
     #===========================================================================
         userID = self.tools.sanitizeInput(input("\nUser ID (blank for all): "))
-        showVisitsResult = self.db.showVisits(userID)
+
+        if userID != "":
+            self.showRank(userID)
+            return
+
+        # Stream the standings so the first rows print before the rest are fetched
+        showVisitsResult = self.engine.run(self.engine.showVisits("", stream=True))
 
         if showVisitsResult["showVisitsStatus"] == c.SQL_ERROR:
             self.showDatabaseError(showVisitsResult["sqlError"])
+        elif showVisitsResult["showVisitsStatus"] == c.DB_BUSY:
+            self.showDatabaseBusy()
         elif showVisitsResult["showVisitsStatus"] == c.NO_RESULTS:
             print("\nThere were no results to that query.")
         elif showVisitsResult["showVisitsStatus"] == c.SUCCESS:
-            # If showing all users, display a pretty table
-            if userID == "":
-                print("\n+--------------------+\n| User ID | Visits |\n+--------------------+")
+            # Display a pretty table of all users
+            print("\n+--------------------+\n| User ID | Visits |\n+--------------------+")
 
-                for i in range(len(showVisitsResult["visitsTuple"])):
-                    print("|%10s | %6s |" % (showVisitsResult["visitsTuple"][i][0], showVisitsResult["visitsTuple"][i][1]))
-                
-                print("+--------------------+")
-         
-            # Show a single user's visits
+            for row in showVisitsResult["visitsTuple"]:
+                print("|%10s | %6s |" % (row[0], row[1]))
+            
+            print("+--------------------+")
+
+            # The query can still fail after the first rows were shown
+            if showVisitsResult["showVisitsStatus"] == c.SQL_ERROR:
+                self.showDatabaseError(showVisitsResult["sqlError"])
+
+
+    def runReports(self, outDir=None):
+    #===========================================================================
+    # Write the visit reports and say where they went
+    #===========================================================================
+        from reports import reportsAvailable
+
+        if self.serverURL is not None:
+            print("\nReports need a direct database connection, not a check-in service.")
+            return
+        elif not reportsAvailable():
+            print("\nReports need NumPy. Install it with \"pip install numpy\".")
+            return
+
+        print("\nGenerating reports...")
+        reportResult = self.engine.run(self.engine.runReports(outDir))
+
+        if reportResult["reportStatus"] == c.SUCCESS:
+            print("Reports on %d visits written to %s" % (reportResult["visits"], reportResult["index"]))
+        elif reportResult["reportStatus"] == c.NO_RESULTS:
+            print("There are no visits to report on.")
+        elif reportResult["reportStatus"] == c.SQL_ERROR:
+            self.showDatabaseError(reportResult["sqlError"])
+        elif reportResult["reportStatus"] == c.DB_BUSY:
+            self.showDatabaseBusy()
+        elif reportResult["reportStatus"] == c.FAILURE:
+            print("Could not write the reports: %s" % reportResult["error"])
+
+
+    def showTopVisitors(self):
+    #===========================================================================
+    # Show the leaderboard and daily visits for the last few days
+    #===========================================================================
+        days = input("\nDays to cover (blank for %d): " % c.LEADERBOARD_DAYS)
+        try:
+            days = int(days) if days != "" else c.LEADERBOARD_DAYS
+        except ValueError:
+            days = 0
+        if days <= 0:
+            self.invalidInput()
+            return
+
+        # The window ends today, inclusive
+        today = datetime.now().date()
+        start, end = today - timedelta(days=days - 1), today + timedelta(days=1)
+
+        topResult = self.engine.run(self.engine.topVisitors(start, end))
+        if topResult["topStatus"] == c.SQL_ERROR:
+            self.showDatabaseError(topResult["sqlError"])
+            return
+        elif topResult["topStatus"] == c.DB_BUSY:
+            self.showDatabaseBusy()
+            return
+        elif topResult["topStatus"] == c.NO_RESULTS:
+            print("\nNo visits since %s." % start)
+            return
+
+        print("\nTop visitors since %s\n+------------------------------+\n|  User ID  | Visits |   Days  |\n+------------------------------+" % start)
+        for userID, visits, daysVisited in topResult["rows"]:
+            print("|%10s | %6s | %7s |" % (userID, visits, daysVisited))
+        print("+------------------------------+")
+
+        trendResult = self.engine.run(self.engine.visitTrend(start, end))
+        if trendResult["trendStatus"] == c.SUCCESS:
+            busiest = max(visits for day, visits, visitors in trendResult["rows"]) or 1
+            print("\nDay          Visits  Visitors")
+            for day, visits, visitors in trendResult["rows"]:
+                print("%s  %6d  %8d  %s" % (day, visits, visitors, "#" * (40 * visits // busiest)))
+
+
+    def showRank(self, userID):
+    #===========================================================================
+    # Show a single user's visits, rank and percentile
+    #===========================================================================
+        rankResult = self.engine.run(self.engine.showRank(userID))
+
+        if rankResult["showRankStatus"] == c.SQL_ERROR:
+            self.showDatabaseError(rankResult["sqlError"])
+        elif rankResult["showRankStatus"] == c.DB_BUSY:
+            self.showDatabaseBusy()
+        elif rankResult["showRankStatus"] == c.NO_RESULTS:
+            print("\nThere were no results to that query.")
+        elif rankResult["showRankStatus"] == c.SUCCESS:
+            print("\n%s has %s visits (rank %d of %d, %.1f percentile)." %
+                  (userID, rankResult["visits"], rankResult["rank"], rankResult["total"], rankResult["percentile"]))
+
+
+    def showImportResult(self, importResult):
+    #===========================================================================
+    # Report the outcome of a roster import
+    #===========================================================================
+        if importResult["resumedFrom"] > 0:
+            print("\nResumed import after line %d." % importResult["resumedFrom"])
+
+        print("\nImported %d users, rejected %d rows." % (importResult["imported"], importResult["rejected"]))
+        if importResult["rejected"] > 0:
+            print("Rejected rows were written to %s" % importResult["rejectPath"])
+
+        if importResult["importStatus"] == c.SQL_ERROR:
+            self.showDatabaseError(importResult["sqlError"])
+            print("Run the import again to resume from the last saved batch.")
+        elif importResult["importStatus"] == c.DB_BUSY:
+            self.showDatabaseBusy()
+        elif importResult["importStatus"] == c.FAILURE:
+            print("\nCould not read %s" % importResult["csvPath"])
+
+
+    def showInitSchemaResult(self, initSchemaResult):
+    #===========================================================================
+    # Report the outcome of creating the schema
+    #===========================================================================
+        if initSchemaResult["initSchemaStatus"] == c.SUCCESS and not initSchemaResult["problems"]:
+            print("\nThe users and visits tables and their indexes are ready.")
+        elif initSchemaResult["initSchemaStatus"] == c.SQL_ERROR:
+            self.showDatabaseError(initSchemaResult["sqlError"])
+        elif initSchemaResult["initSchemaStatus"] == c.DB_BUSY:
+            self.showDatabaseBusy()
+        else:
+            self.showSchemaProblems(initSchemaResult["problems"])
+
+
+    def showPartitionResult(self, partitionResult):
+    #===========================================================================
+    # Report the outcome of partitioning the visits table
+    #===========================================================================
+        if partitionResult["partitionStatus"] == c.SUCCESS:
+            if partitionResult["created"]:
+                print("\nMoved %d visits into %d partitions." % (partitionResult["moved"], len(partitionResult["created"])))
             else:
-                print("\n%s has %s visits." % (userID, str(showVisitsResult["visitsTuple"][0][0])))
+                print("\nThe visits table is already partitioned.")
+            for name in partitionResult["retired"]:
+                print("Retired partition %s" % name)
+        elif partitionResult["partitionStatus"] == c.SQL_ERROR:
+            self.showDatabaseError(partitionResult["sqlError"])
+        elif partitionResult["partitionStatus"] == c.DB_BUSY:
+            self.showDatabaseBusy()
+        else:
+            print("\nThis database does not support partitioning the visits table.")
+
+
+    def showBackfillResult(self, backfillResult):
+    #===========================================================================
+    # Report the outcome of rebuilding the rollups
+    #===========================================================================
+        if backfillResult["backfillStatus"] == c.SUCCESS:
+            print("\nRollups rebuilt for %d days of visits." % backfillResult["days"])
+        elif backfillResult["backfillStatus"] == c.SQL_ERROR:
+            self.showDatabaseError(backfillResult["sqlError"])
+        elif backfillResult["backfillStatus"] == c.DB_BUSY:
+            self.showDatabaseBusy()
+
+
+    def showSchemaProblems(self, problems):
+    #===========================================================================
+    # Warn about missing tables or indexes
+    #===========================================================================
+        if problems:
+            print("\nWarning: the database schema is incomplete:")
+            for problem in problems:
+                print("\t" + problem)
+            print("Run \"checkIn.py --init-schema\" to create them.")
+
+
+    def showExportResult(self, exportResult):
+    #===========================================================================
+    # Report the outcome of a visits export
+    #===========================================================================
+        if exportResult["exportStatus"] == c.SUCCESS:
+            print("\nVisits exported to %s" % exportResult["path"])
+        elif exportResult["exportStatus"] == c.SQL_ERROR:
+            self.showDatabaseError(exportResult["sqlError"])
+        elif exportResult["exportStatus"] == c.DB_BUSY:
+            self.showDatabaseBusy()
+        elif exportResult["exportStatus"] == c.FAILURE:
+            print("\nCould not write %s" % exportResult["path"])
 
 
     def getDbInfo(self):
@@ -252,6 +572,13 @@ class TextUI:
         print("\nWARNING! Database error:\n%s" % error.pgerror)
 
 
+    def showDatabaseBusy(self):
+    #===========================================================================
+    # Warn that no database connection was free in time
+    #===========================================================================
+        print("\nThe database is busy. Try again.")
+
+
     def invalidInput(self):
     #===========================================================================
     # Complain about invalid input
@@ -17,21 +17,22 @@
 #===============================================================================
 
 from time import sleep
-from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtCore import QObject, QThread, pyqtSignal
 
-from dbUtil import DB
+from storage import newDB
 import constants as c
 
 
 class LoginThread(QThread):
     postLoginSignal = pyqtSignal(int, object)
 
-    def __init__(self, dbHost, dbDatabase, dbUsersTable, dbVisitsTable, dbUser, dbPass, postLoginCallback):
+    def __init__(self, backend, dbHost, dbDatabase, dbUsersTable, dbVisitsTable, dbUser, dbPass, postLoginCallback):
         super(LoginThread, self).__init__()
+        self.backend = backend
         self.dbHost = dbHost
         self.dbDatabase = dbDatabase
         self.dbUsersTable = dbUsersTable
-        self.dbVisistsTable = dbVisitsTable
+        self.dbVisitsTable = dbVisitsTable
         self.dbUser = dbUser
         self.dbPass = dbPass
 
@@ -43,111 +44,61 @@ class LoginThread(QThread):
     # Initialize db object and connect to database
     #===========================================================================
         # Init the db object
-        db = DB(self.dbHost, self.dbDatabase, self.dbTable, self.dbUser, self.dbPass)
+        db = newDB(self.backend, self.dbHost, self.dbDatabase, self.dbUsersTable, self.dbVisitsTable, self.dbUser, self.dbPass)
 
         # Connect to the remote database server
         loginStatus = db.connect()
    
         self.postLoginSignal.emit(loginStatus, db)
 
+        # Warm up the connections while the main window is shown
+        if loginStatus == c.SUCCESS:
+            db.warmUp()
 
-class CheckinThread(QThread):
-    postCardSwipeSignal = pyqtSignal(int, str, str, object)
 
-    def __init__(self, db, postCardSwipeCallback):
-        super(CheckinThread, self).__init__()
+class EngineBridge(QObject):
+    resultSignal = pyqtSignal(object, object)
 
-        self.db = db
-        self.CUID = None
-
-        self.postCardSwipeSignal.connect(postCardSwipeCallback)
-
-
-    def setCUID(self, CUID):
-    #===========================================================================
-    # set CUID
-    #===========================================================================
-        self.CUID = CUID
-
-   
-    def run(self):
+    def __init__(self, engine, parent=None):
     #===========================================================================
-    # Verify CUID card length, and attempt checkIn. Return results.
+    # Delivers the results of engine requests to callbacks on the Qt thread
     #===========================================================================
-        # Warning: setCUID() must have been called before starting this thread
-
-        # At least make sure the card ID is of the right length. Not much more validation can be done.
-        if len(self.CUID) != 9:
-            self.postCardSwipeSignal.emit(c.ERROR_READING_CARD, '', '', object())
-            return
-      
-        checkInResult = self.db.checkIn(self.CUID)
-
-        # Don't pass nonetype's through signals expecting an object or seg faults happen
-        if checkInResult["sqlError"] is None:
-            checkInResult["sqlError"] = object()
-
-        self.postCardSwipeSignal.emit(checkInResult["checkInStatus"], checkInResult["userID"], checkInResult["CUID"], checkInResult["sqlError"])
+        super(EngineBridge, self).__init__(parent)
 
+        self.engine = engine
 
-class AddCardThread(QThread):
-    cardAddedSignal = pyqtSignal(int, str, str, object)
+        # Emitted from the engine thread; Qt queues it to the thread this object lives in
+        self.resultSignal.connect(self.deliver)
 
-    def __init__(self, db, CUID, userID, cardAddedCallback):
-        super(AddCardThread, self).__init__()
 
-        self.db = db
-        self.CUID = CUID
-        self.userID = userID
-
-        self.cardAddedSignal.connect(cardAddedCallback)
-
-   
-    def run(self):
+    def call(self, coro, callback):
     #===========================================================================
-    # Request additional data about new card then send to db
+    # Run a coroutine on the engine and pass its result to callback on the Qt
+    # thread. Returns a future; cancel() it to drop the request and the callback
     #===========================================================================
-        addCardResult = self.db.addCard(self.CUID, self.userID)
+        future = self.engine.submit(coro)
+        future.add_done_callback(lambda done: self.finished(done, callback))
+        return future
 
-        # Don't send nonetype's through signals
-        if addCardResult['sqlError'] is None:
-            addCardResult['sqlError'] = object()
 
-        self.cardAddedSignal.emit(addCardResult["addCardStatus"], addCardResult["userID"], addCardResult["CUID"], addCardResult["sqlError"])
-
-
-class ShowVisitsThread(QThread):
-    showVisitsSignal = pyqtSignal(int, object, object)
-
-    def __init__(self, db, userID, showVisitsCallback):
-        super(ShowVisitsThread, self).__init__()
-
-        self.db = db
-        self.userID = userID
-
-        self.showVisitsSignal.connect(showVisitsCallback)
-   
-
-    def setUserID(self, userID):
+    def finished(self, future, callback):
     #===========================================================================
-    # set User ID
+    # Engine side: forward the result unless the request was cancelled or failed
     #===========================================================================
-        self.userID = userID
+        if future.cancelled():
+            return
+        elif future.exception() is not None:
+            print("Request failed:", future.exception())
+            return
 
-   
-    def run(self):
-    #===========================================================================
-    # Connect to db and request visits information - then return
-    #===========================================================================
-        showVisitsResult = self.db.showVisits(self.userID)
+        self.resultSignal.emit(callback, future.result())
 
-        # Don't send nonetype's through a signal or it gets angry and seg faults
-        if showVisitsResult["sqlError"] is None:
-            showVisitsResult["sqlError"] = object()
-        if showVisitsResult["visitsTuple"] is None:
-            showVisitsResult["visitsTuple"] = object()
 
-        self.showVisitsSignal.emit(showVisitsResult["showVisitsStatus"], showVisitsResult["visitsTuple"], showVisitsResult["sqlError"])
+    def deliver(self, callback, result):
+    #===========================================================================
+    # Qt side: hand the result to the callback
+    #===========================================================================
+        callback(result)
 
 
 class SleepThread(QThread):
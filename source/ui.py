@@ -16,7 +16,6 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>. 
 #===============================================================================
 
-import re
 import sys
 import time
 import os
@@ -24,27 +23,51 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 from PyQt5.QtCore import *
 
-from dbUtil import DB
+from storage import BACKENDS
+from engine import Engine, SwipeQueue
+from service import ServiceClient
 from threads import *
 from sharedUtils import Utils
+from cardReader import SwipeDecoder
+from metrics import STAGE_SECONDS, CHECKINS, STATUS_NAMES, newTrace, traced
 import constants as c
 
 
 class UI(QApplication):
-    def __init__(self, args):
+    def __init__(self, args, serverURL=None, backend=None, dbPath=None):
         super(UI, self).__init__(args)
 
+        # Kiosks using a check-in service skip the database login
+        if serverURL is not None:
+            db = ServiceClient(serverURL)
+            if db.connect() != c.SUCCESS:
+                QMessageBox.critical(None, "Service Error", "Could not reach the check-in service at " + serverURL,
+                                     QMessageBox.Ok, QMessageBox.Ok)
+                sys.exit(1)
+
+            self.mainWnd = MainWnd(db)
+            self.mainWnd.show()
+            return
+
         # Show the login window
-        self.loginWnd = LoginWnd()
+        self.loginWnd = LoginWnd(backend, dbPath)
         self.loginWnd.show()
 
 
 
 class LoginWnd(QMainWindow):
-    def __init__(self):
+    def __init__(self, backend=None, dbPath=None):
         super(LoginWnd, self).__init__()
-        
+
+        # What the host field holds for each backend, kept when switching between them
+        self.locations = {"postgres": c.DEFAULT_HOST, "sqlite": dbPath or c.SQLITE_PATH}
+        self.backend = None
+        # Built while the first login attempt connects, and kept for retries
+        self.mainWnd = None
+
         self.initUI()
+        self.backendCombo.setCurrentText(backend or c.DEFAULT_BACKEND)
+        self.backendChanged(self.backendCombo.currentText())
       
         
     def initUI(self):
@@ -58,6 +81,12 @@ class LoginWnd(QMainWindow):
         self.logoImg = QLabel(self)
         self.logoImg.setPixmap(logoPix)
 
+        # Create storage backend label and selector
+        self.backendLabel = QLabel("Storage:", self)
+        self.backendCombo = QComboBox(self)
+        self.backendCombo.addItems(BACKENDS)
+        self.backendCombo.currentTextChanged.connect(self.backendChanged)
+
         # Create host label and text edit
         self.hostLabel = QLabel("Host:", self)
         self.hostEdit = QLineEdit(c.DEFAULT_HOST, self)
@@ -80,7 +109,7 @@ class LoginWnd(QMainWindow):
         self.loginBtn = QPushButton("Login", self)
         self.exitBtn = QPushButton("Exit", self)
       
-        self.loginBtn.setToolTip("Log in to Postgres server")
+        self.loginBtn.setToolTip("Log in to the database")
         self.exitBtn.setToolTip("Exit")
 
         self.loginBtn.resize(self.loginBtn.sizeHint())
@@ -94,25 +123,29 @@ class LoginWnd(QMainWindow):
         grid = QGridLayout()
         grid.setSpacing(10)
 
+        # Add storage backend widgets
+        grid.addWidget(self.backendLabel, 0, 0)
+        grid.addWidget(self.backendCombo, 0, 1)
+
         # Add host widgets
-        grid.addWidget(self.hostLabel, 0, 0)
-        grid.addWidget(self.hostEdit, 0, 1)
+        grid.addWidget(self.hostLabel, 1, 0)
+        grid.addWidget(self.hostEdit, 1, 1)
 
         # Add table widgets
-        grid.addWidget(self.tableLabel, 1, 0)
-        grid.addWidget(self.tableEdit, 1, 1)
+        grid.addWidget(self.tableLabel, 2, 0)
+        grid.addWidget(self.tableEdit, 2, 1)
 
         # Add username widgets
-        grid.addWidget(self.userLabel, 2, 0)
-        grid.addWidget(self.userEdit, 2, 1)
+        grid.addWidget(self.userLabel, 3, 0)
+        grid.addWidget(self.userEdit, 3, 1)
 
         # Add password widgets
-        grid.addWidget(self.passLabel, 3, 0)
-        grid.addWidget(self.passEdit, 3, 1)
+        grid.addWidget(self.passLabel, 4, 0)
+        grid.addWidget(self.passEdit, 4, 1)
 
         # Add login and exit buttons
-        grid.addWidget(self.exitBtn, 4, 0)
-        grid.addWidget(self.loginBtn, 4, 1)
+        grid.addWidget(self.exitBtn, 5, 0)
+        grid.addWidget(self.loginBtn, 5, 1)
 
         # Add grid to the hbox layout for horizontal centering
         hbox = QHBoxLayout()
@@ -133,7 +166,7 @@ class LoginWnd(QMainWindow):
 
         # Center the window
         # setGeometry args are x, y, width, height
-        self.setGeometry(0, 0, 575, 200)
+        self.setGeometry(0, 0, 575, 230)
         geo = self.frameGeometry()
         centerPt = QDesktopWidget().availableGeometry().center()
         geo.moveCenter(centerPt)
@@ -145,10 +178,27 @@ class LoginWnd(QMainWindow):
         self.statusBar().showMessage("Not connected to server  |  " + c.GROUP_NAME + " Attendance Tracker Version " + str(c.VERSION))
 
 
+    def backendChanged(self, backend):
+    #===========================================================================
+    # Switch the login fields between a Postgres server and a SQLite file,
+    # which needs no login
+    #===========================================================================
+        if self.backend is not None:
+            self.locations[self.backend] = str(self.hostEdit.text())
+        self.backend = backend
+
+        isServer = backend != "sqlite"
+        self.hostLabel.setText("Host:" if isServer else "File:")
+        self.hostEdit.setText(self.locations[backend])
+        self.userEdit.setEnabled(isServer)
+        self.passEdit.setEnabled(isServer)
+
+
     def preLogin(self):
     #===========================================================================
     # Ensure settings are populated and then attempt to connect to db
     #===========================================================================
+        backend = self.backend
         dbHost = str(self.hostEdit.text())
         dbTable = str(self.tableEdit.text())
         dbUser = str(self.userEdit.text())
@@ -156,26 +206,39 @@ class LoginWnd(QMainWindow):
       
         # Check if user or pass are empty
         if dbHost == "":
-            QMessageBox.warning(self, "Error", "Host field cannot be empty", QMessageBox.Ok, QMessageBox.Ok)
+            QMessageBox.warning(self, "Error", str(self.hostLabel.text()).rstrip(":") + " field cannot be empty",
+                                QMessageBox.Ok, QMessageBox.Ok)
             return
         elif dbTable == "":
             QMessageBox.warning(self, "Error", "Table field cannot be empty", QMessageBox.Ok, QMessageBox.Ok)
             return
-        elif dbUser == "":
+        elif dbUser == "" and backend != "sqlite":
             QMessageBox.warning(self, "Error", "User field cannot be empty", QMessageBox.Ok, QMessageBox.Ok)
             return
-        elif dbPass == "":
+        elif dbPass == "" and backend != "sqlite":
             QMessageBox.warning(self, "Error", "Password field cannot be empty", QMessageBox.Ok, QMessageBox.Ok)
             return
 
+        # For SQLite the host field holds the database file
+        if backend == "sqlite":
+            dbDatabase = dbHost
+            dbHost = None
+        else:
+            dbDatabase = c.DEFAULT_DATABASE
+
         # Display the connecting window
         self.connWnd = ConnectingWnd()
         self.connWnd.show()
 
-        # Create a new dbUtil object and have it connect to the database
-        self.loginThread = LoginThread(dbHost, c.DEFAULT_DATABASE, dbTable, dbUser, dbPass, self.postLogin)
+        # Create a new DB object for the backend and have it connect to the database
+        self.loginThread = LoginThread(backend, dbHost, dbDatabase, dbTable, c.TABLE_VISITS, dbUser, dbPass,
+                                       self.postLogin)
         self.loginThread.start()
 
+        # Build the main window while the connection is being made
+        if self.mainWnd is None:
+            self.mainWnd = MainWnd()
+
 
     def postLogin(self, loginStatus, db):
     #===========================================================================
@@ -192,31 +255,69 @@ class LoginWnd(QMainWindow):
             QMessageBox.critical(self, "Database Error", "Error connecting to database", QMessageBox.Ok, QMessageBox.Ok)
             return
 
+        # Connected, but the check-in and standings queries will be slow or fail without these
+        if db.schemaProblems:
+            QMessageBox.warning(self, "Database Warning", "The database schema is incomplete:\n\n" +
+                                "\n".join(db.schemaProblems) + "\n\nRun \"checkIn.py --init-schema\" to create them.",
+                                QMessageBox.Ok, QMessageBox.Ok)
+
         # Connected to server. Launch the main window and hide the login window
-        self.mainWnd = MainWnd(db)
+        self.mainWnd.setDB(db)
         self.mainWnd.show()
         self.close()
 
 
 
 class MainWnd(QMainWindow):
-    def __init__(self, db):
+    def __init__(self, db=None):
         super(MainWnd, self).__init__()
 
-        self.db = db
+        self.db = None
         self.tools = Utils()
 
-        # Init card input so it can be appended to later
-        self.cardInput = ""
+        # Every database request goes through the engine; results come back on the UI thread
+        # The engine is started once there is a database (see setDB)
+        self.engine = Engine(db)
+        self.bridge = EngineBridge(self.engine, self)
+
+        # Swipes are queued and checked in in order by a worker on the engine
+        self.swipeQueue = SwipeQueue(self.engine, lambda result: self.bridge.resultSignal.emit(self.showCheckInResult, result))
+
+        # The extra card readers being served
+        self.swipeSources = []
+        self.rankFuture = None
 
-        # Compile the regex for pulling the card ID from all the data on a card
-        self.regex = re.compile("%(.+)..\?;")
+        # Decodes the card reader's keystrokes as they arrive
+        self.decoder = SwipeDecoder()
+
+        # Finishes swipes from readers that don't end them with Enter
+        self.swipeTimer = QTimer(self)
+        self.swipeTimer.setSingleShot(True)
+        self.swipeTimer.timeout.connect(lambda: self.cardsRead(self.decoder.poll()))
 
         # Declare sleepThread
         self.sleepThread = SleepThread(c.TIME_BETWEEN_CHECKINS, self.resetCheckinWidget)
 
         self.initUI()
 
+        if db is not None:
+            self.setDB(db)
+
+
+    def setDB(self, db):
+    #===========================================================================
+    # Start checking in to a connected database. The window can be built
+    # before this, while the connection is being made
+    #===========================================================================
+        self.db = db
+        self.engine.db = db
+        self.engine.start()
+        self.swipeQueue.start()
+
+        # Keep the swipe queue stats in the status bar current
+        self.updateStatusBar()
+        self.statsTimer.start(500)
+
         
     def initUI(self):
     #===========================================================================
@@ -233,7 +334,10 @@ class MainWnd(QMainWindow):
         # Title, icon, and statusbar
         self.setWindowTitle(c.GROUP_INITIALS + " Attendance")
         self.setWindowIcon(QIcon(os.path.abspath("images/login_logo.png")))
-        self.statusBar().showMessage("Connected to server  |  " + c.GROUP_NAME + " Attendance Tracker Version " + str(c.VERSION))
+
+        # Keep the swipe queue stats in the status bar current (started by setDB)
+        self.statsTimer = QTimer(self)
+        self.statsTimer.timeout.connect(self.updateStatusBar)
         # Init all the central widgets
         self.initMainMenuWidget()
         self.initCheckinWidget()
@@ -255,28 +359,44 @@ class MainWnd(QMainWindow):
    
     def keyPressEvent(self, event):
     #===========================================================================
-    # Collect key data until regex matches - then reset and collect again
+    # Feed key data to the card decoder and check in each card it completes
     #===========================================================================
         # Only look for card swipes if the checkin widget is currently shown
         if self.centralWidget.currentWidget() == self.checkinWidget:
-            try:
-                # Try to match the input to the card ID regex
-                r =  self.regex.search(self.cardInput)
-                CUID = r.groups()[0]
+            self.cardsRead(self.decoder.feed(event.text()))
+
+            # Give the rest of a swipe time to arrive before finishing it
+            if self.decoder.pending():
+                self.swipeTimer.start(int(self.decoder.timeout * 1000) + 10)
+
+
+    def cardsRead(self, results):
+    #===========================================================================
+    # Queue the cards the decoder completed and report garbled swipes
+    #===========================================================================
+        for CUID in results:
+            if CUID == c.ERROR_READING_CARD:
+                CHECKINS.inc(STATUS_NAMES[c.ERROR_READING_CARD])
+                self.postCardSwipe(c.ERROR_READING_CARD, '', '', None)
+            else:
+                # Queue the card even if earlier swipes are still being checked in
+                self.checkInCard(CUID)
 
-                # A match was made so reset cardInput for the next card
-                self.cardInput = ""
 
-                # Set the card ID and start the checkin thread
-                # CUID is going into an SQL query; don't forget to sanitize the input
-                if not (self.checkinThread.isRunning() and self.sleepThread.isRunning()):
-                    #self.checkinThread.setCUID(Utils.sanitizeInput(str(CUID)))
-                    self.checkinThread.setCUID(CUID)
-                    self.checkinThread.start()
+    def updateStatusBar(self):
+    #===========================================================================
+    # Show the connection, swipe queue depth and queue wait times
+    #===========================================================================
+        stats = self.swipeQueue.stats()
+        queueText = "Queue %d/%d  |  Wait avg %d ms, max %d ms" % (stats["depth"], stats["maxSize"],
+                                                                 stats["avgWait"] * 1000, stats["maxWait"] * 1000)
+        if stats["spilled"]:
+            queueText += ", %d saved for later" % stats["spilled"]
+        if stats["rejected"]:
+            queueText += ", %d turned away" % stats["rejected"]
 
-            except AttributeError:
-                # If a match was not made append the current text to card input
-                self.cardInput += event.text()
+        self.statusBar().showMessage("Connected to server  |  " + queueText + "  |  " + c.GROUP_NAME +
+                                     " Attendance Tracker Version " + str(c.VERSION))
 
 
     def closeEvent(self, closeEvent):
@@ -284,6 +404,9 @@ class MainWnd(QMainWindow):
     # Close database connection prior to closing application
     #===========================================================================
         print("Cleaning up and exiting...")
+        self.statsTimer.stop()
+        self.swipeQueue.stop()
+        self.engine.stop()
         if self.db is not None:
             self.db.close()
         closeEvent.accept();
@@ -297,12 +420,15 @@ class MainWnd(QMainWindow):
 
         checkinButton = QImageButton("Check-in", os.path.abspath('images/magnetic_card.png'), self.showCheckinWidget, 100, self)
         showVisitsButton = QImageButton("Show Visits", os.path.abspath('images/trophy.png'), self.showVisitsWidget, 100, self)
+        self.reportsButton = QImageButton("Reports", os.path.abspath('images/main_logo.png'), self.runReports, 100, self)
 
         hbox = QHBoxLayout()
         hbox.addStretch(1)
         hbox.addWidget(checkinButton)
         hbox.addSpacing(45)
         hbox.addWidget(showVisitsButton)
+        hbox.addSpacing(45)
+        hbox.addWidget(self.reportsButton)
         hbox.addStretch(1)
 
         self.mainMenuWidget.setLayout(hbox)
@@ -314,22 +440,14 @@ class MainWnd(QMainWindow):
     #===========================================================================
         self.checkinWidget = QWidget()
 
-        # Init widgets
-        self.cardPix = QPixmap(os.path.abspath("images/magnetic_card.png"))
-        self.greenPix = QPixmap(os.path.abspath("images/green_check_mark.png"))
-        self.redPix = QPixmap(os.path.abspath("images/red_x_mark.png"))
+        # Init widgets. The images are loaded when the screen is first shown
+        self.cardPix = None
+        self.greenPix = None
+        self.redPix = None
         self.checkinImg = QLabel(self)
         self.checkinLabel = QLabel("Waiting for card swipe...")
         self.checkinBackBtn = QPushButton("Back", self)
 
-        # Size the images properly
-        self.cardPix = self.cardPix.scaledToHeight(175, Qt.SmoothTransformation)
-        self.greenPix = self.greenPix.scaledToHeight(175, Qt.SmoothTransformation)
-        self.redPix = self.redPix.scaledToHeight(175, Qt.SmoothTransformation)
-
-        # Add the card image to image widget
-        self.checkinImg.setPixmap(self.cardPix)
-
         # Set the font for the checkin label
         font = QFont("Sans Serif", 16, QFont.Bold)
         self.checkinLabel.setFont(font)
@@ -361,33 +479,55 @@ class MainWnd(QMainWindow):
         self.checkinWidget.setLayout(hbox)
 
    
+    def loadCheckinImages(self):
+    #===========================================================================
+    # Load and size the check-in screen's images the first time it is shown
+    #===========================================================================
+        if self.cardPix is not None:
+            return
+
+        self.cardPix = QPixmap(os.path.abspath("images/magnetic_card.png")).scaledToHeight(175, Qt.SmoothTransformation)
+        self.greenPix = QPixmap(os.path.abspath("images/green_check_mark.png")).scaledToHeight(175, Qt.SmoothTransformation)
+        self.redPix = QPixmap(os.path.abspath("images/red_x_mark.png")).scaledToHeight(175, Qt.SmoothTransformation)
+
+        # Add the card image to image widget
+        self.checkinImg.setPixmap(self.cardPix)
+
+   
     def initShowVisitsWidget(self):
     #===========================================================================
     # Initialize visits widget
     #===========================================================================
         self.visitsWidget = QWidget()
 
-        self.checkinThread = None
-
         # Init widgets
         self.visitsTitle = QLabel("Current visits Standings")
-        self.visitsTextArea = QTextEdit()
+        self.visitsTable = QTableView()
         self.visitsBackBtn = QPushButton("Back", self)
 
+        # Rows are fetched page by page in the background as the table is scrolled
+        self.visitsModel = VisitsTableModel(self.engine, self.bridge, self)
+        self.visitsModel.errorSignal.connect(self.setVisits)
+        self.visitsTable.setModel(self.visitsModel)
+        self.visitsTable.setSortingEnabled(True)
+        self.visitsTable.verticalHeader().hide()
+        self.visitsTable.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.visitsTable.setSelectionBehavior(QAbstractItemView.SelectRows)
+
         # Set the font for the checkin label
         self.visitsTitle.setFont(QFont("Sans Serif", 12, QFont.Bold))
 
         # Add signals to buttons
         self.visitsBackBtn.clicked.connect(self.closeShowVisitsScreen)
 
-        # Create the layout for the visits scroll area
-        self.visitsTextArea.setFont(QFont("Monospace", 8, QFont.Normal))
+        # Create the layout for the visits table
+        self.visitsTable.setFont(QFont("Monospace", 8, QFont.Normal))
       
         # Add widgets to vbox layout for vertical centering
         vbox = QVBoxLayout()
         vbox.addStretch(1)
         vbox.addWidget(self.visitsTitle, alignment=Qt.AlignCenter)
-        vbox.addWidget(self.visitsTextArea)
+        vbox.addWidget(self.visitsTable)
         vbox.addWidget(self.visitsBackBtn)
         vbox.addStretch(1)
 
@@ -405,6 +545,7 @@ class MainWnd(QMainWindow):
     #===========================================================================
     # Show Checkin Widget - used to request point value that is now depreciated
     #===========================================================================
+        self.loadCheckinImages()
         self.centralWidget.setCurrentWidget(self.checkinWidget)
 
         """# Get the visit value
@@ -419,48 +560,87 @@ class MainWnd(QMainWindow):
             else:
                 self.closeCheckinScreen()
                 return"""
-      
-        # Init the checkin thread
-        # visitValue will be used in SQL queries. Sanitize it.
-        self.checkinThread = CheckinThread(self.db, self.postCardSwipe)
+
+        # Extra card readers are checked in from while this screen is up
+        self.swipeSources = [self.engine.addSwipeSource(path, lambda result: self.bridge.resultSignal.emit(self.showCheckInResult, result))
+                             for path in c.SWIPE_SOURCES]
+
+
+    def checkInCard(self, CUID):
+    #===========================================================================
+    # Queue a decoded card ID to be checked in on the engine
+    # The card format checked its length when it was decoded
+    #===========================================================================
+        # CUID is going into an SQL query; don't forget to sanitize the input
+        # Each swipe gets a trace id that its log lines are tagged with
+        if self.swipeQueue.submit(self.tools.sanitizeInput(CUID), newTrace()) == c.SUCCESS:
+            # Let people in a rush know their swipe was taken
+            ahead = self.swipeQueue.stats()["depth"] - 1
+            if ahead > 0:
+                self.checkinLabel.setText("Please wait, %d swipe%s ahead of you..." % (ahead, "" if ahead == 1 else "s"))
+            self.updateStatusBar()
+
+
+    def showCheckInResult(self, checkInResult):
+    #===========================================================================
+    # Show a check-in or add card result dict
+    #===========================================================================
+        status = checkInResult["checkInStatus"] if "checkInStatus" in checkInResult else checkInResult["addCardStatus"]
+
+        with traced(checkInResult.get("trace")):
+            started = time.perf_counter()
+            self.postCardSwipe(status, str(checkInResult["userID"]), str(checkInResult["CUID"]), checkInResult["sqlError"])
+
+            # Results that open a dialog would time the person reading it
+            if status in STATUS_NAMES and status not in (c.CUID_NOT_IN_DB, c.SQL_ERROR):
+                STAGE_SECONDS.observe("ui", time.perf_counter() - started)
 
    
     def showVisitsWidget(self):
     #===========================================================================
     # Show visits for certain CUID
     #===========================================================================
-        self.visitsTextArea.clear()
         self.centralWidget.setCurrentWidget(self.visitsWidget)
 
         # Get the user ID to show visits for or an empty string for all user ID's
         CUID, ok = QInputDialog.getText(self, "CUID", "CUID (blank for all CUID\'s):")
 
         if not ok:
-            # The show visits thread was not declared yet so just skip the closeShowvisitsScreen function
             self.showMainMenuWidget()
+            return
       
-        # Init the show visits thread
-        # userID will be used in SQL queries. Sanitize it.
-        self.showVisitsThread = ShowVisitsThread(self.db, self.tools.sanitizeInput(str(CUID)), self.setVisits)
-        self.showVisitsThread.start()
+        userID = self.tools.sanitizeInput(str(CUID))
+
+        # A single user also gets their rank in the title
+        self.visitsTitle.setText("Current visits Standings")
+        if self.rankFuture is not None:
+            self.rankFuture.cancel()
+        if userID != "":
+            self.rankFuture = self.bridge.call(self.engine.showRank(userID), self.setRank)
+
+        # Point the model at the new query. Sorting restarts the background fetch
+        self.visitsModel.setUserID(userID)
+        self.visitsTable.sortByColumn(1, Qt.DescendingOrder)
+        self.visitsTable.scrollToTop()
 
 
     def closeCheckinScreen(self):
     #===========================================================================
-    # Close checkinThread and return to Main Menu
+    # Stop the extra card readers and return to Main Menu
+    # A check-in already sent to the database is left to finish
     #===========================================================================
-        if self.checkinThread is not None:
-            self.checkinThread.terminate()
+        for swipeSource in self.swipeSources:
+            swipeSource.cancel()
+        self.swipeSources = []
 
         self.showMainMenuWidget()
 
    
     def closeShowVisitsScreen(self):
     #=======================================================================
-    # Close visits thread and return to main menu
+    # Stop fetching visits and return to main menu
     #=======================================================================
-        if self.checkinThread is not None:
-            self.showVisitsThread.terminate()
+        self.visitsModel.clear()
         self.showMainMenuWidget()
         
       
@@ -471,6 +651,9 @@ class MainWnd(QMainWindow):
         if checkinStatus == c.SUCCESS:
             self.checkinImg.setPixmap(self.greenPix)
             self.checkinLabel.setText(str(userID))
+        elif checkinStatus == c.CHECKIN_JOURNALED:
+            self.checkinImg.setPixmap(self.greenPix)
+            self.checkinLabel.setText(str(CUID) + " (saved, will sync later)")
         elif checkinStatus == c.SQL_ERROR:
                 QMessageBox.critical(self, "Database Error", "WARNING! Database error: " + sqlError.pgerror, QMessageBox.Ok, QMessageBox.Ok)
                 # Don't bother to change UI elements or start the sleep thread, just wait for the next card
@@ -483,18 +666,28 @@ class MainWnd(QMainWindow):
                 self.checkinLabel.setText("Yoau may only check-in once per hour.")
             elif checkinStatus == c.FUTURE_CHECKIN_TIME:
                 self.checkinLabel.setText("Previous check-in time was in the future. Check your local system time.")
+            elif checkinStatus == c.DB_BUSY:
+                self.checkinLabel.setText("The database is busy. Swipe again.")
+            elif checkinStatus == c.SWIPE_QUEUE_FULL:
+                self.checkinLabel.setText("Please wait a moment, then swipe again.")
             elif checkinStatus == c.CUID_NOT_IN_DB:
                 # If the card is not in the DB ask to add it
                 reply = QMessageBox.question(self, "CUID Not in Database", "This CUID was not found in the database. Add it now?", QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
 
                 if reply == QMessageBox.Yes:
-                    # If adding new card, get the userID associated with the card
-                    userID, ok = QInputDialog.getText(self, "Add New Card", "User ID:")
-                    # Sanitize the userID input and call the add card thread
-                
+                    # If adding new card, get the user's name and userID
+                    firstName, ok = QInputDialog.getText(self, "Add New Card", "First Name:")
+                    if ok:
+                        lastName, ok = QInputDialog.getText(self, "Add New Card", "Last Name:")
+                    if ok:
+                        userID, ok = QInputDialog.getText(self, "Add New Card", "User ID:")
+
+                    # Sanitize the input and add the card
                     if ok and userID != "":
-                        self.addCardThread = AddCardThread(self.db, CUID, self.tools.sanitizeInput(userID), self.postCardSwipe)
-                        self.addCardThread.start()
+                        self.bridge.call(self.engine.addCard(CUID, self.tools.sanitizeInput(str(firstName)),
+                                                                                self.tools.sanitizeInput(str(lastName)),
+                                                                                self.tools.sanitizeInput(str(userID))),
+                                                            self.showCheckInResult)
                 
                 # Don't bother to change UI elements or start the sleep thread, just wait for the next card
                 return
@@ -522,21 +715,197 @@ class MainWnd(QMainWindow):
         self.checkinLabel.update()
 
    
-    def setVisits(self, showVisitsStatus, visitsTuple, sqlError):
+    def setVisits(self, showVisitsStatus, sqlError):
     #===========================================================================
-    # Depreciated - removing visits setting
+    # Report errors from the visits table's background fetches
     #===========================================================================
         if showVisitsStatus == c.NO_RESULTS:
             QMessageBox.critical(self, "Empty Query", "The specified user ID was not found in the database", QMessageBox.Ok, QMessageBox.Ok)
+        elif showVisitsStatus == c.DB_BUSY:
+            QMessageBox.critical(self, "Database Busy", "The database is busy. Try again.", QMessageBox.Ok, QMessageBox.Ok)
+        elif showVisitsStatus == c.SQL_ERROR:
+            QMessageBox.critical(self, "Database Error", "WARNING! Database error: " + str(sqlError.pgerror), QMessageBox.Ok, QMessageBox.Ok)
+
+
+    def runReports(self):
+    #===========================================================================
+    # Write the visit reports in the background and open them when done
+    #===========================================================================
+        # NumPy is only loaded once someone asks for reports
+        from reports import reportsAvailable
+
+        if isinstance(self.db, ServiceClient):
+            QMessageBox.information(self, "Reports", "Reports need a direct database connection, not a check-in service.",
+                                    QMessageBox.Ok, QMessageBox.Ok)
+            return
+        elif not reportsAvailable():
+            QMessageBox.information(self, "Reports", "Reports need NumPy. Install it with \"pip install numpy\".",
+                                    QMessageBox.Ok, QMessageBox.Ok)
+            return
+
+        # One run at a time
+        self.reportsButton.setEnabled(False)
+        self.bridge.call(self.engine.runReports(), self.showReportResult)
+
+
+    def showReportResult(self, reportResult):
+    #===========================================================================
+    # Open the reports index in the browser or show what went wrong
+    #===========================================================================
+        self.reportsButton.setEnabled(True)
+
+        if reportResult["reportStatus"] == c.SUCCESS:
+            if not QDesktopServices.openUrl(QUrl.fromLocalFile(os.path.abspath(reportResult["index"]))):
+                QMessageBox.information(self, "Reports", "Reports written to " + os.path.abspath(reportResult["index"]),
+                                        QMessageBox.Ok, QMessageBox.Ok)
+        elif reportResult["reportStatus"] == c.NO_RESULTS:
+            QMessageBox.information(self, "Reports", "There are no visits to report on.", QMessageBox.Ok, QMessageBox.Ok)
+        elif reportResult["reportStatus"] == c.DB_BUSY:
+            QMessageBox.critical(self, "Database Busy", "The database is busy. Try again.", QMessageBox.Ok, QMessageBox.Ok)
+        elif reportResult["reportStatus"] == c.SQL_ERROR:
+            QMessageBox.critical(self, "Database Error", "WARNING! Database error: " + str(reportResult["sqlError"].pgerror), QMessageBox.Ok, QMessageBox.Ok)
+        elif reportResult["reportStatus"] == c.FAILURE:
+            QMessageBox.critical(self, "Reports", "Could not write the reports: " + str(reportResult["error"]), QMessageBox.Ok, QMessageBox.Ok)
+
+
+    def setRank(self, rankResult):
+    #===========================================================================
+    # Show a single user's rank and percentile above the visits table
+    #===========================================================================
+        if rankResult["showRankStatus"] == c.SUCCESS:
+            self.visitsTitle.setText("%s: %s visits, rank %d of %d (%.1f percentile)" %
+                                     (rankResult["userID"], rankResult["visits"], rankResult["rank"],
+                                      rankResult["total"], rankResult["percentile"]))
+
+
+class VisitsTableModel(QAbstractTableModel):
+    errorSignal = pyqtSignal(int, object)
+
+    HEADERS = ["User ID", "Visits"]
+    SORT_KEYS = ["userID", "visits"]
+
+    def __init__(self, engine, bridge, parent=None):
+        super(VisitsTableModel, self).__init__(parent)
+
+        self.engine = engine
+        self.bridge = bridge
+        self.userID = ""
+        self.rows = []
+        self.orderBy = "visits"
+        self.descending = True
+        self.exhausted = True
+
+        # Bumped whenever the query changes so results of older fetches are dropped
+        self.generation = 0
+        self.fetchFuture = None
+
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+
+    def data(self, index, role=Qt.DisplayRole):
+    #===========================================================================
+    # Show a cell of the standings
+    #===========================================================================
+        if not index.isValid():
+            return QVariant()
+        elif role == Qt.DisplayRole:
+            return str(self.rows[index.row()][index.column()])
+        elif role == Qt.TextAlignmentRole and index.column() == 1:
+            return Qt.AlignRight | Qt.AlignVCenter
+        return QVariant()
+
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return QVariant()
+
+
+    def setUserID(self, userID):
+    #===========================================================================
+    # Show one user (or everyone for "") on the next sort
+    #===========================================================================
+        self.userID = userID
+
+
+    def sort(self, column, order=Qt.AscendingOrder):
+    #===========================================================================
+    # Sorting is done by the database. Drop the rows and fetch from the top
+    #===========================================================================
+        self.orderBy = self.SORT_KEYS[column]
+        self.descending = order == Qt.DescendingOrder
+        self.restart()
+
+
+    def restart(self):
+    #===========================================================================
+    # Drop the loaded rows and start fetching the current query again
+    #===========================================================================
+        self.clear()
+        self.exhausted = False
+        self.fetchMore(QModelIndex())
+
+
+    def clear(self):
+    #===========================================================================
+    # Drop the loaded rows and ignore fetches in progress
+    #===========================================================================
+        self.beginResetModel()
+        self.generation += 1
+        self.rows = []
+        self.exhausted = True
+        self.endResetModel()
+
+        if self.fetchFuture is not None:
+            self.fetchFuture.cancel()
+            self.fetchFuture = None
+
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and not self.exhausted
+
+
+    def fetchMore(self, parent):
+    #===========================================================================
+    # Fetch the next page on the engine unless one is on its way
+    #===========================================================================
+        if self.exhausted or self.fetchFuture is not None:
             return
-        for i in range(len(visitsTuple)):
-            userID = str(visitsTuple[i][0])
-            visits = str(visitsTuple[i][1])
-            self.visitsTextArea.append(userID + "\t" + visits)
-
-        # Move the scrollbar to the top
-        scrollbar = self.visitsTextArea.verticalScrollBar()
-        scrollbar.setValue(scrollbar.minimum())
+
+        generation = self.generation
+        self.fetchFuture = self.bridge.call(self.engine.showVisits(self.userID, limit=c.VISITS_FETCH_BATCH, offset=len(self.rows),
+                                                                   orderBy=self.orderBy, descending=self.descending),
+                                            lambda showVisitsResult: self.rowsFetched(generation, showVisitsResult))
+
+
+    def rowsFetched(self, generation, showVisitsResult):
+    #===========================================================================
+    # Append a fetched page (on the UI thread)
+    #===========================================================================
+        if generation != self.generation:
+            return
+
+        self.fetchFuture = None
+        showVisitsStatus = showVisitsResult["showVisitsStatus"]
+        rows = showVisitsResult["visitsTuple"]
+        sqlError = showVisitsResult["sqlError"]
+
+        if showVisitsStatus == c.SUCCESS:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(rows) - 1)
+            self.rows.extend(rows)
+            self.endInsertRows()
+            self.exhausted = len(rows) < c.VISITS_FETCH_BATCH
+        else:
+            self.exhausted = True
+            # Running off the end of the standings is not an error
+            if showVisitsStatus != c.NO_RESULTS or not self.rows:
+                self.errorSignal.emit(showVisitsStatus, sqlError)
 
 
 class ConnectingWnd(QWidget):
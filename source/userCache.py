@@ -0,0 +1,86 @@
+#===============================================================================
+#    Magstripe Attendance Database System
+#===============================================================================
+#
+#    Magstripe Attendance is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Magstripe Attendance is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import threading
+from collections import OrderedDict
+
+
+class UserCache:
+    def __init__(self, maxSize):
+    #===========================================================================
+    # Bounded LRU cache of user records keyed by CUID
+    # Records are dicts with the userID, lastCheckIn and visitNum of a user
+    #===========================================================================
+        self.maxSize = maxSize
+        self.records = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+
+    def get(self, CUID):
+    #===========================================================================
+    # Get a user's record or None if it is not cached
+    #===========================================================================
+        with self.lock:
+            record = self.records.get(CUID)
+
+            if record is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.records.move_to_end(CUID)
+            return record
+
+
+    def put(self, CUID, record):
+    #===========================================================================
+    # Cache a user's record, evicting the least recently used one if full
+    #===========================================================================
+        with self.lock:
+            self.records[CUID] = record
+            self.records.move_to_end(CUID)
+
+            while len(self.records) > self.maxSize:
+                self.records.popitem(last=False)
+                self.evictions += 1
+
+
+    def invalidate(self, CUID):
+    #===========================================================================
+    # Drop a user's record. A CUID of None drops everything
+    #===========================================================================
+        with self.lock:
+            if CUID is None:
+                self.invalidations += len(self.records)
+                self.records.clear()
+            elif self.records.pop(CUID, None) is not None:
+                self.invalidations += 1
+
+
+    def stats(self):
+    #===========================================================================
+    # Hit/miss counters and current size
+    #===========================================================================
+        with self.lock:
+            return {"size": len(self.records), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "invalidations": self.invalidations}